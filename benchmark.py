@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import platform
+import tempfile
+
+import torch
+
+from dataloader.synthetic import loadSyntheticDataset
+from dataloader.common import TextDataloader, SOS_token
+from model.seq2seq import Seq2SeqModel, lengthMask
+from model.checkpoint import makeCheckpoint, saveCheckpoint, exportInference
+from inference import loadInferenceModel
+from model.shortlist import buildShortlist, DEFAULT_FALLBACK_THRESHOLD
+from model.sampling import Sampler
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_pairs', type=int, default=20000)
+parser.add_argument('--vocab_size', type=int, default=5000)
+parser.add_argument('--min_length', type=int, default=1)
+parser.add_argument('--max_length', type=int, default=20)
+parser.add_argument('--length_dist', type=str, default='geometric', choices=['uniform', 'geometric'])
+parser.add_argument('--min_count', type=int, default=3)
+parser.add_argument('-b', '--batch_size', type=int, default=64)
+parser.add_argument('--hidden_size', type=int, default=500)
+parser.add_argument('--attn_model', type=str, default='dot', choices=['dot', 'general', 'concat'])
+parser.add_argument('--train_steps', type=int, default=20)
+parser.add_argument('--decode_batch_sizes', type=str, default='1,8,32')
+parser.add_argument('--decode_length', type=int, default=10)
+parser.add_argument('--decode_repeats', type=int, default=5)
+parser.add_argument('--step_repeats', type=int, default=200)
+parser.add_argument('--shortlist_k', type=int, default=2000)
+parser.add_argument('--shortlist_per_word', type=int, default=20)
+parser.add_argument('--shortlist_threshold', type=float, default=DEFAULT_FALLBACK_THRESHOLD)
+parser.add_argument('--shortlist_sentences', type=int, default=100)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--only', type=str, default='data,collate,train,decode,step,sampling,coldstart,shortlist')
+parser.add_argument('-o', '--output', type=str, default='benchmark.json')
+parser.add_argument('--baseline', type=str, help='previous benchmark output to compare against')
+args = parser.parse_args()
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def peakRSS():
+	# ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		rss /= 1024
+	return rss / 1024
+
+def synchronize():
+	if device.type == 'cuda':
+		torch.cuda.synchronize()
+
+def toDevice(data):
+	inputs, lengths, targets, mask, max_target_len = data
+	return inputs.to(device), lengths, targets.to(device), mask.to(device), max_target_len
+
+def benchDataBuild(dataset):
+	start = time.perf_counter()
+	dataloader = TextDataloader(dataset, max_length=args.max_length + 2, min_count=args.min_count,
+		batch_size=args.batch_size, shuffle=True)
+	elapsed = time.perf_counter() - start
+	return dataloader, {
+		'seconds': elapsed,
+		'pairs': len(dataloader.pairs),
+		'num_words': dataloader.getVoc().num_words,
+	}
+
+def benchCollation(dataloader):
+	start = time.perf_counter()
+	batches = 0
+	for _ in dataloader:
+		batches += 1
+	elapsed = time.perf_counter() - start
+	return {
+		'seconds': elapsed,
+		'batches': batches,
+		'batches_per_sec': batches / elapsed,
+	}
+
+def benchTraining(model, dataloader):
+	model.train()
+	batches = [toDevice(data) for _, data in zip(range(args.train_steps + 1), dataloader)]
+	# The first step pays for allocator and kernel warm-up, so it is excluded
+	model.optimize(*batches[0])
+	tokens = 0
+	synchronize()
+	start = time.perf_counter()
+	for data in batches[1:]:
+		model.optimize(*data)
+		tokens += data[3].sum().item()
+	synchronize()
+	elapsed = time.perf_counter() - start
+	return {
+		'steps': len(batches) - 1,
+		'seconds': elapsed,
+		'tokens': tokens,
+		'tokens_per_sec': tokens / elapsed,
+	}
+
+def decodeBatch(dataloader, batch_size):
+	pairs = dataloader.pairs
+	voc = dataloader.getVoc()
+	sentences = [pairs[i % len(pairs)][0] for i in range(batch_size)]
+	sentences.sort(key=lambda s: len(s.split(' ')), reverse=True)
+	indexes_batch = [voc.indicesFromSentence(sentence) for sentence in sentences]
+	lengths = torch.tensor([len(indexes) for indexes in indexes_batch])
+	input_batch = torch.nn.utils.rnn.pad_sequence([torch.LongTensor(indexes) for indexes in indexes_batch]).to(device)
+	return input_batch, lengths
+
+def timeDecode(model, input_batch, lengths, **kwargs):
+	with torch.no_grad():
+		model.evaluate(input_batch, lengths, args.decode_length, **kwargs)
+		synchronize()
+		start = time.perf_counter()
+		for _ in range(args.decode_repeats):
+			model.evaluate(input_batch, lengths, args.decode_length, **kwargs)
+		synchronize()
+	return (time.perf_counter() - start) / args.decode_repeats
+
+def benchDecode(model, dataloader):
+	model.eval()
+	results = {}
+	for batch_size in [int(b) for b in args.decode_batch_sizes.split(',')]:
+		input_batch, lengths = decodeBatch(dataloader, batch_size)
+		# Per-token cost over a fixed number of steps, then the reply latency with early exit at EOS
+		elapsed = timeDecode(model, input_batch, lengths, EOS_token=None)
+		early_exit = timeDecode(model, input_batch, lengths)
+		with torch.no_grad():
+			_, _, reply_lengths = model.evaluate(input_batch, lengths, args.decode_length)
+		results[str(batch_size)] = {
+			'seconds_per_batch': elapsed,
+			'ms_per_token': elapsed / args.decode_length * 1000,
+			'ms_per_token_per_sentence': elapsed / args.decode_length / batch_size * 1000,
+			'early_exit_seconds_per_batch': early_exit,
+			'mean_reply_length': reply_lengths.float().mean().item(),
+			'max_reply_length': reply_lengths.max().item(),
+		}
+	return results
+
+def benchStep(model, dataloader):
+	# A single decoder step against a fixed encoder memory, and its attention part (scores, softmax and
+	#   context) on its own, without the decoding loop around them
+	model.eval()
+	decoder = model.decoder
+	results = {}
+	for batch_size in [int(b) for b in args.decode_batch_sizes.split(',')]:
+		input_batch, lengths = decodeBatch(dataloader, batch_size)
+		with torch.no_grad():
+			encoder_outputs, encoder_hidden = model.encoder(input_batch, lengths)
+			attn_mask = lengthMask(lengths.to(device), encoder_outputs.size(1)).unsqueeze(1)
+			attn_keys = decoder.attn.precompute(encoder_outputs)
+			hidden = encoder_hidden[:decoder.n_layers].clone()
+			decoder_input = torch.full((1, batch_size), SOS_token, device=device, dtype=torch.long)
+			rnn_output, _ = decoder.gru(decoder.embedding(decoder_input), hidden)
+			timings = {}
+			for name, step in [
+				('step', lambda: decoder(decoder_input, hidden, encoder_outputs, attn_mask, attn_keys)),
+				('attention', lambda: decoder.attn(rnn_output, encoder_outputs, attn_mask, attn_keys).bmm(encoder_outputs)),
+			]:
+				step()
+				synchronize()
+				start = time.perf_counter()
+				for _ in range(args.step_repeats):
+					step()
+				synchronize()
+				timings[name] = (time.perf_counter() - start) / args.step_repeats
+		results[str(batch_size)] = {
+			'input_length': input_batch.size(0),
+			'us_per_step': timings['step'] * 1e6,
+			'attention_us_per_step': timings['attention'] * 1e6,
+		}
+	return results
+
+def benchSampling(model, dataloader):
+	# Overhead of seeded per-request top-k / top-p sampling relative to greedy decoding
+	model.eval()
+	results = {}
+	for batch_size in [int(b) for b in args.decode_batch_sizes.split(',')]:
+		input_batch, lengths = decodeBatch(dataloader, batch_size)
+		greedy = timeDecode(model, input_batch, lengths, EOS_token=None)
+		results[str(batch_size)] = {'greedy_ms_per_token': greedy / args.decode_length * 1000}
+		for name, params in [('top_k', {'top_k': 40}), ('top_p', {'top_p': 0.9})]:
+			sampler = Sampler(batch_size, temperature=0.8, seeds=list(range(batch_size)), device=device, **params)
+			elapsed = timeDecode(model, input_batch, lengths, sampler=sampler, EOS_token=None)
+			results[str(batch_size)][name + '_ms_per_token'] = elapsed / args.decode_length * 1000
+			results[str(batch_size)][name + '_overhead'] = elapsed / greedy - 1
+	return results
+
+def benchColdStart(model, dataloader):
+	# Time to rebuild a servable model from an exported inference checkpoint (weights + vocab only)
+	with tempfile.TemporaryDirectory() as directory:
+		full_path = os.path.join(directory, 'full.pth')
+		inference_path = os.path.join(directory, 'inference.pth')
+		saveCheckpoint(makeCheckpoint(model, dataloader.getVoc(), dataloader), full_path)
+		exportInference(full_path, inference_path)
+		start = time.perf_counter()
+		loadInferenceModel(inference_path, device)
+		elapsed = time.perf_counter() - start
+		return {
+			'seconds': elapsed,
+			'checkpoint_mb': os.path.getsize(full_path) / 1024 / 1024,
+			'inference_checkpoint_mb': os.path.getsize(inference_path) / 1024 / 1024,
+		}
+
+def benchShortlist(model, dataloader):
+	# Single-sentence greedy decoding with and without the shortlist; quality is reported as the
+	#   fraction of output tokens identical to full-vocabulary decoding
+	model.eval()
+	voc = dataloader.getVoc()
+	start = time.perf_counter()
+	shortlist = buildShortlist(voc, dataloader.pairs, args.shortlist_k, args.shortlist_per_word).to(device)
+	shortlist.fallback_threshold = args.shortlist_threshold
+	build_time = time.perf_counter() - start
+
+	full_time, shortlist_time, matches, total, candidates = 0.0, 0.0, 0, 0, 0
+	with torch.no_grad():
+		for pair in dataloader.pairs[:args.shortlist_sentences]:
+			input_batch = torch.LongTensor(voc.indicesFromSentence(pair[0])).view(-1, 1).to(device)
+			lengths = torch.tensor([input_batch.size(0)])
+			start = time.perf_counter()
+			full_tokens, _, _ = model.evaluate(input_batch, lengths, args.decode_length, EOS_token=None)
+			synchronize()
+			full_time += time.perf_counter() - start
+			start = time.perf_counter()
+			tokens, _, _ = model.evaluate(input_batch, lengths, args.decode_length, shortlist, EOS_token=None)
+			synchronize()
+			shortlist_time += time.perf_counter() - start
+			matches += (tokens == full_tokens).sum().item()
+			total += tokens.numel()
+			candidates += shortlist.candidates(input_batch).numel()
+	sentences = min(args.shortlist_sentences, len(dataloader.pairs))
+	return {
+		'build_seconds': build_time,
+		'mean_candidates': candidates / sentences,
+		'num_words': voc.num_words,
+		'full_ms_per_token': full_time / total * 1000,
+		'shortlist_ms_per_token': shortlist_time / total * 1000,
+		'speedup': full_time / shortlist_time,
+		'fallback_threshold': shortlist.fallback_threshold,
+		'token_agreement': matches / total,
+		'fallback_rate': shortlist.fallbacks / shortlist.steps if shortlist.steps > 0 else 0.0,
+	}
+
+def compare(results, baseline, prefix=''):
+	# Print every numeric metric next to its value in the baseline run
+	for key, value in results.items():
+		if key not in baseline:
+			continue
+		if isinstance(value, dict):
+			compare(value, baseline[key], prefix + key + '.')
+		elif isinstance(value, (int, float)) and not isinstance(value, bool) and baseline[key]:
+			print('%-50s %14.4f %14.4f %+8.1f%%' % (prefix + key, baseline[key], value, (value / baseline[key] - 1) * 100))
+
+def main():
+	random.seed(args.seed)
+	torch.manual_seed(args.seed)
+	sections = args.only.split(',')
+
+	results = {
+		'config': vars(args),
+		'environment': {
+			'python': platform.python_version(),
+			'torch': torch.__version__,
+			'device': str(device),
+			'num_threads': torch.get_num_threads(),
+			'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		},
+	}
+
+	dataset = loadSyntheticDataset(args.num_pairs, args.vocab_size, args.min_length, args.max_length,
+		args.length_dist, args.seed)
+	dataloader, results['data'] = benchDataBuild(dataset)
+	print('data build: %.2fs for %d pairs' % (results['data']['seconds'], results['data']['pairs']))
+
+	if 'collate' in sections:
+		results['collate'] = benchCollation(dataloader)
+		print('collation: %.1f batches/sec' % (results['collate']['batches_per_sec']))
+
+	model = Seq2SeqModel(device, SOS_token, dataloader.getVoc().num_words,
+		attn_model=args.attn_model, hidden_size=args.hidden_size).to(device)
+
+	if 'train' in sections:
+		results['train'] = benchTraining(model, dataloader)
+		print('training: %.1f tokens/sec' % (results['train']['tokens_per_sec']))
+
+	if 'decode' in sections:
+		results['decode'] = benchDecode(model, dataloader)
+		for batch_size, r in results['decode'].items():
+			print('decode (batch %s): %.3f ms/token, %.2f ms/batch stopping at EOS (mean length %.1f of %d)' % (batch_size, r['ms_per_token'],
+				r['early_exit_seconds_per_batch'] * 1000, r['mean_reply_length'], args.decode_length))
+
+	if 'step' in sections:
+		results['step'] = benchStep(model, dataloader)
+		for batch_size, r in results['step'].items():
+			print('decoder step (batch %s, input length %d): %.1f us, attention %.1f us' % (batch_size, r['input_length'],
+				r['us_per_step'], r['attention_us_per_step']))
+
+	if 'sampling' in sections:
+		results['sampling'] = benchSampling(model, dataloader)
+		for batch_size, r in results['sampling'].items():
+			print('sampling overhead (batch %s): top-k %+.1f%%, top-p %+.1f%%' % (batch_size, 100 * r['top_k_overhead'], 100 * r['top_p_overhead']))
+
+	if 'coldstart' in sections:
+		results['coldstart'] = benchColdStart(model, dataloader)
+		print('cold start: %.3fs from a %.1f MB inference checkpoint' % (results['coldstart']['seconds'], results['coldstart']['inference_checkpoint_mb']))
+
+	if 'shortlist' in sections:
+		results['shortlist'] = benchShortlist(model, dataloader)
+		shortlist = results['shortlist']
+		print('shortlist (%.0f of %d words, fallback below %.2f): %.2fx faster per token, %.1f%% tokens identical, %.1f%% fallbacks' % (
+			shortlist['mean_candidates'], shortlist['num_words'], shortlist['fallback_threshold'], shortlist['speedup'],
+			100 * shortlist['token_agreement'], 100 * shortlist['fallback_rate']))
+
+	results['peak_rss_mb'] = peakRSS()
+	print('peak RSS: %.1f MB' % (results['peak_rss_mb']))
+
+	with open(args.output, 'w') as f:
+		json.dump(results, f, indent=2)
+
+	if args.baseline and os.path.exists(args.baseline):
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		print('%-50s %14s %14s %9s' % ('metric', 'baseline', 'current', 'change'))
+		compare({k: v for k, v in results.items() if k not in ['config', 'environment']}, baseline)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import random
+import argparse
+
+import numpy as np
+import torch
+
+from dataloader.corpus import loadCorpus
+from dataloader.common import TextDataloader
+from model.retrieval import buildRetrievalIndex, encodePairs
+from inference import loadInferenceModel
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-l', '--load', type=str, required=True, help='checkpoint with an embedded vocabulary; serve with the same one')
+	parser.add_argument('-o', '--output', type=str, default='weights/retrieval')
+	parser.add_argument('--batch_size', type=int, default=256)
+	parser.add_argument('--n_lists', type=int, help='IVF lists (default: 4 * sqrt(pairs))')
+	parser.add_argument('--lsh_bits', type=int, default=64)
+	parser.add_argument('--kmeans_iterations', type=int, default=10)
+	parser.add_argument('--n_probe', type=int, default=8, help='IVF lists searched per query in the report')
+	parser.add_argument('--n_candidates', type=int, default=1000, help='LSH candidates reranked per query in the report')
+	parser.add_argument('--held_out', type=str, default='weights/held_out.tsv', help='pairs the checkpoint never trained on (test.py --held_out), used as report queries')
+	parser.add_argument('--thresholds', type=str, default='0.8,0.9,0.95', help='similarity thresholds to report fast-path hit rates for')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--synthetic', type=int, default=0, help='index a synthetic corpus of this many pairs instead of NUCC, queried with pairs of the next seed')
+	parser.add_argument('--report', type=str, default='retrieval.json')
+	args = parser.parse_args()
+
+	device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+	random.seed(args.seed)
+	torch.manual_seed(args.seed)
+
+	model, voc = loadInferenceModel(args.load, device)
+	# Every training pair of the checkpoint is indexed; the pairs it never trained on are the report queries
+	train_pairs, held_out_pairs = loadCorpus(args.held_out, args.synthetic, args.seed)
+	pairs = TextDataloader(train_pairs, max_length=32, min_count=3, batch_size=args.batch_size, shuffle=False, voc=voc).pairs
+	queries = TextDataloader(held_out_pairs, max_length=32, min_count=3, batch_size=args.batch_size, shuffle=False, voc=voc).pairs
+
+	start = time.perf_counter()
+	index = buildRetrievalIndex(model, voc, pairs, args.output, args.batch_size, args.n_lists, args.lsh_bits,
+		args.kmeans_iterations, seed=args.seed)
+	build_time = time.perf_counter() - start
+	report = {
+		'config': vars(args),
+		'pairs': len(index),
+		'build_seconds': build_time,
+		'vectors_mb': os.path.getsize(os.path.join(args.output, 'vectors.npy')) / 1024 / 1024,
+		'n_lists': len(index.centroids),
+	}
+	print('indexed %d pairs in %.2fs (%d IVF lists)' % (len(index), build_time, report['n_lists']))
+
+	if queries:
+		vectors = np.zeros((len(queries), index.hidden_size), dtype=np.float32)
+		encodePairs(model, voc, queries, vectors, args.batch_size)
+		results = {}
+		for method in ['exact', 'ivf', 'lsh']:
+			# One query at a time, as in serving
+			start = time.perf_counter()
+			scores, ids = zip(*[index.search(vectors[i : i + 1], 1, method, args.n_probe, args.n_candidates) for i in range(len(queries))])
+			elapsed = time.perf_counter() - start
+			results[method] = (np.concatenate(scores)[:, 0], np.concatenate(ids)[:, 0])
+			report[method] = {'ms_per_query': elapsed / len(queries) * 1000}
+			if method != 'exact':
+				# Counted by score, since identical inputs in the corpus make the exact nearest id ambiguous
+				report[method]['recall_at_1'] = float((results[method][0] >= results['exact'][0] - 1e-5).mean())
+			print('%-5s %.3f ms/query%s' % (method, report[method]['ms_per_query'],
+				', recall@1 %.3f' % (report[method]['recall_at_1']) if method != 'exact' else ''))
+		report['hit_rate'] = {}
+		for threshold in [float(t) for t in args.thresholds.split(',')]:
+			report['hit_rate'][str(threshold)] = float((results['exact'][0] >= threshold).mean())
+			print('threshold %.2f: %.1f%% of held-out inputs answered from the index' % (threshold, 100 * report['hit_rate'][str(threshold)]))
+
+	with open(args.report, 'w') as f:
+		json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,34 @@
+import glob
+import argparse
+
+from dataloader.shards import buildShards, iterPairFile
+from dataloader.dedup import PairDeduplicator
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('inputs', nargs='+', help='tab-separated pair files (e.g. data/nucc/formated_lines.txt); globs are expanded')
+	parser.add_argument('-o', '--output', type=str, required=True)
+	parser.add_argument('--shard_size', type=int, default=1000000, help='pairs per shard')
+	parser.add_argument('--max_length', type=int, default=32)
+	parser.add_argument('--min_count', type=int, default=3)
+	parser.add_argument('--dedup', action='store_true')
+	parser.add_argument('--near_dup', action='store_true')
+	parser.add_argument('--max_response_count', type=int)
+	parser.add_argument('--dedup_capacity', type=int, default=1000000, help='kept pairs the fixed-size dedup filters are sized for (20 MB per million)')
+	args = parser.parse_args()
+
+	paths = sorted(path for pattern in args.inputs for path in glob.glob(pattern))
+
+	def pairs():
+		for path in paths:
+			yield from iterPairFile(path)
+
+	dedup = None
+	if args.dedup or args.near_dup or args.max_response_count is not None:
+		dedup = PairDeduplicator(near_duplicates=args.near_dup, max_response_count=args.max_response_count,
+			capacity=args.dedup_capacity)
+
+	buildShards(pairs, args.output, args.max_length, args.min_count, args.shard_size, dedup)
+
+if __name__ == '__main__':
+	main()
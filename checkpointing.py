@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import random
+import resource
+import argparse
+import multiprocessing as mp
+
+import torch
+
+from dataloader.common import SOS_token
+from model.seq2seq import Seq2SeqModel
+
+# Peak memory and training throughput of Seq2SeqModel.optimize across target lengths, with and without
+#   activation checkpointing of the decoder loop (Seq2SeqModel.checkpoint_steps). Batches are random tokens
+#   of fixed length, so every step decodes exactly max_length targets.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--lengths', type=str, default='10,20,40,80', help='comma-separated target lengths')
+parser.add_argument('--chunks', type=str, default='0,5,10', help='comma-separated decoder timesteps per checkpoint (0: no checkpointing)')
+parser.add_argument('-b', '--batch_size', type=int, default=64)
+parser.add_argument('--input_length', type=int, default=10)
+parser.add_argument('--num_words', type=int, default=5000)
+parser.add_argument('--hidden_size', type=int, default=500)
+parser.add_argument('--steps', type=int, default=3, help='timed optimize() calls per setting, after one warm-up call')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('-o', '--output', type=str, default='checkpointing.json')
+args = parser.parse_args()
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def currentRSS():
+	# Resident memory in MB (Linux)
+	with open('/proc/self/statm') as f:
+		return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+def peakRSS():
+	# ru_maxrss is reported in kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(max_length, chunk_steps):
+	random.seed(args.seed)
+	torch.manual_seed(args.seed)
+	model = Seq2SeqModel(device, SOS_token, args.num_words, hidden_size=args.hidden_size).to(device)
+	model.checkpoint_steps = chunk_steps
+	model.train()
+	inputs = torch.randint(3, args.num_words, (args.input_length, args.batch_size), device=device)
+	lengths = torch.full((args.batch_size,), args.input_length, dtype=torch.long)
+	targets = torch.randint(3, args.num_words, (max_length, args.batch_size), device=device)
+	mask = torch.ones(max_length, args.batch_size, dtype=torch.bool, device=device)
+
+	# The warm-up call also allocates the Adam moments, so that the peak below is that of activations
+	model.optimize(inputs, lengths, targets, mask, max_length, teacher_forcing_ratio=1.0)
+	if device.type == 'cuda':
+		torch.cuda.synchronize()
+		torch.cuda.reset_peak_memory_stats()
+		baseline = torch.cuda.memory_allocated() / 1024 / 1024
+	else:
+		baseline = currentRSS()
+	start = time.perf_counter()
+	for _ in range(args.steps):
+		model.optimize(inputs, lengths, targets, mask, max_length, teacher_forcing_ratio=1.0)
+	if device.type == 'cuda':
+		torch.cuda.synchronize()
+	elapsed = time.perf_counter() - start
+	peak = torch.cuda.max_memory_allocated() / 1024 / 1024 if device.type == 'cuda' else peakRSS()
+	return {
+		'max_length': max_length,
+		'checkpoint_steps': chunk_steps,
+		'peak_mb': peak - baseline,
+		'seconds_per_step': elapsed / args.steps,
+		'tokens_per_sec': max_length * args.batch_size * args.steps / elapsed,
+	}
+
+def measureInChild(max_length, chunk_steps, results):
+	results.put(measure(max_length, chunk_steps))
+
+def main():
+	report = {'config': vars(args), 'device': str(device), 'results': []}
+	for max_length in [int(length) for length in args.lengths.split(',')]:
+		for chunk_steps in [int(chunk) for chunk in args.chunks.split(',')]:
+			if device.type == 'cuda':
+				result = measure(max_length, chunk_steps)
+			else:
+				# The peak RSS of a process never decreases, so every CPU setting runs in a fresh process
+				context = mp.get_context('fork')
+				results = context.Queue()
+				process = context.Process(target=measureInChild, args=(max_length, chunk_steps, results))
+				process.start()
+				result = results.get()
+				process.join()
+			report['results'].append(result)
+			print('max_length %3d, checkpoint_steps %3d: peak %8.1f MB above the model, %8.1f tokens/sec' % (max_length, chunk_steps,
+				result['peak_mb'], result['tokens_per_sec']))
+
+	with open(args.output, 'w') as f:
+		json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+	main()
@@ -54,6 +54,48 @@ class Voc:
 		for word in keep_words:
 			self.addWord(word)
 
+	# Add the words of new sentence pairs that occur at least min_count times in them. New words are
+	#   appended after the existing ids, so indices already used by a model never change.
+	def extend(self, pairs, min_count=1):
+		new_counts = {}
+		for pair in pairs:
+			for sentence in pair:
+				for word in sentence.split(' '):
+					if word in self.word2index:
+						self.word2count[word] += 1
+					else:
+						new_counts[word] = new_counts.get(word, 0) + 1
+		added = 0
+		for word, count in new_counts.items():
+			if count >= min_count:
+				self.word2index[word] = self.num_words
+				self.word2count[word] = count
+				self.index2word[self.num_words] = word
+				self.num_words += 1
+				added += 1
+		return added
+
+	# Compact serializable form: words and counts in index order, without the default tokens
+	def state_dict(self):
+		words = [self.index2word[i] for i in range(3, self.num_words)]
+		return {
+			'trimmed': self.trimmed,
+			'words': words,
+			'counts': [self.word2count[word] for word in words],
+		}
+
+	def load_state_dict(self, state):
+		self.trimmed = state['trimmed']
+		self.word2index = {}
+		self.word2count = {}
+		self.index2word = {PAD_token: "PAD", SOS_token: "SOS", EOS_token: "EOS"}
+		self.num_words = 3
+		for word, count in zip(state['words'], state['counts']):
+			self.word2index[word] = self.num_words
+			self.word2count[word] = count
+			self.index2word[self.num_words] = word
+			self.num_words += 1
+
 	def indicesFromSentence(self, sentence):
 		return [self.word2index[word] for word in sentence.split(' ')] + [EOS_token]
 
@@ -91,6 +133,10 @@ def trimRareWords(voc, pairs, MIN_COUNT):
 	print("Trimmed from {} pairs to {}, {:.4f} of total".format(len(pairs), len(keep_pairs), len(keep_pairs) / len(pairs)))
 	return keep_pairs
 
+def knownPairs(voc, pairs):
+	# Pairs whose words are all in the vocabulary
+	return [pair for pair in pairs if all(word in voc.word2index for sentence in pair for word in sentence.split(' '))]
+
 def loadPrepareData(pairs, max_length, min_count):
 	pairs = filterPairs(pairs, max_length)
 	print("Trimmed to {!s} sentence pairs".format(len(pairs)))
@@ -119,15 +165,16 @@ def binaryMatrix(l, value=PAD_token):
 				m[i].append(1)
 	return m
  
-def inputVar(l, voc):
-	indexes_batch = [voc.indicesFromSentence(sentence) for sentence in l]
+def inputVarFromIndices(indexes_batch):
 	lengths = torch.tensor([len(indexes) for indexes in indexes_batch])
 	padList = zeroPadding(indexes_batch)
 	padVar = torch.LongTensor(padList)
 	return padVar, lengths
  
-def outputVar(l, voc):
-	indexes_batch = [voc.indicesFromSentence(sentence) for sentence in l]
+def inputVar(l, voc):
+	return inputVarFromIndices([voc.indicesFromSentence(sentence) for sentence in l])
+ 
+def outputVarFromIndices(indexes_batch):
 	max_target_len = max([len(indexes) for indexes in indexes_batch])
 	padList = zeroPadding(indexes_batch)
 	mask = binaryMatrix(padList)
@@ -135,6 +182,9 @@ def outputVar(l, voc):
 	padVar = torch.LongTensor(padList)
 	return padVar, mask, max_target_len
  
+def outputVar(l, voc):
+	return outputVarFromIndices([voc.indicesFromSentence(sentence) for sentence in l])
+ 
 def batch2TrainData(voc, pair_batch):
 	pair_batch.sort(key=lambda x: len(x[0].split(" ")), reverse=True)
 	input_batch, output_batch = [], []
@@ -145,26 +195,114 @@ def batch2TrainData(voc, pair_batch):
 	output, mask, max_target_len = outputVar(output_batch, voc)
 	return inp, lengths, output, mask, max_target_len
 
+# Same as batch2TrainData for pairs that are already token ids (ending in EOS)
+def indicesBatch2TrainData(pair_batch):
+	pair_batch.sort(key=lambda x: len(x[0]), reverse=True)
+	inp, lengths = inputVarFromIndices([pair[0] for pair in pair_batch])
+	output, mask, max_target_len = outputVarFromIndices([pair[1] for pair in pair_batch])
+	return inp, lengths, output, mask, max_target_len
+
+# Moves a training batch to device; lengths stay on the CPU for pack_padded_sequence
+def trainDataToDevice(data, device):
+	inputs, lengths, targets, mask, max_target_len = data
+	return inputs.to(device), lengths, targets.to(device), mask.to(device), max_target_len
+
+def pairLength(pair):
+	# Tokens a pair occupies in a padded batch, including EOS
+	return max(len(pair[0].split(' ')), len(pair[1].split(' '))) + 1
+
+def makeTokenBatches(indices, lengths, max_tokens, pool_size=4096):
+	# Within pools of consecutive (already shuffled) indices, sort by length so that batches hold
+	#   similar lengths, then fill each batch until batch_size * longest_length exceeds max_tokens
+	batches = []
+	for start in range(0, len(indices), pool_size):
+		pool = sorted(indices[start : start + pool_size], key=lambda ind: lengths[ind], reverse=True)
+		batch = []
+		for ind in pool:
+			# Sorted descending, so the first pair of a batch is its longest
+			if batch and (len(batch) + 1) * lengths[batch[0]] > max_tokens:
+				batches.append(batch)
+				batch = []
+			batch.append(ind)
+		if batch:
+			batches.append(batch)
+	return batches
+
 class TextDataloader():
-	def __init__(self, dataset, max_length, min_count, batch_size, shuffle=True):
-		self.voc, self.pairs = loadPrepareData(dataset, max_length, min_count)
+	def __init__(self, dataset, max_length, min_count, batch_size, shuffle=True, max_tokens=None, dedup=None, voc=None,
+		held_out=0, held_out_seed=0):
+		if voc is None:
+			self.voc, self.pairs = loadPrepareData(dataset, max_length, min_count)
+		else:
+			# Shared vocabulary built elsewhere (e.g. across several corpora); keep the pairs it covers
+			self.voc, self.pairs = voc, knownPairs(voc, filterPairs(dataset, max_length))
+		# Optional PairDeduplicator (see dataloader.dedup) applied after vocabulary trimming
+		if dedup is not None:
+			self.pairs = dedup.filter(self.voc, self.pairs)
+		# Pairs kept out of training for evaluation, drawn with their own seed so that the split is the same
+		#   on every run (and on resume) whatever the global random state
+		self.held_out_pairs = []
+		if held_out > 0:
+			held = set(random.Random(held_out_seed).sample(range(len(self.pairs)), min(held_out, len(self.pairs))))
+			self.held_out_pairs = [pair for i, pair in enumerate(self.pairs) if i in held]
+			self.pairs = [pair for i, pair in enumerate(self.pairs) if i not in held]
 		self.batch_size = batch_size
+		# Token budget per batch (padded tokens); when set it replaces the fixed batch_size
+		self.max_tokens = max_tokens
+		self.lengths = [pairLength(pair) for pair in self.pairs] if max_tokens is not None else None
+		# Optional StageProfiler recording collation time (see model.profiling)
+		self.profiler = None
+		self.rank = 0
+		self.world_size = 1
 
 		self.indices = [i for i in range(len(self.pairs))]
 		if shuffle:
 			random.shuffle(self.indices)
+		self.batches = self.makeBatches()
+		# Number of batches of the current epoch already handed out; lets a resumed run continue mid-epoch
+		self.position = 0
+
+	def makeBatches(self):
+		if self.max_tokens is None:
+			batches = [self.indices[i * self.batch_size : (i + 1) * self.batch_size]
+				for i in range(math.ceil(len(self.indices) / self.batch_size))]
+		else:
+			batches = makeTokenBatches(self.indices, self.lengths, self.max_tokens)
+		# Every rank gets the same number of batches so that all ranks run the same number of steps
+		per_rank = len(batches) // self.world_size
+		return batches[self.rank : per_rank * self.world_size : self.world_size]
 
 	def __len__(self):
-		return math.ceil(len(self.indices) / self.batch_size)
+		return len(self.batches)
 
 	def __iter__(self):
-		for i in range(self.__len__()):
-			indices = self.indices[i * self.batch_size : (i + 1) * self.batch_size]
+		for i in range(self.position, self.__len__()):
 			batch = []
-			for ind in indices:
+			for ind in self.batches[i]:
 				batch.append(self.pairs[ind])
-			trainData = batch2TrainData(self.voc, batch)
+			if self.profiler is None:
+				trainData = batch2TrainData(self.voc, batch)
+			else:
+				with self.profiler.stage('collate'):
+					trainData = batch2TrainData(self.voc, batch)
+			self.position = i + 1
 			yield trainData
+		self.position = 0
+
+	# Keep only this process's share of the (identically shuffled) batches for data-parallel training
+	def shard(self, rank, world_size):
+		self.rank = rank
+		self.world_size = world_size
+		self.batches = self.makeBatches()
+		self.position = 0
+
+	def state_dict(self):
+		return {'indices': torch.tensor(self.indices, dtype=torch.long), 'position': self.position}
+
+	def load_state_dict(self, state):
+		self.indices = state['indices'].tolist()
+		self.batches = self.makeBatches()
+		self.position = state['position']
 
 	def getVoc(self):
 		return self.voc
@@ -0,0 +1,26 @@
+import os
+
+from .synthetic import loadSyntheticDataset
+from .shards import iterPairFile
+
+# Corpus of the tools that measure a trained checkpoint (distill.py, speculate.py, factorize.py, build_index.py).
+#   Their held-out pairs have to be pairs the checkpoint never trained on, so they are not split off here but
+#   read from the file test.py --held_out wrote while training it.
+
+# Held-out pairs of a synthetic corpus, generated from the next seed
+SYNTHETIC_HELD_OUT = 1000
+
+def loadCorpus(held_out, synthetic=0, seed=0):
+	# (training pairs, held-out pairs); the training pairs are the whole corpus but the held-out pairs
+	if synthetic > 0:
+		dataset = loadSyntheticDataset(synthetic, seed=seed)
+		held_out_pairs = loadSyntheticDataset(SYNTHETIC_HELD_OUT, seed=seed + 1)
+	else:
+		if not os.path.exists(held_out):
+			raise ValueError(held_out, "does not exist; write the held-out pairs of the checkpoint with test.py --held_out")
+		# Imported lazily: the NUCC loader pulls in spaCy/GiNZA, which synthetic runs do not need
+		from .nucc import loadNUCCDataset
+		dataset = loadNUCCDataset('data/nucc')
+		held_out_pairs = list(iterPairFile(held_out))
+	excluded = set(tuple(pair) for pair in held_out_pairs)
+	return [pair for pair in dataset if tuple(pair) not in excluded], held_out_pairs
@@ -0,0 +1,119 @@
+import math
+
+import torch
+
+# Mersenne prime for the MinHash permutations; (a * x + b) stays within int64 for a, b, x < 2^31
+MINHASH_PRIME = (1 << 31) - 1
+
+def hashPositions(key, count, size):
+	# count positions in [0, size) for a 64-bit hash, by double hashing of its two 32-bit halves
+	h1, h2 = key & 0xFFFFFFFF, ((key >> 32) & 0xFFFFFFFF) | 1
+	return [(h1 + i * h2) % size for i in range(count)]
+
+# Fixed-size set of 64-bit hashes. There are no false negatives, and false positives stay around error_rate
+#   up to capacity hashes, in capacity * -ln(error_rate) / ln(2)^2 bits (1.8 bytes per hash at 0.1%)
+class BloomFilter():
+	def __init__(self, capacity, error_rate):
+		self.num_bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+		self.num_hashes = max(round(self.num_bits / capacity * math.log(2)), 1)
+		self.bits = bytearray((self.num_bits + 7) // 8)
+
+	def __contains__(self, key):
+		return all(self.bits[p >> 3] & (1 << (p & 7)) for p in hashPositions(key, self.num_hashes, self.num_bits))
+
+	def add(self, key):
+		for p in hashPositions(key, self.num_hashes, self.num_bits):
+			self.bits[p >> 3] |= 1 << (p & 7)
+
+# Fixed-size counts of 64-bit hashes in depth rows of width one-byte counters, saturating at 255. A count is
+#   never underestimated; conservative updates (only the smallest counters grow) keep overestimates rare
+#   while fewer distinct hashes than width are counted.
+class CountMinSketch():
+	def __init__(self, width, depth=4):
+		self.width = width
+		self.rows = [bytearray(width) for _ in range(depth)]
+
+	def get(self, key):
+		return min(row[p] for row, p in zip(self.rows, hashPositions(key, len(self.rows), self.width)))
+
+	def increment(self, key):
+		positions = hashPositions(key, len(self.rows), self.width)
+		count = min(row[p] for row, p in zip(self.rows, positions))
+		if count < 255:
+			for row, p in zip(self.rows, positions):
+				if row[p] == count:
+					row[p] = count + 1
+
+# Memory is fixed by capacity, the number of kept pairs the structures are sized for, whatever the corpus
+#   size: 1.8 bytes per pair for exact duplicates at the default error rate of 0.1%, 4 bytes for the response
+#   cap and 8 * 1.8 bytes for the near-duplicate bands, so 20 MB per million pairs with all three rules.
+#   The price is that about error_rate of the unique pairs are dropped as duplicates (per band for the
+#   near-duplicate rule), growing beyond that once more than capacity pairs are kept.
+class PairDeduplicator():
+	def __init__(self, near_duplicates=False, num_perm=64, bands=8, ngram=2, max_response_count=None, seed=0,
+		capacity=1000000, error_rate=0.001):
+		if num_perm % bands != 0:
+			raise ValueError(num_perm, "is not divisible by the number of bands.")
+		if max_response_count is not None and max_response_count > 255:
+			raise ValueError(max_response_count, "exceeds the response counts of at most 255.")
+		self.near_duplicates = near_duplicates
+		self.bands = bands
+		self.ngram = ngram
+		# Drop a pair once its response has already been kept this many times (e.g. backchannels)
+		self.max_response_count = max_response_count
+
+		generator = torch.Generator().manual_seed(seed)
+		self.a = torch.randint(1, MINHASH_PRIME, (num_perm, 1), generator=generator)
+		self.b = torch.randint(0, MINHASH_PRIME, (num_perm, 1), generator=generator)
+
+		# Only 64-bit hashes are kept, never the sequences themselves
+		self.seen = BloomFilter(capacity, error_rate)
+		self.response_counts = CountMinSketch(capacity) if max_response_count is not None else None
+		self.band_buckets = [BloomFilter(capacity, error_rate) for _ in range(bands)] if near_duplicates else []
+		self.removed = {'exact': 0, 'response_cap': 0, 'near': 0}
+
+	def signature(self, ids):
+		shingles = [hash(tuple(ids[i : i + self.ngram])) for i in range(max(len(ids) - self.ngram + 1, 1))]
+		x = torch.tensor(shingles, dtype=torch.long) % MINHASH_PRIME
+		return ((self.a * x + self.b) % MINHASH_PRIME).min(dim=1).values
+
+	# Returns True if the pair should be kept. Takes token ids as returned by Voc.indicesFromSentence
+	#   (ending in EOS) so that the decision is made on normalized text
+	def keep(self, input_ids, output_ids):
+		key = hash((tuple(input_ids), tuple(output_ids)))
+		if key in self.seen:
+			self.removed['exact'] += 1
+			return False
+
+		if self.max_response_count is not None:
+			response = hash(tuple(output_ids))
+			if self.response_counts.get(response) >= self.max_response_count:
+				self.removed['response_cap'] += 1
+				return False
+
+		if self.near_duplicates:
+			# LSH banding: pairs sharing all rows of any band are near-duplicates, which selects
+			#   Jaccard similarity above roughly (1 / bands) ^ (1 / rows); the shared EOS is left out
+			signature = self.signature(list(input_ids[:-1]) + [-1] + list(output_ids[:-1])).view(self.bands, -1)
+			band_keys = [hash(tuple(band.tolist())) for band in signature]
+			if any(k in bucket for k, bucket in zip(band_keys, self.band_buckets)):
+				self.removed['near'] += 1
+				return False
+			for k, bucket in zip(band_keys, self.band_buckets):
+				bucket.add(k)
+
+		self.seen.add(key)
+		if self.max_response_count is not None:
+			self.response_counts.increment(response)
+		return True
+
+	def memory(self):
+		# Bytes of the hash structures, fixed at construction
+		filters = [self.seen] + self.band_buckets
+		return sum(len(f.bits) for f in filters) + (sum(len(row) for row in self.response_counts.rows) if self.response_counts is not None else 0)
+
+	def filter(self, voc, pairs):
+		keep_pairs = [pair for pair in pairs if self.keep(voc.indicesFromSentence(pair[0]), voc.indicesFromSentence(pair[1]))]
+		print("Deduplicated from {} pairs to {} (exact: {}, response cap: {}, near-duplicate: {}) in {:.1f} MB".format(
+			len(pairs), len(keep_pairs), self.removed['exact'], self.removed['response_cap'], self.removed['near'], self.memory() / 1024 / 1024))
+		return keep_pairs
@@ -0,0 +1,154 @@
+import random
+
+from .common import Voc, TextDataloader, filterPairs
+
+# Mixes several named corpora with sampling weights. Each source keeps its own TextDataloader
+#   (and cursor) over a shared vocabulary; every batch is drawn from one source chosen by weight,
+#   so the mixture no longer depends on the raw corpus sizes. The vocabulary keeps the words that occur
+#   min_count times over all sources together.
+class MixedTextDataloader(TextDataloader):
+	def __init__(self, sources, max_length, min_count, batch_size, shuffle=True, max_tokens=None, dedup=None, seed=0, held_out=0):
+		self.max_length = max_length
+		self.min_count = min_count
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.max_tokens = max_tokens
+		self.dedup = dedup
+		# Pairs held out of each source for evaluation, so held_out times the number of sources in total
+		self.held_out = held_out
+		self.profiler = None
+		self.rank = 0
+		self.world_size = 1
+		self.position = 0
+
+		self.voc = Voc()
+		self.voc.trimmed = True
+		# Word counts over all sources, including the words still below min_count
+		self.word_counts = {}
+		self.loaders = {}
+		self.weights = {}
+		self.stats = {}
+		# Name of the source the last yielded batch came from
+		self.current = None
+		self.rng = random.Random(seed)
+		self.iterators = {}
+
+		# sources: {name: (dataset, weight)}, where dataset is a list of pairs or a callable returning one.
+		#   All of them are counted before the vocabulary is built, so word ids do not depend on their order.
+		datasets = {}
+		for name, (dataset, weight) in sources.items():
+			datasets[name] = (self.loadPairs(dataset), weight)
+			print("Source {}: {} pairs".format(name, len(datasets[name][0])))
+		self.extendVoc(pair for pairs, _ in datasets.values() for pair in pairs)
+		print("Counted words of {} sources: {}".format(len(datasets), self.voc.num_words))
+		for name, (pairs, weight) in datasets.items():
+			self.addLoader(name, pairs, weight)
+
+	def loadPairs(self, dataset):
+		return filterPairs(dataset() if callable(dataset) else dataset, self.max_length)
+
+	def extendVoc(self, pairs):
+		# Count the words of new pairs and add those that now occur min_count times over all sources, after the
+		#   existing ids, by decreasing count and then alphabetically
+		for pair in pairs:
+			for sentence in pair:
+				for word in sentence.split(' '):
+					self.word_counts[word] = self.word_counts.get(word, 0) + 1
+		new_words = sorted((word for word, count in self.word_counts.items() if count >= self.min_count and word not in self.voc.word2index),
+			key=lambda word: (-self.word_counts[word], word))
+		for word in new_words:
+			self.voc.addWord(word)
+		for word in self.voc.word2count:
+			self.voc.word2count[word] = self.word_counts[word]
+		return len(new_words)
+
+	def addSource(self, name, dataset, weight):
+		# Loaded only here, so a new corpus can be added without re-materializing the existing ones; the existing
+		#   word ids are kept and pairs of earlier sources are not revisited
+		pairs = self.loadPairs(dataset)
+		added = self.extendVoc(pairs)
+		print("Source {}: {} pairs, {} new words, {} words in total".format(name, len(pairs), added, self.voc.num_words))
+		self.addLoader(name, pairs, weight)
+
+	def addLoader(self, name, pairs, weight):
+		loader = TextDataloader(pairs, self.max_length, self.min_count, self.batch_size, self.shuffle,
+			self.max_tokens, self.dedup, voc=self.voc, held_out=self.held_out)
+		loader.profiler = self.profiler
+		loader.shard(self.rank, self.world_size)
+		self.loaders[name] = loader
+		self.weights[name] = weight
+		self.stats[name] = {'batches': 0, 'tokens': 0, 'loss': 0.0, 'seconds': 0.0}
+		self.iterators.pop(name, None)
+
+	@property
+	def held_out_pairs(self):
+		return [pair for loader in self.loaders.values() for pair in loader.held_out_pairs]
+
+	def __len__(self):
+		# One pass over the mixture draws as many batches as all sources hold together
+		return sum(len(loader) for loader in self.loaders.values())
+
+	def nextBatch(self, name):
+		if name not in self.iterators:
+			self.iterators[name] = iter(self.loaders[name])
+		try:
+			return next(self.iterators[name])
+		except StopIteration:
+			# Exhausted sources start over, so small high-weight corpora are repeated
+			self.iterators[name] = iter(self.loaders[name])
+			return next(self.iterators[name])
+
+	def __iter__(self):
+		names = list(self.loaders.keys())
+		weights = [self.weights[name] for name in names]
+		for i in range(self.position, self.__len__()):
+			self.current = self.rng.choices(names, weights=weights)[0]
+			self.loaders[self.current].profiler = self.profiler
+			trainData = self.nextBatch(self.current)
+			self.position = i + 1
+			yield trainData
+		self.position = 0
+
+	# Called by the training loop after each step to attribute loss and throughput to the current source
+	def record(self, loss, tokens, seconds):
+		stats = self.stats[self.current]
+		stats['batches'] += 1
+		stats['tokens'] += tokens
+		stats['loss'] += loss * tokens
+		stats['seconds'] += seconds
+
+	def report(self):
+		lines = []
+		for name, stats in self.stats.items():
+			if stats['batches'] == 0:
+				continue
+			lines.append('%-16s %8d batches %10d tokens %10.1f tokens/sec loss %f' % (
+				name, stats['batches'], stats['tokens'],
+				stats['tokens'] / stats['seconds'] if stats['seconds'] > 0 else 0.0,
+				stats['loss'] / stats['tokens'] if stats['tokens'] > 0 else 0.0))
+			self.stats[name] = {'batches': 0, 'tokens': 0, 'loss': 0.0, 'seconds': 0.0}
+		return '\n'.join(lines)
+
+	def shard(self, rank, world_size):
+		# The source sequence comes from the same seeded rng on every rank; each source is sharded by batch
+		self.rank = rank
+		self.world_size = world_size
+		for loader in self.loaders.values():
+			loader.shard(rank, world_size)
+		self.iterators = {}
+		self.position = 0
+
+	def state_dict(self):
+		return {
+			'position': self.position,
+			'rng': self.rng.getstate(),
+			'sources': {name: loader.state_dict() for name, loader in self.loaders.items()},
+		}
+
+	def load_state_dict(self, state):
+		self.position = state['position']
+		self.rng.setstate(state['rng'])
+		for name, loader_state in state['sources'].items():
+			if name in self.loaders:
+				self.loaders[name].load_state_dict(loader_state)
+		self.iterators = {}
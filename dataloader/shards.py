@@ -0,0 +1,173 @@
+import os
+import math
+import random
+
+import torch
+
+from .common import Voc, TextDataloader, filterPair, indicesBatch2TrainData
+
+# On-disk corpus for datasets larger than RAM. A directory holds index.pt (vocabulary, shard
+#   names and sizes) and shard_XXXXX.pt files, each with the concatenated int32 token ids of its
+#   inputs and outputs plus int64 offsets into them. Shards are memory-mapped when read.
+
+def iterPairFile(path):
+	# Tab-separated "input<TAB>output" lines, as cached by loadNUCCDataset
+	with open(path, 'r', encoding='utf-8') as f:
+		for line in f:
+			pair = line.rstrip('\n').split('\t')
+			if len(pair) == 2:
+				yield pair
+
+def writePairFile(path, pairs):
+	with open(path, 'w', encoding='utf-8') as f:
+		for pair in pairs:
+			f.write(pair[0] + '\t' + pair[1] + '\n')
+
+def writeShard(path, pairs):
+	shard = {}
+	for side, name in enumerate(['input', 'output']):
+		offsets = [0]
+		for pair in pairs:
+			offsets.append(offsets[-1] + len(pair[side]))
+		shard[name + '_ids'] = torch.tensor([token for pair in pairs for token in pair[side]], dtype=torch.int32)
+		shard[name + '_offsets'] = torch.tensor(offsets, dtype=torch.long)
+	torch.save(shard, path)
+
+def buildShards(pairs_fn, directory, max_length, min_count, shard_size=1000000, dedup=None):
+	# pairs_fn() returns a fresh iterator over [input, output] sentence pairs; it is consumed twice,
+	#   once to count words and once to write token ids, so only one shard is ever held in memory
+	os.makedirs(directory, exist_ok=True)
+
+	voc = Voc()
+	for pair in pairs_fn():
+		if filterPair(pair, max_length):
+			voc.addSentence(pair[0])
+			voc.addSentence(pair[1])
+	print("Counted words:", voc.num_words)
+	voc.trim(min_count)
+
+	shards = []
+	buffer = []
+	def flush():
+		name = 'shard_%05d.pt' % (len(shards))
+		writeShard(os.path.join(directory, name), buffer)
+		shards.append({'name': name, 'pairs': len(buffer)})
+		buffer.clear()
+
+	total, kept = 0, 0
+	for pair in pairs_fn():
+		total += 1
+		if not filterPair(pair, max_length):
+			continue
+		try:
+			input_ids, output_ids = voc.indicesFromSentence(pair[0]), voc.indicesFromSentence(pair[1])
+		except KeyError:
+			# Pair contains a trimmed word
+			continue
+		if dedup is not None and not dedup.keep(input_ids, output_ids):
+			continue
+		buffer.append((input_ids, output_ids))
+		kept += 1
+		if len(buffer) >= shard_size:
+			flush()
+	if buffer:
+		flush()
+
+	torch.save({'voc': voc.state_dict(), 'shards': shards}, os.path.join(directory, 'index.pt'))
+	print("Wrote {} of {} pairs to {} shards".format(kept, total, len(shards)))
+	return voc
+
+class ShardedTextDataloader(TextDataloader):
+	def __init__(self, directory, batch_size, buffer_size=100000, shuffle=True, seed=0):
+		index = torch.load(os.path.join(directory, 'index.pt'), weights_only=True)
+		self.voc = Voc()
+		self.voc.load_state_dict(index['voc'])
+		self.directory = directory
+		self.shards = index['shards']
+		self.num_pairs = sum(shard['pairs'] for shard in self.shards)
+		self.batch_size = batch_size
+		# Pairs held in memory for shuffling across shard boundaries
+		self.buffer_size = buffer_size
+		self.shuffle = shuffle
+		self.seed = seed
+		self.profiler = None
+		self.rank = 0
+		self.world_size = 1
+		self.epoch = 0
+		self.position = 0
+
+	def __len__(self):
+		return math.ceil(self.num_pairs / self.batch_size) // self.world_size
+
+	def iterShard(self, shard):
+		data = torch.load(os.path.join(self.directory, shard['name']), mmap=True, weights_only=True)
+		input_ids, input_offsets = data['input_ids'], data['input_offsets'].tolist()
+		output_ids, output_offsets = data['output_ids'], data['output_offsets'].tolist()
+		for i in range(shard['pairs']):
+			yield (input_ids[input_offsets[i] : input_offsets[i + 1]].tolist(),
+				output_ids[output_offsets[i] : output_offsets[i + 1]].tolist())
+
+	def iterPairs(self, rng):
+		shards = list(self.shards)
+		if not self.shuffle:
+			for shard in shards:
+				yield from self.iterShard(shard)
+			return
+		rng.shuffle(shards)
+		# Shuffle buffer: once full, every incoming pair replaces a randomly chosen buffered one
+		buffer = []
+		for shard in shards:
+			for pair in self.iterShard(shard):
+				if len(buffer) < self.buffer_size:
+					buffer.append(pair)
+					continue
+				i = rng.randrange(len(buffer))
+				yield buffer[i]
+				buffer[i] = pair
+		rng.shuffle(buffer)
+		yield from buffer
+
+	def iterBatches(self):
+		# Seeded per epoch, so the batch order can be regenerated when resuming mid-epoch
+		rng = random.Random(self.seed * 1000003 + self.epoch)
+		batch = []
+		for pair in self.iterPairs(rng):
+			batch.append(pair)
+			if len(batch) == self.batch_size:
+				yield batch
+				batch = []
+		if batch:
+			yield batch
+
+	def __iter__(self):
+		num_batches = self.__len__()
+		i = 0
+		for j, batch in enumerate(self.iterBatches()):
+			# Data-parallel ranks take every world_size-th batch of the same stream
+			if j % self.world_size != self.rank:
+				continue
+			if i >= num_batches:
+				break
+			if i >= self.position:
+				if self.profiler is None:
+					trainData = indicesBatch2TrainData(batch)
+				else:
+					with self.profiler.stage('collate'):
+						trainData = indicesBatch2TrainData(batch)
+				self.position = i + 1
+				yield trainData
+			i += 1
+		self.position = 0
+		self.epoch += 1
+
+	def shard(self, rank, world_size):
+		self.rank = rank
+		self.world_size = world_size
+		self.position = 0
+
+	def state_dict(self):
+		return {'epoch': self.epoch, 'position': self.position}
+
+	def load_state_dict(self, state):
+		self.epoch = state['epoch']
+		self.position = state['position']
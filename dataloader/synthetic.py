@@ -0,0 +1,31 @@
+import random
+import itertools
+
+# Synthetic dialog corpus for benchmarking without downloading a real dataset.
+#   Words are drawn from a Zipf-like distribution so that min_count trimming
+#   keeps a realistic fraction of the vocabulary.
+def sampleLength(rng, min_length, max_length, length_dist):
+	if length_dist == 'uniform':
+		return rng.randint(min_length, max_length)
+	elif length_dist == 'geometric':
+		# Mostly short utterances with a long tail, like real chat logs
+		length = min_length
+		while length < max_length and rng.random() < 0.75:
+			length += 1
+		return length
+	raise ValueError(length_dist, "is not an appropriate length distribution.")
+
+def loadSyntheticDataset(num_pairs, vocab_size=5000, min_length=1, max_length=20, length_dist='geometric', seed=0):
+	rng = random.Random(seed)
+	words = ['w%d' % (i) for i in range(vocab_size)]
+	cum_weights = list(itertools.accumulate(1.0 / (i + 1) for i in range(vocab_size)))
+
+	def sentence():
+		length = sampleLength(rng, min_length, max_length, length_dist)
+		return ' '.join(rng.choices(words, cum_weights=cum_weights, k=length))
+
+	pairs = []
+	for _ in range(num_pairs):
+		pairs.append([sentence(), sentence()])
+
+	return pairs
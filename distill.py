@@ -0,0 +1,133 @@
+import json
+import time
+import random
+import argparse
+
+import torch
+
+from dataloader.corpus import loadCorpus
+from dataloader.common import TextDataloader, SOS_token, trainDataToDevice
+from model.seq2seq import Seq2SeqModel
+from model.checkpoint import makeCheckpoint, saveCheckpoint
+from inference import loadInferenceModel
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-t', '--teacher', type=str, required=True, help='trained checkpoint with an embedded vocabulary')
+parser.add_argument('--hidden_size', type=int, default=256)
+parser.add_argument('--encoder_n_layers', type=int, default=1)
+parser.add_argument('--decoder_n_layers', type=int, default=1)
+parser.add_argument('--attn_model', type=str, default='dot', choices=['dot', 'general', 'concat'])
+parser.add_argument('--alpha', type=float, default=0.5, help='weight of the teacher KL term; 0 trains on the targets only')
+parser.add_argument('--temperature', type=float, default=1.0, help='softening of the teacher and student distributions')
+parser.add_argument('-i', '--iteration', type=int, default=10)
+parser.add_argument('-b', '--batch_size', type=int, default=64)
+parser.add_argument('--max_tokens', type=int, help='build batches by padded token budget instead of a fixed pair count')
+parser.add_argument('--steps', type=int, default=0, help='limit the steps per epoch (0: full epochs)')
+parser.add_argument('--held_out', type=str, default='weights/held_out.tsv', help='pairs the teacher never trained on (test.py --held_out), kept out of training to measure the loss gap on')
+parser.add_argument('--decode_length', type=int, default=10)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--synthetic', type=int, default=0, help='distill on a synthetic corpus of this many pairs instead of NUCC, held out against pairs of the next seed')
+parser.add_argument('--save', type=str, default='weights/student.pth')
+parser.add_argument('-o', '--output', type=str, default='distillation.json')
+args = parser.parse_args()
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def numParameters(model):
+	return sum(param.numel() for param in model.parameters())
+
+def heldOutLoss(model, batches):
+	# Teacher-forced per-token NLL of the targets
+	model.eval()
+	loss_sum, n_totals = 0.0, 0
+	with torch.no_grad():
+		for data in batches:
+			_, print_loss, n = model(*data, teacher_forcing_ratio=1.0)
+			loss_sum += print_loss
+			n_totals += n
+	return loss_sum / n_totals
+
+def decodeHeldOut(model, batches):
+	# Fixed-length greedy decoding of the held-out inputs; returns seconds per decoded token and the tokens
+	model.eval()
+	outputs = []
+	elapsed, steps = 0.0, 0
+	with torch.no_grad():
+		for inputs, lengths, _, _, _ in batches:
+			if device.type == 'cuda':
+				torch.cuda.synchronize()
+			start = time.perf_counter()
+			tokens, _, _ = model.evaluate(inputs, lengths, args.decode_length, EOS_token=None)
+			if device.type == 'cuda':
+				torch.cuda.synchronize()
+			elapsed += time.perf_counter() - start
+			steps += args.decode_length
+			outputs.append(tokens)
+	return elapsed / steps, outputs
+
+def main():
+	random.seed(args.seed)
+	torch.manual_seed(args.seed)
+
+	teacher, voc = loadInferenceModel(args.teacher, device)
+
+	# The student shares the teacher's vocabulary, so pairs with words the teacher never saw are dropped
+	train_pairs, held_out_pairs = loadCorpus(args.held_out, args.synthetic, args.seed)
+	dataloader = TextDataloader(train_pairs, max_length=32, min_count=3, batch_size=args.batch_size, shuffle=True,
+		max_tokens=args.max_tokens, voc=voc)
+	held_out = [trainDataToDevice(data, device) for data in TextDataloader(held_out_pairs, max_length=32, min_count=3,
+		batch_size=args.batch_size, shuffle=False, voc=voc)]
+
+	student = Seq2SeqModel(device, SOS_token, voc.num_words, attn_model=args.attn_model, hidden_size=args.hidden_size,
+		encoder_n_layers=args.encoder_n_layers, decoder_n_layers=args.decoder_n_layers).to(device)
+	student.distillFrom(teacher, args.alpha, args.temperature)
+
+	start = time.perf_counter()
+	for epoch in range(args.iteration):
+		student.train()
+		for i, data in enumerate(dataloader):
+			if args.steps > 0 and i >= args.steps:
+				break
+			print_loss = student.optimize(*trainDataToDevice(data, device))
+			if i % 10 == 0:
+				print('[Epoch: %d, %d/%d] loss: %f' % (epoch, i, len(dataloader), print_loss))
+		print('[Epoch: %d] held-out loss: %f' % (epoch, heldOutLoss(student, held_out)))
+	train_time = time.perf_counter() - start
+
+	saveCheckpoint(makeCheckpoint(student, voc), args.save)
+
+	teacher_loss, student_loss = heldOutLoss(teacher, held_out), heldOutLoss(student, held_out)
+	teacher_time, teacher_tokens = decodeHeldOut(teacher, held_out)
+	student_time, student_tokens = decodeHeldOut(student, held_out)
+	matches = sum((s == t).sum().item() for s, t in zip(student_tokens, teacher_tokens))
+	total = sum(tokens.numel() for tokens in teacher_tokens)
+
+	report = {
+		'config': vars(args),
+		'held_out_pairs': sum(data[0].size(1) for data in held_out),
+		'train_seconds': train_time,
+		'teacher': {
+			'config': teacher.config,
+			'parameters': numParameters(teacher),
+			'held_out_loss': teacher_loss,
+			'ms_per_token': teacher_time * 1000,
+		},
+		'student': {
+			'config': student.config,
+			'parameters': numParameters(student),
+			'held_out_loss': student_loss,
+			'ms_per_token': student_time * 1000,
+		},
+		'speedup': teacher_time / student_time,
+		'loss_gap': student_loss - teacher_loss,
+		'token_agreement': matches / total,
+	}
+	print('teacher: %d parameters, %.3f ms/token, held-out loss %.4f' % (report['teacher']['parameters'], teacher_time * 1000, teacher_loss))
+	print('student: %d parameters, %.3f ms/token, held-out loss %.4f' % (report['student']['parameters'], student_time * 1000, student_loss))
+	print('speedup %.2fx, loss gap %+.4f, %.1f%% greedy tokens identical' % (report['speedup'], report['loss_gap'], 100 * report['token_agreement']))
+
+	with open(args.output, 'w') as f:
+		json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,77 @@
+import os
+import json
+import time
+import argparse
+
+import torch
+
+from dataloader.common import knownPairs, indicesBatch2TrainData, EOS_token, PAD_token
+from dataloader.shards import iterPairFile
+from model.metrics import corpusMetrics
+from inference import loadInferenceCheckpoint, buildInferenceModel, evaluateBatch
+
+# Evaluates a checkpoint on held-out pairs (written by test.py --held_out): perplexity from batched
+#   teacher-forced scoring, and BLEU / distinct-n of batched greedy replies computed in a worker pool.
+#   One JSON line per checkpoint is appended to the results file, so that test.py --async_eval can
+#   run this in the background for every saved checkpoint.
+
+def perplexity(model, voc, pairs, batch_size):
+	loss_sum, n_totals = 0.0, 0
+	with torch.no_grad():
+		for i in range(0, len(pairs), batch_size):
+			batch = [(voc.indicesFromSentence(pair[0]), voc.indicesFromSentence(pair[1])) for pair in pairs[i : i + batch_size]]
+			inputs, lengths, targets, mask, max_target_len = indicesBatch2TrainData(batch)
+			_, print_loss, n = model(inputs.to(model.device), lengths, targets.to(model.device), mask.to(model.device),
+				max_target_len, teacher_forcing_ratio=1.0)
+			loss_sum += print_loss
+			n_totals += n
+	return loss_sum / n_totals
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-l', '--load', type=str, required=True, help='checkpoint with an embedded vocabulary')
+	parser.add_argument('--pairs', type=str, default='weights/held_out.tsv', help='tab-separated held-out pairs')
+	parser.add_argument('-b', '--batch_size', type=int, default=64)
+	parser.add_argument('--max_length', type=int, default=10)
+	parser.add_argument('--workers', type=int, default=4, help='processes computing BLEU and distinct-n')
+	parser.add_argument('--threads', type=int, help='intra-op threads, e.g. to leave cores to a running training')
+	parser.add_argument('--results', type=str, default='weights/eval.jsonl')
+	args = parser.parse_args()
+
+	if args.threads:
+		torch.set_num_threads(args.threads)
+	device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+	start = time.perf_counter()
+	checkpoint = loadInferenceCheckpoint(args.load, device)
+	model, voc = buildInferenceModel(checkpoint, device)
+	# Sorted by input length so that batches need little padding
+	pairs = sorted(knownPairs(voc, list(iterPairFile(args.pairs))), key=lambda pair: len(pair[0].split(' ')), reverse=True)
+
+	loss = perplexity(model, voc, pairs, args.batch_size)
+
+	hypotheses = []
+	for i in range(0, len(pairs), args.batch_size):
+		replies = evaluateBatch(model, voc, [pair[0] for pair in pairs[i : i + args.batch_size]], args.max_length)
+		hypotheses.extend([word for word in reply if word not in [voc.index2word[EOS_token], voc.index2word[PAD_token]]] for reply in replies)
+	metrics = corpusMetrics(hypotheses, [pair[1].split(' ') for pair in pairs], args.workers)
+
+	result = {
+		'checkpoint': args.load,
+		'epoch': checkpoint.get('epoch'),
+		'step': checkpoint.get('step'),
+		'pairs': len(pairs),
+		'loss': loss,
+		'perplexity': float(torch.tensor(loss).exp()),
+	}
+	result.update(metrics)
+	result['seconds'] = time.perf_counter() - start
+	print('%s: perplexity %.2f, BLEU %.4f, distinct-1 %.4f, distinct-2 %.4f (%d pairs, %.1fs)' % (args.load, result['perplexity'],
+		result['bleu'], result['distinct_1'], result['distinct_2'], len(pairs), result['seconds']))
+
+	os.makedirs(os.path.dirname(args.results) or '.', exist_ok=True)
+	with open(args.results, 'a') as f:
+		f.write(json.dumps(result) + '\n')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,149 @@
+import sys
+import json
+import time
+import random
+import argparse
+
+import torch
+
+from dataloader.corpus import loadCorpus
+from dataloader.common import TextDataloader, SOS_token, trainDataToDevice
+from model.seq2seq import Seq2SeqModel
+from model.checkpoint import convertOutputProjection, makeCheckpoint, saveCheckpoint
+from inference import loadInferenceModel
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-l', '--load', type=str, required=True, help='checkpoint with an untied full-rank output projection and an embedded vocabulary')
+parser.add_argument('-o', '--output', type=str, required=True, help='converted checkpoint')
+parser.add_argument('--tie_embedding', action='store_true', help='use the shared embedding as the output projection')
+parser.add_argument('--output_rank', type=str, default='0', help='factorize the output projection through this many features; of several comma-separated ranks, the most accurate one that decodes faster than the full projection is kept')
+parser.add_argument('--steps', type=int, default=0, help='fine-tune the converted model for this many batches')
+parser.add_argument('-b', '--batch_size', type=int, default=64)
+parser.add_argument('--held_out', type=str, default='weights/held_out.tsv', help='pairs the checkpoint never trained on (test.py --held_out), kept out of fine-tuning to measure the loss on')
+parser.add_argument('--decode_length', type=int, default=10)
+parser.add_argument('--rounds', type=int, default=5, help='interleaved timing rounds of all models, of which the median is reported')
+parser.add_argument('--min_speedup', type=float, default=1.05, help='decoding speedup over the full projection a low rank needs to be kept')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--synthetic', type=int, default=0, help='use a synthetic corpus of this many pairs instead of NUCC, held out against pairs of the next seed')
+parser.add_argument('--report', type=str, default='factorize.json')
+args = parser.parse_args()
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def measure(model, held_out):
+	# Parameter count and teacher-forced per-token loss
+	model.eval()
+	loss_sum, n_totals = 0.0, 0
+	with torch.no_grad():
+		for data in held_out:
+			_, print_loss, n = model(*data, teacher_forcing_ratio=1.0)
+			loss_sum += print_loss
+			n_totals += n
+	return {
+		'parameters': sum(param.numel() for param in model.parameters()),
+		'output_parameters': sum(param.numel() for name, param in model.named_parameters() if name.startswith('decoder.out.') or 'embedding' in name),
+		'held_out_loss': loss_sum / n_totals,
+	}
+
+def median(values):
+	return sorted(values)[len(values) // 2]
+
+def timeDecoding(models, held_out):
+	# Fixed-length greedy decoding times per token of every model in every round. The models take turns
+	#   within each round, so that load changes of the machine affect all of them alike.
+	times = [[] for _ in models]
+	with torch.no_grad():
+		for model in models:
+			model.eval()
+			model.evaluate(held_out[0][0], held_out[0][1], args.decode_length, EOS_token=None)
+		for _ in range(args.rounds):
+			for model, model_times in zip(models, times):
+				start = time.perf_counter()
+				for inputs, lengths, _, _, _ in held_out:
+					model.evaluate(inputs, lengths, args.decode_length, EOS_token=None)
+				model_times.append((time.perf_counter() - start) / (len(held_out) * args.decode_length) * 1000)
+	return times
+
+def main():
+	random.seed(args.seed)
+	torch.manual_seed(args.seed)
+
+	original, voc = loadInferenceModel(args.load, device)
+	hidden_size, num_words = original.decoder.hidden_size, original.decoder.output_size
+
+	# A rank only saves parameters and multiply-adds below hidden_size * num_words / (hidden_size + num_words)
+	ranks = []
+	for rank in [int(rank) for rank in args.output_rank.split(',')]:
+		if rank > 0 and rank * (hidden_size + num_words) >= hidden_size * num_words:
+			print('rank %d skipped: %d factor parameters are no fewer than the %d of the full projection' % (rank,
+				rank * (hidden_size + num_words), hidden_size * num_words))
+		else:
+			ranks.append(rank)
+	if not ranks:
+		sys.exit('no rank below %d to convert to' % (hidden_size * num_words // (hidden_size + num_words) + 1))
+
+	train_pairs, held_out_pairs = loadCorpus(args.held_out, args.synthetic, args.seed)
+	held_out = [trainDataToDevice(data, device) for data in TextDataloader(held_out_pairs, max_length=32, min_count=3,
+		batch_size=args.batch_size, shuffle=False, voc=voc)]
+
+	candidates = []
+	for rank in ranks:
+		converted = convertOutputProjection(args.load, None, args.tie_embedding, rank)
+		model = Seq2SeqModel(device, SOS_token, **converted['config']).to(device)
+		model.load_state_dict(converted['model'])
+		candidates.append((rank, converted, model))
+
+	report = {'config': vars(args), 'original': measure(original, held_out), 'candidates': {}}
+	times = timeDecoding([original] + [model for _, _, model in candidates], held_out)
+	report['original']['ms_per_token'] = median(times[0])
+	for (rank, _, model), model_times in zip(candidates, times[1:]):
+		r = measure(model, held_out)
+		r['ms_per_token'] = median(model_times)
+		# Median of the speedups within a round, against the original timed right before
+		r['speedup'] = median([original_time / model_time for original_time, model_time in zip(times[0], model_times)])
+		r['faster'] = r['speedup'] >= args.min_speedup
+		report['candidates'][str(rank)] = r
+
+	# Fewer parameters alone are no gain: a low-rank projection is kept only if it also decodes faster
+	faster = [candidate for candidate in candidates if candidate[0] == 0 or report['candidates'][str(candidate[0])]['faster']]
+	if not faster:
+		report['converted'] = None
+	else:
+		rank, converted, model = min(faster, key=lambda candidate: report['candidates'][str(candidate[0])]['held_out_loss'])
+		saveCheckpoint(converted, args.output)
+		report['converted'] = report['candidates'][str(rank)]
+		report['converted_rank'] = rank
+
+	if args.steps > 0 and faster:
+		dataloader = TextDataloader(train_pairs, max_length=32, min_count=3, batch_size=args.batch_size, shuffle=True, voc=voc)
+		model.train()
+		step = 0
+		while step < args.steps:
+			for data in dataloader:
+				print_loss = model.optimize(*trainDataToDevice(data, device))
+				if step % 10 == 0:
+					print('[Step: %d] loss: %f' % (step, print_loss))
+				step += 1
+				if step >= args.steps:
+					break
+		saveCheckpoint(makeCheckpoint(model, voc), args.output)
+		report['fine_tuned'] = measure(model, held_out)
+
+	r = report['original']
+	print('%-10s %10d parameters (%d embedding/output), %.3f ms/token, held-out loss %.4f' % ('original', r['parameters'],
+		r['output_parameters'], r['ms_per_token'], r['held_out_loss']))
+	for rank, r in report['candidates'].items():
+		print('%-10s %10d parameters (%d embedding/output), %.3f ms/token (%.3fx), held-out loss %.4f%s' % ('rank ' + rank, r['parameters'],
+			r['output_parameters'], r['ms_per_token'], r['speedup'], r['held_out_loss'],
+			'' if r['faster'] else ', NOT faster than the full projection (needs %.2fx)' % (args.min_speedup)))
+	if 'fine_tuned' in report:
+		print('%-10s held-out loss %.4f' % ('fine-tuned', report['fine_tuned']['held_out_loss']))
+
+	with open(args.report, 'w') as f:
+		json.dump(report, f, indent=2)
+	if report['converted'] is None:
+		sys.exit('no rank decodes at least %.2fx faster than the full projection; nothing written to %s' % (args.min_speedup, args.output))
+	print('kept rank %d in %s' % (report['converted_rank'], args.output))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,161 @@
+import time
+start_time = time.perf_counter()
+
+import sys
+import argparse
+
+import torch
+
+from dataloader.common import Voc, SOS_token
+from model.seq2seq import Seq2SeqModel
+from model.shortlist import Shortlist, DEFAULT_FALLBACK_THRESHOLD
+from model.sampling import Sampler
+from model.speculative import SpeculativeDecoder
+from model.retrieval import RetrievalIndex, RetrievalResponder
+
+def loadInferenceCheckpoint(path, device):
+	# On CPU the file is memory-mapped, so optimizer state and other unused entries are never read
+	return torch.load(path, map_location=device, mmap=(device.type == 'cpu'), weights_only=True)
+
+def buildInferenceModel(checkpoint, device):
+	voc = Voc()
+	voc.load_state_dict(checkpoint['voc'])
+	# Built on the meta device, so no parameters are allocated or randomly initialized, and then given the
+	#   loaded tensors (memory-mapped on CPU) directly instead of copies of them
+	with torch.device('meta'):
+		model = Seq2SeqModel(device, SOS_token, **checkpoint['config'], inference=True)
+	model.load_state_dict(checkpoint['model'], assign=True)
+	model.eval()
+	return model, voc
+
+def loadInferenceModel(path, device):
+	checkpoint = loadInferenceCheckpoint(path, device)
+	if 'voc' not in checkpoint or 'config' not in checkpoint:
+		raise ValueError(path, "has no embedded vocabulary; convert it with model.checkpoint.exportInference")
+	return buildInferenceModel(checkpoint, device)
+
+# sampling: optional keyword arguments of model.sampling.Sampler (temperature, top_k, top_p, seeds)
+# retrieval: optional model.retrieval.RetrievalResponder answering close matches of training inputs
+def evaluate(model, voc, sentence, max_length=10, shortlist=None, sampling=None, retrieval=None):
+	indexes_batch = [voc.indicesFromSentence(sentence)]
+	lengths = torch.tensor([len(indexes) for indexes in indexes_batch])
+	input_batch = torch.LongTensor(indexes_batch).transpose(0, 1)
+	input_batch = input_batch.to(model.device)
+	if retrieval is not None:
+		response = retrieval.respond(input_batch, lengths)[0]
+		if response is not None:
+			return response.split(' ')
+	sampler = Sampler(1, device=model.device, **sampling) if sampling is not None else None
+	with torch.no_grad():
+		tokens, scores, reply_lengths = model.evaluate(input_batch, lengths, max_length, shortlist, sampler)
+	decoded_words = [voc.index2word[token] for token in tokens[:reply_lengths[0], 0].tolist()]
+	return decoded_words 
+ 
+# Replies to several sentences with one batched decode; sentences with unknown words get None
+def evaluateBatch(model, voc, sentences, max_length=10):
+	replies = [None] * len(sentences)
+	known = []
+	for i, sentence in enumerate(sentences):
+		try:
+			known.append((i, voc.indicesFromSentence(sentence)))
+		except KeyError:
+			pass
+	if not known:
+		return replies
+	# pack_padded_sequence in the encoder needs descending input lengths
+	known.sort(key=lambda x: len(x[1]), reverse=True)
+	lengths = torch.tensor([len(indexes) for _, indexes in known])
+	input_batch = torch.nn.utils.rnn.pad_sequence([torch.LongTensor(indexes) for _, indexes in known]).to(model.device)
+	with torch.no_grad():
+		tokens, scores, reply_lengths = model.evaluate(input_batch, lengths, max_length)
+	tokens, reply_lengths = tokens.t().tolist(), reply_lengths.tolist()
+	for row, (i, _) in enumerate(known):
+		replies[i] = [voc.index2word[token] for token in tokens[row][:reply_lengths[row]]]
+	return replies
+
+def evaluateInput(model, voc, normalize, shortlist=None, sampling=None, retrieval=None):
+	input_sentence = ''
+	while(1):
+		try:
+			input_sentence = input('> ')
+			if input_sentence == 'q' or input_sentence == 'quit': break
+			input_sentence = normalize(input_sentence)
+			output_words = evaluate(model, voc, input_sentence, shortlist=shortlist, sampling=sampling, retrieval=retrieval)
+			output_words[:] = [x for x in output_words if not (x == 'EOS' or x == 'PAD')]
+			print('Bot:', ' '.join(output_words))
+ 
+		except KeyError:
+			print("Error: Encountered unknown word.")
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-l', '--load', type=str, required=True)
+	parser.add_argument('--english', action='store_true', help='normalize input like the Cornell/ConvAI2 loaders instead of with GiNZA')
+	parser.add_argument('--shortlist', type=str, help='decode over a shortlist built by test.py --shortlist')
+	parser.add_argument('--shortlist_threshold', type=float, default=DEFAULT_FALLBACK_THRESHOLD, help='rescore over the full vocabulary when the best shortlisted word is less likely than this (0: never)')
+	parser.add_argument('--temperature', type=float, default=0.0, help='sample replies at this temperature (0: greedy)')
+	parser.add_argument('--top_k', type=int, default=0)
+	parser.add_argument('--top_p', type=float, default=1.0)
+	parser.add_argument('--seed', type=int, help='seed sampling so that every input gets a reproducible reply')
+	parser.add_argument('--draft', type=str, help='decode speculatively with this small checkpoint sharing the vocabulary (greedy only; speculate.py reports whether it pays off)')
+	parser.add_argument('--draft_k', type=int, default=4, help='tokens drafted per verification pass')
+	parser.add_argument('--retrieval', type=str, help='answer from an index built by build_index.py with the same checkpoint when the input is close enough')
+	parser.add_argument('--retrieval_threshold', type=float, default=0.95, help='cosine similarity above which the indexed response is used')
+	parser.add_argument('--retrieval_method', type=str, default='ivf', choices=['exact', 'ivf', 'lsh'])
+	parser.add_argument('--n_probe', type=int, default=8, help='IVF lists searched per query')
+	parser.add_argument('--n_candidates', type=int, default=1000, help='LSH candidates reranked per query')
+	parser.add_argument('--compile', action='store_true', help='run the encoder and decoder steps through torch.compile, compiled at startup')
+	parser.add_argument('--compile_cache', type=str, default='weights/compile_cache', help='directory of compiled kernels reused across runs with --compile')
+	parser.add_argument('--startup_budget', type=float, help='exit with an error if cold start takes longer than this many seconds')
+	args = parser.parse_args()
+
+	device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+	load_start = time.perf_counter()
+	model, voc = loadInferenceModel(args.load, device)
+	if args.draft:
+		if args.shortlist or args.temperature > 0 or args.compile:
+			sys.exit('--draft cannot be combined with --shortlist, sampling or --compile')
+		# Same evaluate() interface as the model, producing identical greedy replies
+		model = SpeculativeDecoder(model, loadInferenceModel(args.draft, device)[0], args.draft_k)
+	retrieval = None
+	if args.retrieval:
+		index = RetrievalIndex(args.retrieval)
+		if index.num_words != voc.num_words:
+			sys.exit('%s was built for a different checkpoint' % (args.retrieval))
+		encoder = model.model.encoder if args.draft else model.encoder
+		retrieval = RetrievalResponder(index, encoder, args.retrieval_threshold, args.retrieval_method,
+			n_probe=args.n_probe, n_candidates=args.n_candidates)
+	shortlist = None
+	if args.shortlist:
+		shortlist = Shortlist.fromState(torch.load(args.shortlist, weights_only=True), args.shortlist_threshold).to(device)
+	load_time = time.perf_counter() - load_start
+
+	compile_time = 0.0
+	if args.compile:
+		# Single-sentence replies only need the batch size 1 graphs
+		compile_start = time.perf_counter()
+		model.compileSteps(cache=args.compile_cache)
+		model.warmup(batch_sizes=(1,))
+		compile_time = time.perf_counter() - compile_start
+
+	tokenizer_start = time.perf_counter()
+	from dataloader import utils
+	normalize = utils.normalizeString if args.english else utils.normalizeJapaneseString
+	tokenizer_time = time.perf_counter() - tokenizer_start
+
+	startup_time = time.perf_counter() - start_time
+	print('startup: %.2fs (weights + vocab %.2fs, compile %.2fs, tokenizer %.2fs, %d words)' % (startup_time, load_time, compile_time,
+		tokenizer_time, voc.num_words))
+	if args.startup_budget is not None and startup_time > args.startup_budget:
+		sys.exit('startup took %.2fs, over the budget of %.2fs' % (startup_time, args.startup_budget))
+
+	sampling = None
+	if args.temperature > 0:
+		sampling = {'temperature': args.temperature, 'top_k': args.top_k, 'top_p': args.top_p,
+			'seeds': [args.seed] if args.seed is not None else None}
+
+	evaluateInput(model, voc, normalize, shortlist, sampling, retrieval)
+
+if __name__ == '__main__':
+	main()
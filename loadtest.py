@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+import subprocess
+
+import numpy as np
+
+from serve import WorkerPool, memoryUsage
+
+# Open-loop load test of the inference path. Utterances of a corpus or of a recorded log are sent at a given
+#   arrival rate (or at their recorded times) to a WorkerPool in this process, or to serve.py --port over a
+#   localhost socket. Latency is measured from the scheduled arrival of a request, so a server falling behind
+#   shows up as queueing delay instead of slowing down the load generator. CPU time and memory are those of
+#   the serving processes.
+
+def parentPid(pid):
+	with open('/proc/%d/stat' % (pid)) as f:
+		return int(f.read().rsplit(')', 1)[1].split()[1])
+
+def childPids(pid):
+	children = []
+	for entry in os.listdir('/proc'):
+		if entry.isdigit():
+			try:
+				if parentPid(int(entry)) == pid:
+					children.append(int(entry))
+			except (OSError, IndexError, ValueError):
+				continue
+	return children
+
+def cpuSeconds(pids):
+	# User + system time of the processes (Linux)
+	total = 0
+	for pid in pids:
+		try:
+			with open('/proc/%d/stat' % (pid)) as f:
+				fields = f.read().rsplit(')', 1)[1].split()
+		except OSError:
+			continue
+		total += int(fields[11]) + int(fields[12])
+	return total / os.sysconf('SC_CLK_TCK')
+
+def loadUtterances(args):
+	# (recorded time in seconds or None, normalized sentence)
+	if args.log:
+		# One sentence per line, optionally preceded by a timestamp and a tab
+		utterances = []
+		with open(args.log, encoding='utf-8') as f:
+			for line in f:
+				line = line.rstrip('\n')
+				if not line.strip():
+					continue
+				timestamp, tab, sentence = line.partition('\t')
+				utterances.append((float(timestamp), sentence) if tab else (None, line))
+		return utterances
+	if args.corpus == 'synthetic':
+		from dataloader.synthetic import loadSyntheticDataset
+		dataset = loadSyntheticDataset(args.synthetic, seed=args.seed)
+	elif args.corpus == 'cornell':
+		from dataloader.cornell import loadCornellDataset
+		dataset = loadCornellDataset('data/cornell movie-dialogs corpus')
+	else:
+		# Imported lazily: the NUCC loader pulls in spaCy/GiNZA
+		from dataloader.nucc import loadNUCCDataset
+		dataset = loadNUCCDataset('data/nucc')
+	utterances = [(None, pair[0]) for pair in dataset]
+	random.Random(args.seed).shuffle(utterances)
+	return utterances
+
+def schedule(utterances, count, rate, process, rng, speedup=1.0):
+	# Arrival offsets in seconds of count requests, cycling through the utterances
+	sentences = [utterances[i % len(utterances)][1] for i in range(count)]
+	if rate is None:
+		# Recorded times, relative to the first utterance
+		first = utterances[0][0]
+		return [(utterances[i][0] - first) / speedup for i in range(count)], sentences
+	if process == 'constant':
+		return [i / rate for i in range(count)], sentences
+	offsets, offset = [], 0.0
+	for _ in range(count):
+		offsets.append(offset)
+		offset += rng.expovariate(rate)
+	return offsets, sentences
+
+class PoolTarget():
+	def __init__(self, pool):
+		self.pool = pool
+		self.lock = threading.Lock()
+		# pool request id -> load test request id
+		self.ids = {}
+
+	def send(self, request_id, sentence):
+		with self.lock:
+			self.ids[self.pool.submit(sentence)] = request_id
+
+	def receive(self):
+		# (request id, whether the reply was decoded)
+		pool_id, reply, _, _ = self.pool.result()
+		with self.lock:
+			return self.ids.pop(pool_id), reply is not None
+
+	def pids(self):
+		return [worker.pid for worker in self.pool.workers]
+
+	def close(self):
+		self.pool.close()
+
+class SocketTarget():
+	def __init__(self, command, port, timeout):
+		self.server = subprocess.Popen(command)
+		deadline = time.perf_counter() + timeout
+		# The server accepts connections once its model is loaded (and compiled)
+		while True:
+			try:
+				self.connection = socket.create_connection(('127.0.0.1', port))
+				break
+			except OSError:
+				if self.server.poll() is not None or time.perf_counter() > deadline:
+					self.server.kill()
+					sys.exit('serve.py did not start listening on port %d' % (port))
+				time.sleep(0.5)
+		self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.lines = self.connection.makefile('r', encoding='utf-8')
+
+	def send(self, request_id, sentence):
+		self.connection.sendall(('%d\t%s\n' % (request_id, sentence)).encode('utf-8'))
+
+	def receive(self):
+		request_id, tab, _ = self.lines.readline().rstrip('\n').partition('\t')
+		return int(request_id), tab != ''
+
+	def pids(self):
+		return [self.server.pid] + childPids(self.server.pid)
+
+	def close(self):
+		self.connection.close()
+		self.server.terminate()
+		self.server.wait()
+
+def runPhase(target, offsets, sentences, sample_interval):
+	count = len(sentences)
+	latencies = np.zeros(count)
+	errors = [0]
+	finished = threading.Event()
+	peak = {'rss_mb': 0.0, 'pss_mb': 0.0}
+	pids = target.pids()
+
+	def receive():
+		for _ in range(count):
+			request_id, ok = target.receive()
+			latencies[request_id] = time.perf_counter() - start - offsets[request_id]
+			if not ok:
+				errors[0] += 1
+		finished.set()
+
+	def sample():
+		while not finished.is_set():
+			usage = [memoryUsage(pid) for pid in pids]
+			for key in peak:
+				peak[key] = max(peak[key], sum(u.get(key, 0.0) for u in usage))
+			finished.wait(sample_interval)
+
+	cpu_start = cpuSeconds(pids)
+	start = time.perf_counter()
+	threads = [threading.Thread(target=receive, daemon=True), threading.Thread(target=sample, daemon=True)]
+	for thread in threads:
+		thread.start()
+	for request_id, (offset, sentence) in enumerate(zip(offsets, sentences)):
+		delay = start + offset - time.perf_counter()
+		if delay > 0:
+			time.sleep(delay)
+		target.send(request_id, sentence)
+	finished.wait()
+	elapsed = time.perf_counter() - start
+	cpu = cpuSeconds(pids) - cpu_start
+	for thread in threads:
+		thread.join()
+
+	return {
+		'requests': count,
+		'errors': errors[0],
+		'offered_rate': count / offsets[-1] if offsets[-1] > 0 else None,
+		'seconds': elapsed,
+		'throughput': count / elapsed,
+		'latency_ms': {
+			'mean': float(latencies.mean() * 1000),
+			'p50': float(np.percentile(latencies, 50) * 1000),
+			'p95': float(np.percentile(latencies, 95) * 1000),
+			'p99': float(np.percentile(latencies, 99) * 1000),
+			'max': float(latencies.max() * 1000),
+		},
+		'cpu_cores': cpu / elapsed,
+		'cpu_ms_per_request': cpu / count * 1000,
+		'peak_rss_mb': peak['rss_mb'],
+		'peak_pss_mb': peak['pss_mb'],
+	}
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-l', '--load', type=str, required=True, help='checkpoint with an embedded vocabulary')
+	parser.add_argument('--corpus', type=str, default='nucc', choices=['nucc', 'cornell', 'synthetic'], help='replay the inputs of this corpus')
+	parser.add_argument('--synthetic', type=int, default=10000, help='pairs of the synthetic corpus')
+	parser.add_argument('--log', type=str, help='replay a recorded log of normalized sentences instead, one per line, optionally "<seconds>\\t<sentence>"')
+	parser.add_argument('--rates', type=str, default='5,10,20', help='comma-separated arrival rates in requests/sec, one phase each; "log" replays recorded times')
+	parser.add_argument('--arrival', type=str, default='poisson', choices=['poisson', 'constant'])
+	parser.add_argument('--speedup', type=float, default=1.0, help='replay recorded times this many times faster')
+	parser.add_argument('--requests', type=int, default=200, help='requests per phase')
+	parser.add_argument('--socket', action='store_true', help='start serve.py --port and send requests over a localhost socket')
+	parser.add_argument('--port', type=int, default=5959)
+	parser.add_argument('--startup_timeout', type=float, default=600.0, help='seconds to wait for the socket server to listen')
+	parser.add_argument('-n', '--workers', type=int, default=2)
+	parser.add_argument('--threads', type=int, help='intra-op threads per worker')
+	parser.add_argument('--no_pin', action='store_true')
+	parser.add_argument('--share', type=str, default='mmap', choices=['mmap', 'shm'])
+	parser.add_argument('--max_batch', type=int, default=8, help='requests decoded together by a worker')
+	parser.add_argument('--max_length', type=int, default=10)
+	parser.add_argument('--compile', action='store_true', help='serve through torch.compile')
+	parser.add_argument('--compile_cache', type=str, default='weights/compile_cache')
+	parser.add_argument('--sample_interval', type=float, default=0.2, help='seconds between memory samples')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('-o', '--output', type=str, default='loadtest.json')
+	args = parser.parse_args()
+
+	utterances = loadUtterances(args)
+	rates = [None if rate == 'log' else float(rate) for rate in args.rates.split(',')]
+	if None in rates and any(timestamp is None for timestamp, _ in utterances):
+		sys.exit('--rates log needs a log with a timestamp on every line')
+
+	if args.socket:
+		command = [sys.executable, 'serve.py', '-l', args.load, '--port', str(args.port), '-n', str(args.workers), '--share', args.share,
+			'--max_batch', str(args.max_batch), '--max_length', str(args.max_length), '--compile_cache', args.compile_cache]
+		command += ['--threads', str(args.threads)] if args.threads else []
+		command += ['--no_pin'] if args.no_pin else []
+		command += ['--compile'] if args.compile else []
+		target = SocketTarget(command, args.port, args.startup_timeout)
+	else:
+		target = PoolTarget(WorkerPool(args.load, args.workers, args.threads, not args.no_pin, args.share, args.max_batch, args.max_length,
+			args.compile_cache if args.compile else None).start())
+
+	report = {'config': vars(args), 'phases': []}
+	try:
+		# Warm-up: every worker decodes at least once before timing
+		warmup = [utterance[1] for utterance in utterances[:args.workers * args.max_batch]]
+		runPhase(target, [0.0] * len(warmup), warmup, args.sample_interval)
+		rng = random.Random(args.seed)
+		for rate in rates:
+			count = min(args.requests, len(utterances)) if rate is None else args.requests
+			offsets, sentences = schedule(utterances, count, rate, args.arrival, rng, args.speedup)
+			result = runPhase(target, offsets, sentences, args.sample_interval)
+			result['rate'] = rate if rate is not None else 'log'
+			report['phases'].append(result)
+			latency = result['latency_ms']
+			print('rate %-6s %7.1f requests/sec, latency p50 %8.1f ms, p95 %8.1f ms, p99 %8.1f ms, %.2f cores, peak rss %.1f MB (pss %.1f MB), %d errors'
+				% (result['rate'], result['throughput'], latency['p50'], latency['p95'], latency['p99'], result['cpu_cores'],
+				result['peak_rss_mb'], result['peak_pss_mb'], result['errors']))
+	finally:
+		target.close()
+
+	with open(args.output, 'w') as f:
+		json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,243 @@
+import os
+import glob
+import queue
+import random
+import threading
+import subprocess
+
+import torch
+
+def cpuCopy(obj):
+	# Detached CPU copy of every tensor in a (nested) state dict, so that training can keep
+	#   mutating the live tensors while the copy is written out
+	if torch.is_tensor(obj):
+		return obj.detach().to('cpu', copy=True)
+	elif isinstance(obj, dict):
+		return {k: cpuCopy(v) for k, v in obj.items()}
+	elif isinstance(obj, (list, tuple)):
+		return type(obj)(cpuCopy(v) for v in obj)
+	return obj
+
+def rngState():
+	state = {
+		'python': random.getstate(),
+		'torch': torch.get_rng_state(),
+	}
+	if torch.cuda.is_available():
+		state['cuda'] = torch.cuda.get_rng_state_all()
+	return state
+
+def setRngState(state):
+	random.setstate(state['python'])
+	torch.set_rng_state(state['torch'])
+	if 'cuda' in state and torch.cuda.is_available():
+		torch.cuda.set_rng_state_all(state['cuda'])
+
+def makeCheckpoint(model, voc=None, dataloader=None, epoch=0, step=0):
+	checkpoint = {
+		'config': model.config,
+		'model': model.state_dict(),
+		'encoder_optimizer': model.encoder_optimizer.state_dict(),
+		'decoder_optimizer': model.decoder_optimizer.state_dict(),
+		'epoch': epoch,
+		'step': step,
+		'rng': rngState(),
+	}
+	if voc is not None:
+		checkpoint['voc'] = voc.state_dict()
+	if dataloader is not None:
+		checkpoint['dataloader'] = dataloader.state_dict()
+	return cpuCopy(checkpoint)
+
+def saveCheckpoint(checkpoint, path):
+	# Write to a temporary file first so a crash mid-save never leaves a truncated checkpoint behind
+	tmp_path = path + '.tmp'
+	torch.save(checkpoint, tmp_path)
+	os.replace(tmp_path, path)
+
+def loadCheckpoint(path, model=None, dataloader=None, map_location='cpu', restore_rng=True):
+	checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+	# Plain state_dicts saved before checkpoints bundled optimizer state are still accepted
+	if 'model' not in checkpoint:
+		checkpoint = {'model': checkpoint}
+	if model is not None:
+		model.load_state_dict(checkpoint['model'])
+		if 'encoder_optimizer' in checkpoint:
+			model.encoder_optimizer.load_state_dict(checkpoint['encoder_optimizer'])
+			model.decoder_optimizer.load_state_dict(checkpoint['decoder_optimizer'])
+	if dataloader is not None and 'dataloader' in checkpoint:
+		dataloader.load_state_dict(checkpoint['dataloader'])
+	if restore_rng and 'rng' in checkpoint:
+		setRngState(checkpoint['rng'])
+	return checkpoint
+
+def exportInference(path, output_path, voc=None):
+	# Strip optimizer, data cursor and RNG state, keeping only what serving needs
+	checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+	if voc is not None:
+		checkpoint['voc'] = voc.state_dict()
+	if 'config' not in checkpoint or 'voc' not in checkpoint:
+		raise ValueError(path, "has no embedded config or vocabulary; pass voc explicitly")
+	saveCheckpoint({k: checkpoint[k] for k in ['config', 'model', 'voc']}, output_path)
+
+def lowRankFactors(weight, rank):
+	# Best rank-r approximation weight ~= left @ right.t() by truncated SVD; left (rows, rank), right (columns, rank)
+	U, S, Vh = torch.linalg.svd(weight.float(), full_matrices=False)
+	return (U[:, :rank] * S[:rank]).to(weight.dtype), Vh[:rank].t().contiguous().to(weight.dtype)
+
+def convertOutputProjection(path, output_path, tie_embedding=False, output_rank=0):
+	# Rewrite a checkpoint with an untied full-rank output projection for Seq2SeqModel(tie_embedding, output_rank):
+	#   tied: the output matrix is dropped and the embedding used instead
+	#   low rank: the output matrix is replaced by its truncated SVD factors
+	#   tied and low rank: the embedding is replaced by its truncated SVD factors, shared with the output
+	#   Optimizer and data state no longer match the parameters and are dropped; fine-tune afterwards.
+	#   Without output_path the converted checkpoint is only returned.
+	checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+	if 'config' not in checkpoint:
+		raise ValueError(path, "has no embedded config")
+	config = dict(checkpoint['config'])
+	if config.get('tie_embedding', False) or config.get('output_rank', 0) > 0:
+		raise ValueError(path, "already has a tied or low-rank output projection")
+	state = dict(checkpoint['model'])
+	if tie_embedding and output_rank > 0:
+		table, projection = lowRankFactors(state['encoder.embedding.weight'], output_rank)
+		for prefix in ['encoder.embedding.', 'decoder.embedding.']:
+			del state[prefix + 'weight']
+			state[prefix + 'table.weight'] = table
+			state[prefix + 'projection.weight'] = projection
+		del state['decoder.out.weight']
+	elif tie_embedding:
+		del state['decoder.out.weight']
+	elif output_rank > 0:
+		state['decoder.out.weight'], down = lowRankFactors(state['decoder.out.weight'], output_rank)
+		state['decoder.out.down.weight'] = down.t().contiguous()
+	config['tie_embedding'] = tie_embedding
+	config['output_rank'] = output_rank
+	converted = {'config': config, 'model': state}
+	if 'voc' in checkpoint:
+		converted['voc'] = checkpoint['voc']
+	if output_path is not None:
+		saveCheckpoint(converted, output_path)
+	return converted
+
+class CheckpointSaver():
+	def __init__(self, directory, keep=None, pattern='step_%08d.pth', on_saved=None):
+		self.directory = directory
+		# Number of step checkpoints to retain; None keeps all of them
+		self.keep = keep
+		self.pattern = pattern
+		# Called with the path of every checkpoint once it is completely written (e.g. to start an evaluation);
+		#   runs on the writer thread
+		self.on_saved = on_saved
+		# Step checkpoints still in use (e.g. by an evaluation), which pruning skips
+		self.protected = set()
+		os.makedirs(directory, exist_ok=True)
+
+		# At most one checkpoint waits behind the one being written, so a slow disk
+		#   throttles training instead of piling up snapshots in memory
+		self.queue = queue.Queue(maxsize=1)
+		self.error = None
+		self.thread = threading.Thread(target=self._worker, daemon=True)
+		self.thread.start()
+
+	def _worker(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				self.queue.task_done()
+				break
+			checkpoint, path, retain = item
+			try:
+				saveCheckpoint(checkpoint, path)
+				if retain:
+					self._prune()
+				if self.on_saved is not None:
+					self.on_saved(path)
+			except Exception as e:
+				self.error = e
+			self.queue.task_done()
+
+	def _prune(self):
+		if self.keep is None:
+			return
+		paths = sorted(glob.glob(os.path.join(self.directory, self.pattern.replace('%08d', '*'))))
+		for path in paths[:max(len(paths) - self.keep, 0)]:
+			if path not in self.protected:
+				os.remove(path)
+
+	def protect(self, path):
+		self.protected.add(path)
+
+	def release(self, path):
+		# Pruned with the next saved step checkpoint if it is beyond the retention limit by then
+		self.protected.discard(path)
+
+	def _raise(self):
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise error
+
+	def save(self, checkpoint, name):
+		# Snapshot is taken synchronously by the caller (makeCheckpoint); only the write is deferred
+		self._raise()
+		self.queue.put((checkpoint, os.path.join(self.directory, name), False))
+
+	def saveStep(self, checkpoint, step):
+		# Mid-epoch checkpoint subject to the retention limit
+		self._raise()
+		self.queue.put((checkpoint, os.path.join(self.directory, self.pattern % (step)), True))
+
+	def wait(self):
+		self.queue.join()
+		self._raise()
+
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+		self._raise()
+
+# Runs command + [path] in a background process for saved checkpoints (e.g. as CheckpointSaver.on_saved), one
+#   at a time: a checkpoint saved while an evaluation runs waits for it, replacing any older checkpoint still
+#   waiting, so frequent saves never pile up processes that compete with training. Checkpoints running or
+#   waiting are protected from the saver's pruning until their turn is over.
+class CheckpointEvaluator():
+	def __init__(self, command, saver=None):
+		self.command = command
+		self.saver = saver
+		self.condition = threading.Condition()
+		self.running = None
+		self.waiting = None
+
+	def __call__(self, path):
+		with self.condition:
+			if self.saver is not None:
+				self.saver.protect(path)
+			if self.waiting is not None:
+				self._release(self.waiting)
+			self.waiting = path
+			if self.running is None:
+				self._startWaiting()
+
+	def _release(self, path):
+		if self.saver is not None:
+			self.saver.release(path)
+
+	def _startWaiting(self):
+		self.running, self.waiting = self.waiting, None
+		process = subprocess.Popen(self.command + [self.running])
+		threading.Thread(target=self._wait, args=(process,), daemon=True).start()
+
+	def _wait(self, process):
+		process.wait()
+		with self.condition:
+			self._release(self.running)
+			self.running = None
+			if self.waiting is not None:
+				self._startWaiting()
+			else:
+				self.condition.notify_all()
+
+	def close(self):
+		# Wait for the running evaluation and the one waiting after it
+		with self.condition:
+			self.condition.wait_for(lambda: self.running is None)
@@ -0,0 +1,26 @@
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+def setup(rank, world_size, port=29500, threads=None):
+	os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+	os.environ['MASTER_PORT'] = str(port)
+	dist.init_process_group('gloo', rank=rank, world_size=world_size)
+	# Split the cores between the processes instead of letting every process use all of them
+	if threads is None:
+		threads = max(1, (os.cpu_count() or 1) // world_size)
+	torch.set_num_threads(threads)
+
+def cleanup():
+	dist.destroy_process_group()
+
+def allReduceSum(value):
+	tensor = torch.tensor([float(value)], dtype=torch.float64)
+	dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+	return tensor.item()
+
+def launch(fn, world_size, *args):
+	# fn(rank, world_size, *args) runs in each of world_size spawned processes
+	mp.spawn(fn, args=(world_size,) + args, nprocs=world_size, join=True)
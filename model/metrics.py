@@ -0,0 +1,70 @@
+import math
+import functools
+import multiprocessing as mp
+from collections import Counter
+
+# Corpus-level BLEU and distinct-n of generated replies. Statistics are additive over sentences, so
+#   chunks of the corpus are counted in a worker pool and merged.
+
+def ngrams(tokens, n):
+	return [tuple(tokens[i : i + n]) for i in range(len(tokens) - n + 1)]
+
+def chunkStats(chunk, max_n=4, distinct_n=2):
+	# chunk: list of (hypothesis tokens, reference tokens)
+	matches, totals = [0] * max_n, [0] * max_n
+	hypothesis_length, reference_length = 0, 0
+	distinct = [set() for _ in range(distinct_n)]
+	distinct_totals = [0] * distinct_n
+	for hypothesis, reference in chunk:
+		hypothesis_length += len(hypothesis)
+		reference_length += len(reference)
+		for n in range(1, max_n + 1):
+			hypothesis_ngrams = Counter(ngrams(hypothesis, n))
+			reference_ngrams = Counter(ngrams(reference, n))
+			# Clipped counts: an n-gram matches at most as often as it occurs in the reference
+			matches[n - 1] += sum(min(count, reference_ngrams[ngram]) for ngram, count in hypothesis_ngrams.items())
+			totals[n - 1] += max(len(hypothesis) - n + 1, 0)
+		for n in range(1, distinct_n + 1):
+			hypothesis_ngrams = ngrams(hypothesis, n)
+			distinct[n - 1].update(hypothesis_ngrams)
+			distinct_totals[n - 1] += len(hypothesis_ngrams)
+	return matches, totals, hypothesis_length, reference_length, distinct, distinct_totals
+
+def corpusMetrics(hypotheses, references, workers=4, chunk_size=1000, max_n=4, distinct_n=2):
+	# hypotheses, references: lists of token lists. BLEU uses add-one smoothing of the n > 1 precisions,
+	#   which keeps short replies from scoring zero.
+	chunks = [list(zip(hypotheses[i : i + chunk_size], references[i : i + chunk_size])) for i in range(0, len(hypotheses), chunk_size)]
+	count = functools.partial(chunkStats, max_n=max_n, distinct_n=distinct_n)
+	if workers > 1 and len(chunks) > 1:
+		with mp.get_context('fork').Pool(min(workers, len(chunks))) as pool:
+			results = pool.map(count, chunks)
+	else:
+		results = [count(chunk) for chunk in chunks]
+
+	matches, totals = [0] * max_n, [0] * max_n
+	hypothesis_length, reference_length = 0, 0
+	distinct = [set() for _ in range(distinct_n)]
+	distinct_totals = [0] * distinct_n
+	for chunk_matches, chunk_totals, chunk_hypothesis_length, chunk_reference_length, chunk_distinct, chunk_distinct_totals in results:
+		for n in range(max_n):
+			matches[n] += chunk_matches[n]
+			totals[n] += chunk_totals[n]
+		hypothesis_length += chunk_hypothesis_length
+		reference_length += chunk_reference_length
+		for n in range(distinct_n):
+			distinct[n] |= chunk_distinct[n]
+			distinct_totals[n] += chunk_distinct_totals[n]
+
+	log_precision = 0.0
+	for n in range(max_n):
+		smoothing = 1 if n > 0 else 0
+		if matches[n] + smoothing == 0 or totals[n] + smoothing == 0:
+			log_precision = -math.inf
+			break
+		log_precision += math.log((matches[n] + smoothing) / (totals[n] + smoothing)) / max_n
+	brevity_penalty = 1.0 if hypothesis_length > reference_length else math.exp(1 - reference_length / max(hypothesis_length, 1))
+	metrics = {'bleu': brevity_penalty * math.exp(log_precision) if log_precision > -math.inf else 0.0}
+	for n in range(distinct_n):
+		metrics['distinct_%d' % (n + 1)] = len(distinct[n]) / distinct_totals[n] if distinct_totals[n] > 0 else 0.0
+	metrics['mean_length'] = hypothesis_length / max(len(hypotheses), 1)
+	return metrics
@@ -0,0 +1,75 @@
+import time
+import contextlib
+from collections import defaultdict
+
+import torch
+
+# Shared no-op context returned when profiling is disabled, so an un-instrumented
+#   step costs one attribute check per stage
+NULL_STAGE = contextlib.nullcontext()
+
+class StageProfiler():
+	def __init__(self, synchronize=False, record_functions=False):
+		# Kernels are asynchronous on CUDA, so stage times are only meaningful with synchronize=True
+		self.synchronize = synchronize and torch.cuda.is_available()
+		# Label stages in torch.profiler traces
+		self.record_functions = record_functions
+		self.reset()
+
+	def reset(self):
+		self.times = defaultdict(float)
+		self.calls = defaultdict(int)
+		self.tokens = defaultdict(int)
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		if self.synchronize:
+			torch.cuda.synchronize()
+		record = torch.profiler.record_function(name) if self.record_functions else NULL_STAGE
+		start = time.perf_counter()
+		with record:
+			yield
+		if self.synchronize:
+			torch.cuda.synchronize()
+		self.times[name] += time.perf_counter() - start
+		self.calls[name] += 1
+
+	def addTokens(self, name, count):
+		self.tokens[name] += count
+
+	def summary(self):
+		total = sum(self.times.values())
+		return {
+			'stages': {name: {
+				'seconds': seconds,
+				'calls': self.calls[name],
+				'fraction': seconds / total if total > 0 else 0.0,
+			} for name, seconds in self.times.items()},
+			'tokens': dict(self.tokens),
+		}
+
+	def report(self):
+		total = sum(self.times.values())
+		lines = []
+		for name, seconds in sorted(self.times.items(), key=lambda x: -x[1]):
+			lines.append('%-20s %10.3fs %6.1f%% %8d calls' % (name, seconds, 100 * seconds / total if total > 0 else 0.0, self.calls[name]))
+		for name, count in self.tokens.items():
+			lines.append('%-20s %10d tokens' % (name, count))
+		return '\n'.join(lines)
+
+def stage(profiler, name):
+	if profiler is None:
+		return NULL_STAGE
+	return profiler.stage(name)
+
+def traceProfiler(trace_dir, wait=1, warmup=1, active=3):
+	# Wraps training steps in torch.profiler and exports Chrome/TensorBoard traces to trace_dir;
+	#   call .step() once per iteration
+	activities = [torch.profiler.ProfilerActivity.CPU]
+	if torch.cuda.is_available():
+		activities.append(torch.profiler.ProfilerActivity.CUDA)
+	return torch.profiler.profile(
+		activities=activities,
+		schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+		on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+		record_shapes=True)
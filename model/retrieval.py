@@ -0,0 +1,202 @@
+import os
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .seq2seq import lengthMask
+
+# Nearest-neighbour index over the encoder representations of training inputs, used to answer
+#   inputs close to a training input with its response instead of decoding. A directory holds
+#   index.pt (responses and settings) and NumPy .npy arrays that are memory-mapped when loaded:
+#   vectors (num_pairs, hidden_size) of L2-normalized mean-pooled encoder outputs, an IVF
+#   partition (spherical k-means centroids and the pair ids of every list) and LSH codes
+#   (random hyperplane signs, packed to bytes).
+
+# Number of set bits of every byte, for Hamming distances between packed LSH codes
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def meanPooled(encoder, input_seq, input_length):
+	# Average of the encoder outputs over the non-PAD positions, normalized so that a dot product is a cosine
+	outputs, _ = encoder(input_seq, input_length)
+	lengths = input_length.to(outputs.device)
+	mask = lengthMask(lengths, outputs.size(1)).unsqueeze(2)
+	pooled = (outputs * mask).sum(1) / lengths.unsqueeze(1)
+	return F.normalize(pooled, dim=1)
+
+def topK(scores, ids, k):
+	# Best k columns of every row of scores (descending), with their ids
+	k = min(k, scores.shape[1])
+	best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+	best_scores = np.take_along_axis(scores, best, axis=1)
+	order = np.argsort(-best_scores, axis=1)
+	return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(ids, np.take_along_axis(best, order, axis=1), axis=1)
+
+def encodePairs(model, voc, pairs, vectors, batch_size=256):
+	# Batches of similar lengths: little padding, and pack_padded_sequence needs descending lengths
+	order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0].split(' ')), reverse=True)
+	with torch.no_grad():
+		for start in range(0, len(order), batch_size):
+			ids = order[start : start + batch_size]
+			indexes_batch = [torch.LongTensor(voc.indicesFromSentence(pairs[i][0])) for i in ids]
+			lengths = torch.tensor([len(indexes) for indexes in indexes_batch])
+			input_batch = torch.nn.utils.rnn.pad_sequence(indexes_batch).to(model.device)
+			vectors[ids] = meanPooled(model.encoder, input_batch, lengths).cpu().numpy()
+
+def trainCentroids(vectors, n_lists, iterations=10, sample_size=100000, seed=0):
+	# Spherical k-means on a sample of the vectors
+	rng = np.random.default_rng(seed)
+	sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))])
+	centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+	for _ in range(iterations):
+		assign = np.argmax(sample @ centroids.T, axis=1)
+		sums = np.zeros_like(centroids)
+		np.add.at(sums, assign, sample)
+		norms = np.linalg.norm(sums, axis=1, keepdims=True)
+		# Lists that lost all their vectors keep their previous centroid
+		centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+	return centroids.astype(np.float32)
+
+def buildRetrievalIndex(model, voc, pairs, directory, batch_size=256, n_lists=None, lsh_bits=64,
+	kmeans_iterations=10, chunk_size=65536, seed=0):
+	os.makedirs(directory, exist_ok=True)
+	num_pairs = len(pairs)
+	hidden_size = model.config['hidden_size']
+	vectors = np.lib.format.open_memmap(os.path.join(directory, 'vectors.npy'), mode='w+', dtype=np.float32,
+		shape=(num_pairs, hidden_size))
+	encodePairs(model, voc, pairs, vectors, batch_size)
+	vectors.flush()
+
+	if n_lists is None:
+		n_lists = max(1, int(4 * math.sqrt(num_pairs)))
+	n_lists = min(n_lists, num_pairs)
+	centroids = trainCentroids(vectors, n_lists, kmeans_iterations, seed=seed)
+	planes = np.random.default_rng(seed).standard_normal((hidden_size, lsh_bits)).astype(np.float32)
+	assign = np.zeros(num_pairs, dtype=np.int64)
+	codes = np.lib.format.open_memmap(os.path.join(directory, 'lsh_codes.npy'), mode='w+', dtype=np.uint8,
+		shape=(num_pairs, (lsh_bits + 7) // 8))
+	for start in range(0, num_pairs, chunk_size):
+		chunk = np.asarray(vectors[start : start + chunk_size])
+		assign[start : start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+		codes[start : start + chunk_size] = np.packbits(chunk @ planes > 0, axis=1)
+	codes.flush()
+
+	list_ids = np.argsort(assign, kind='stable')
+	list_offsets = np.searchsorted(assign[list_ids], np.arange(n_lists + 1))
+	np.save(os.path.join(directory, 'ivf_centroids.npy'), centroids)
+	np.save(os.path.join(directory, 'ivf_ids.npy'), list_ids)
+	np.save(os.path.join(directory, 'ivf_offsets.npy'), list_offsets)
+	np.save(os.path.join(directory, 'lsh_planes.npy'), planes)
+	torch.save({
+		'responses': [pair[1] for pair in pairs],
+		'inputs': [pair[0] for pair in pairs],
+		'num_words': model.config['num_words'],
+		'hidden_size': hidden_size,
+	}, os.path.join(directory, 'index.pt'))
+	return RetrievalIndex(directory)
+
+class RetrievalIndex():
+	def __init__(self, directory, chunk_size=65536):
+		meta = torch.load(os.path.join(directory, 'index.pt'), weights_only=True)
+		self.responses = meta['responses']
+		self.inputs = meta['inputs']
+		self.num_words = meta['num_words']
+		self.hidden_size = meta['hidden_size']
+		load = lambda name: np.load(os.path.join(directory, name), mmap_mode='r')
+		self.vectors = load('vectors.npy')
+		self.centroids = np.load(os.path.join(directory, 'ivf_centroids.npy'))
+		self.list_ids = load('ivf_ids.npy')
+		self.list_offsets = np.load(os.path.join(directory, 'ivf_offsets.npy'))
+		self.planes = np.load(os.path.join(directory, 'lsh_planes.npy'))
+		self.codes = load('lsh_codes.npy')
+		# Rows of the memory-mapped arrays scanned at a time by the exact and LSH searches
+		self.chunk_size = chunk_size
+
+	def __len__(self):
+		return len(self.responses)
+
+	# queries: (num_queries, hidden_size) normalized float32 array. Returns cosine similarities and pair ids,
+	#   both (num_queries, k) in descending order.
+	#   exact: brute force over all vectors
+	#   ivf: exact scores within the n_probe lists whose centroids are closest to the query
+	#   lsh: exact scores for the n_candidates codes nearest in Hamming distance
+	def search(self, queries, k=1, method='exact', n_probe=8, n_candidates=1000):
+		queries = np.ascontiguousarray(queries, dtype=np.float32)
+		if method == 'exact':
+			return self.exactSearch(queries, k)
+		elif method == 'ivf':
+			return self.rerank(queries, k, self.ivfCandidates(queries, n_probe))
+		elif method == 'lsh':
+			return self.rerank(queries, k, self.lshCandidates(queries, n_candidates))
+		raise ValueError(method, "is not a retrieval search method.")
+
+	def exactSearch(self, queries, k):
+		best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+		best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+		for start in range(0, len(self), self.chunk_size):
+			scores = queries @ self.vectors[start : start + self.chunk_size].T
+			ids = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+			best_scores, best_ids = topK(np.concatenate((best_scores, scores), axis=1), np.concatenate((best_ids, ids), axis=1), k)
+		return best_scores, best_ids
+
+	def ivfCandidates(self, queries, n_probe):
+		_, probes = topK(queries @ self.centroids.T, np.broadcast_to(np.arange(len(self.centroids)), (len(queries), len(self.centroids))), n_probe)
+		return [np.concatenate([self.list_ids[self.list_offsets[c] : self.list_offsets[c + 1]] for c in probe]) for probe in probes]
+
+	def hamming(self, codes, query_code):
+		# Bit counts of 64-bit words where NumPy has them (>= 2.0), otherwise per byte through a lookup table
+		if hasattr(np, 'bitwise_count') and codes.shape[1] % 8 == 0:
+			return np.bitwise_count(codes.view(np.uint64) ^ query_code.view(np.uint64)).sum(axis=1, dtype=np.int32)
+		return POPCOUNT[codes ^ query_code].sum(axis=1, dtype=np.int32)
+
+	def lshCandidates(self, queries, n_candidates):
+		query_codes = np.packbits(queries @ self.planes > 0, axis=1)
+		distances = np.zeros((len(queries), len(self)), dtype=np.int32)
+		for start in range(0, len(self), self.chunk_size):
+			codes = np.ascontiguousarray(self.codes[start : start + self.chunk_size])
+			for i, query_code in enumerate(query_codes):
+				distances[i, start : start + len(codes)] = self.hamming(codes, query_code)
+		# Every code within the smallest Hamming radius that holds n_candidates codes; a histogram of the
+		#   few possible distances is cheaper than partitioning all of them
+		candidates = []
+		for row in distances:
+			radius = np.searchsorted(np.cumsum(np.bincount(row)), min(n_candidates, len(self)))
+			candidates.append(np.flatnonzero(row <= radius))
+		return candidates
+
+	def rerank(self, queries, k, candidates):
+		scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+		ids = np.full((len(queries), k), -1, dtype=np.int64)
+		for i, candidate_ids in enumerate(candidates):
+			if len(candidate_ids) == 0:
+				continue
+			# Sorted ids read the memory-mapped vectors in file order
+			candidate_ids = np.sort(candidate_ids)
+			candidate_scores = np.asarray(self.vectors[candidate_ids]) @ queries[i]
+			best_scores, best_ids = topK(candidate_scores[None, :], candidate_ids[None, :], k)
+			scores[i, :best_scores.shape[1]], ids[i, :best_ids.shape[1]] = best_scores[0], best_ids[0]
+		return scores, ids
+
+# Serving fast path: inputs whose nearest training input is at least `threshold` similar are answered
+#   with that pair's response, others are left to the decoder
+class RetrievalResponder():
+	def __init__(self, index, encoder, threshold=0.95, method='ivf', **search_kwargs):
+		self.index = index
+		self.encoder = encoder
+		self.threshold = threshold
+		self.method = method
+		self.search_kwargs = search_kwargs
+		# Serving statistics: queries and queries answered from the index
+		self.queries = 0
+		self.hits = 0
+
+	# Returns one response string, or None to decode, per sentence of the batch
+	def respond(self, input_seq, input_length):
+		with torch.no_grad():
+			queries = meanPooled(self.encoder, input_seq, input_length).cpu().numpy()
+		scores, ids = self.index.search(queries, 1, self.method, **self.search_kwargs)
+		responses = [self.index.responses[i[0]] if s[0] >= self.threshold else None for s, i in zip(scores, ids)]
+		self.queries += len(responses)
+		self.hits += sum(response is not None for response in responses)
+		return responses
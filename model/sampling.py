@@ -0,0 +1,149 @@
+import torch
+
+def selectRows(tensor, rows):
+	# tensor[rows] for ascending row indices, without a copy when they are all the rows
+	return tensor if len(rows) == tensor.size(0) else tensor[rows]
+
+def boundaryBucket(mass, above, target):
+	# Highest bucket of every row where the mass of it and all higher buckets, plus above, reaches target;
+	#   returns it and the mass above it, as (batch_size, 1)
+	cumulative = mass.flip(1).cumsum(1).flip(1) + above
+	boundary = ((cumulative >= target).sum(dim=1, keepdim=True) - 1).clamp(min=0)
+	return boundary, cumulative.gather(1, boundary) - mass.gather(1, boundary)
+
+def nucleusThreshold(weights, target):
+	# Largest weight t of every row such that the weights >= t sum to at least target, as (batch_size, 1).
+	#   Non-negative float32 values order like their bit patterns, so t is found without sorting by a radix
+	#   select: per-row mass histograms over 11, 11 and 9 bits narrow it down to a single bit pattern.
+	batch_size = weights.size(0)
+	bits = weights.view(torch.int32)
+	# The first level, over the sign, exponent and top 2 mantissa bits, is the only pass over all weights
+	digits = (bits >> 20).long()
+	mass = torch.zeros(batch_size, 1 << 11, device=weights.device).scatter_add_(1, digits, weights)
+	prefix, above = boundaryBucket(mass, torch.zeros(batch_size, 1, device=weights.device), target)
+	# The next levels refine only the weights within a factor 1.25 of t, a small part of the vocabulary
+	rows, columns = (digits == prefix).nonzero(as_tuple=True)
+	values, bits = weights[rows, columns], bits[rows, columns]
+	for shift, width in [(9, 11), (0, 9)]:
+		digits = ((bits >> shift) & ((1 << width) - 1)).long()
+		mass = torch.zeros(batch_size << width, device=weights.device).index_add_(0, (rows << width) + digits, values)
+		boundary, above = boundaryBucket(mass.view(batch_size, -1), above, target)
+		prefix = (prefix << width) | boundary
+		selected = digits == boundary.squeeze(1)[rows]
+		rows, values, bits = rows[selected], values[selected], bits[selected]
+	return prefix.int().view(torch.float32)
+
+# Batched temperature / top-k / top-p (nucleus) sampling over decoder softmax outputs. Every
+#   sentence of a batch has its own parameters and, optionally, its own seeded generator, so a
+#   request samples the same reply whatever else it is batched with.
+class Sampler():
+	def __init__(self, batch_size, temperature=1.0, top_k=0, top_p=1.0, seeds=None, device=None):
+		def perRow(value, dtype):
+			if isinstance(value, (list, tuple)):
+				return torch.tensor(value, dtype=dtype, device=device)
+			return torch.full((batch_size,), value, dtype=dtype, device=device)
+
+		# temperature <= 0 selects greedy decoding for that row; top_k <= 0 and top_p >= 1 disable the filters
+		self.temperature = perRow(temperature, torch.float)
+		self.top_k = perRow(top_k, torch.long)
+		self.top_p = perRow(top_p, torch.float)
+		self.generators = None
+		if seeds is not None:
+			self.generators = [torch.Generator(device=device or 'cpu').manual_seed(seed) for seed in seeds]
+		# Uniform draws are taken from the generators in blocks, one call per generator per block
+		#   instead of one per decoding step
+		self.block_size = 32
+		self.uniforms = None
+		self.next_uniform = 0
+		# Rows are sampled in groups by filter, each in a way that depends on the row alone
+		greedy = self.temperature <= 0
+		self.groups = [(rows, sample) for rows, sample in [
+			(greedy, self.greedy),
+			(~greedy & (self.top_k > 0), self.topK),
+			(~greedy & (self.top_k <= 0) & (self.top_p < 1.0), self.nucleus),
+			(~greedy & (self.top_k <= 0) & (self.top_p >= 1.0), self.plain),
+		] for rows in [rows.nonzero().squeeze(1)] if len(rows) > 0]
+		# The top-k group is ranked once to its largest k, which avoids sorting the whole vocabulary
+		self.max_k = int(self.top_k.max())
+		self.nucleus_prefix = 64
+
+	def tempered(self, probs, max_probs, inverse_temperature):
+		# (probs / max_probs) ** inverse_temperature, taken through log and exp, which unlike pow are vectorized on CPU
+		return probs.log().sub_(max_probs.log()).mul_(inverse_temperature).exp_()
+
+	def uniform(self, batch_size, device):
+		if self.generators is None:
+			return torch.rand(batch_size, device=device)
+		if self.uniforms is None or self.next_uniform == self.block_size:
+			self.uniforms = torch.stack([torch.rand(self.block_size, generator=generator, device=device) for generator in self.generators], dim=1)
+			self.next_uniform = 0
+		self.next_uniform += 1
+		return self.uniforms[self.next_uniform - 1]
+
+	def sampleIds(self, weights, ids, uniforms):
+		# Inverse-CDF sampling with one uniform draw per row; ids maps positions to words (None: identity)
+		cdf = weights.cumsum(dim=1)
+		positions = torch.searchsorted(cdf, uniforms.unsqueeze(1) * cdf[:, -1:]).clamp(max=weights.size(1) - 1)
+		return positions.squeeze(1) if ids is None else ids.gather(1, positions).squeeze(1)
+
+	# Samplers of the groups: probs, inverse_temperature and uniforms are those of the rows of the group
+
+	def greedy(self, probs, inverse_temperature, uniforms, rows):
+		return probs.argmax(dim=1)
+
+	def plain(self, probs, inverse_temperature, uniforms, rows):
+		# Plain temperature sampling needs no ranking at all; amax, unlike max, does not also compute the argmax
+		return self.sampleIds(self.tempered(probs, probs.amax(dim=1, keepdim=True), inverse_temperature), None, uniforms)
+
+	def topK(self, probs, inverse_temperature, uniforms, rows):
+		# Tempering keeps the ranking of the words, so candidates are selected on probs directly and only
+		#   they are tempered, relative to the row maximum to avoid underflow
+		top_k, top_p = self.top_k[rows].unsqueeze(1), self.top_p[rows].unsqueeze(1)
+		k = min(self.max_k, probs.size(1))
+		top_probs, top_ids = probs.topk(k, dim=1)
+		weights = self.tempered(top_probs, top_probs[:, :1], inverse_temperature)
+		weights = weights.masked_fill(torch.arange(k, device=probs.device).unsqueeze(0) >= top_k, 0.0)
+		# The nucleus is then taken within the remaining words; the best word always stays
+		total = weights.sum(dim=1, keepdim=True)
+		weights = weights.masked_fill((top_p < 1.0) & ((weights.cumsum(dim=1) - weights) >= top_p * total), 0.0)
+		return self.sampleIds(weights, top_ids, uniforms)
+
+	def nucleus(self, probs, inverse_temperature, uniforms, rows):
+		# Top-p without top-k. For peaked distributions a short prefix of the ranking covers top_p of the
+		#   tempered distribution; the other rows are cut from the whole vocabulary by nucleusThreshold().
+		batch_size, num_words = probs.shape
+		weights = self.tempered(probs, probs.amax(dim=1, keepdim=True), inverse_temperature)
+		target = self.top_p[rows].unsqueeze(1) * weights.sum(dim=1, keepdim=True)
+		tokens = torch.zeros(batch_size, dtype=torch.long, device=probs.device)
+		covered = torch.zeros(batch_size, dtype=torch.bool, device=probs.device)
+		# The top nucleus_prefix weights sum to at most sqrt(nucleus_prefix) times the norm of the weights
+		#   (Cauchy-Schwarz), so the prefix is only tried on rows where that reaches target. Tiny weights are
+		#   raised first: their squares would be denormal floats, which are slow on CPU.
+		raised = weights.clamp(min=1e-15)
+		norms = (raised * raised).sum(dim=1, keepdim=True).sqrt()
+		candidates = (target <= self.nucleus_prefix ** 0.5 * norms).squeeze(1).nonzero().squeeze(1)
+		if len(candidates) > 0:
+			top_weights, top_ids = selectRows(weights, candidates).topk(min(self.nucleus_prefix, num_words), dim=1)
+			covered[candidates] = top_weights.sum(dim=1) >= target[candidates].squeeze(1)
+			# Drop a word once the words ranked above it already cover top_p; the best word always stays
+			top_weights = top_weights.masked_fill((top_weights.cumsum(dim=1) - top_weights) >= target[candidates], 0.0)
+			tokens[candidates] = self.sampleIds(top_weights, top_ids, uniforms[candidates])
+		uncovered = (~covered).nonzero().squeeze(1)
+		if len(uncovered) > 0:
+			weights = selectRows(weights, uncovered)
+			weights.masked_fill_(weights < nucleusThreshold(weights, target[uncovered]), 0.0)
+			tokens[uncovered] = self.sampleIds(weights, None, uniforms[uncovered])
+		return tokens
+
+	def __call__(self, probs):
+		# Returns (scores, tokens) like torch.max(probs, dim=1); scores are the unfiltered probabilities
+		batch_size = probs.size(0)
+		inverse_temperature = (1.0 / self.temperature.clamp(min=1e-5)).unsqueeze(1)
+		uniforms = self.uniform(batch_size, probs.device)
+		if len(self.groups) == 1:
+			tokens = self.groups[0][1](probs, inverse_temperature, uniforms, self.groups[0][0])
+		else:
+			tokens = torch.zeros(batch_size, dtype=torch.long, device=probs.device)
+			for rows, sample in self.groups:
+				tokens[rows] = sample(probs[rows], inverse_temperature[rows], uniforms[rows], rows)
+		return probs.gather(1, tokens.unsqueeze(1)).squeeze(1), tokens
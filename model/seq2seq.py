@@ -1,10 +1,16 @@
+import os
+import math
 import random
+import contextlib
 
 import torch
 import torch.nn as nn
 from torch import optim
+from torch.utils.checkpoint import checkpoint
 import torch.nn.functional as F
 
+from .profiling import stage
+
 class EncoderRNN(nn.Module):
 	def __init__(self, hidden_size, embedding, n_layers=1, dropout=0):
 		super(EncoderRNN, self).__init__()
@@ -26,11 +32,72 @@ class EncoderRNN(nn.Module):
 		outputs, hidden = self.gru(packed, hidden)
 		# Unpack padding
 		outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs)
-		# Sum bidirectional GRU outputs
-		outputs = outputs[:, :, :self.hidden_size] + outputs[:, : ,self.hidden_size:]
+		# Sum bidirectional GRU outputs into the batch-first memory (batch_size, max_length, hidden_size) that
+		#   attention reads at every decoder step; the reduction over the permuted view writes it contiguously
+		max_length, batch_size, _ = outputs.shape
+		outputs = outputs.view(max_length, batch_size, 2, self.hidden_size).permute(1, 0, 2, 3).sum(2)
 		# Return output and final hidden state
 		return outputs, hidden
 
+# Embedding through a low-rank bottleneck: rows of a (num_words, rank) table projected to hidden_size.
+#   Used when the output projection is both tied to the embedding and factorized.
+class FactorizedEmbedding(nn.Module):
+	def __init__(self, num_embeddings, embedding_dim, rank):
+		super(FactorizedEmbedding, self).__init__()
+		self.num_embeddings = num_embeddings
+		self.embedding_dim = embedding_dim
+		self.table = nn.Embedding(num_embeddings, rank)
+		self.projection = nn.Linear(rank, embedding_dim, bias=False)
+
+	def forward(self, input):
+		return self.projection(self.table(input))
+
+# Vocabulary scores W x + b of the attentional hidden state, where W (output_size x hidden_size) is
+#   - untied, full rank: its own matrix, as the nn.Linear it replaces (same state_dict keys)
+#   - untied, low rank: weight (output_size x rank) times down (rank x hidden_size)
+#   - tied, full rank: the shared embedding matrix
+#   - tied, low rank: the table times the projection of a FactorizedEmbedding
+class OutputProjection(nn.Module):
+	def __init__(self, hidden_size, output_size, embedding=None, rank=0):
+		super(OutputProjection, self).__init__()
+		self.in_features = hidden_size
+		self.out_features = output_size
+		self.rank = rank
+		self.tied = embedding is not None
+		if self.tied:
+			# The shared embedding is registered by the encoder and decoder already; kept out of this module's
+			#   tree so its weights are not saved a third time
+			self.__dict__['embedding'] = embedding
+		else:
+			if rank > 0:
+				self.down = nn.Linear(hidden_size, rank, bias=False)
+			self.weight = nn.Parameter(torch.empty(output_size, rank or hidden_size))
+			nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
+		bound = 1 / math.sqrt(rank or hidden_size)
+		self.bias = nn.Parameter(torch.empty(output_size).uniform_(-bound, bound))
+
+	# (output_size, features) matrix scored against features(x)
+	def rows(self):
+		if not self.tied:
+			return self.weight
+		return self.embedding.table.weight if self.rank > 0 else self.embedding.weight
+
+	def features(self, x):
+		if self.rank == 0:
+			return x
+		if self.tied:
+			return F.linear(x, self.embedding.projection.weight.t())
+		return self.down(x)
+
+	# Weight rows and biases of output_ids, gathered once per batch and passed to forward() as rows
+	def gather(self, output_ids):
+		return self.rows()[output_ids], self.bias[output_ids]
+
+	# With rows from gather() only those words are scored
+	def forward(self, x, rows=None):
+		weight, bias = rows if rows is not None else (self.rows(), self.bias)
+		return F.linear(self.features(x), weight, bias)
+
 # Luong attention layer
 class Attn(nn.Module):
 	def __init__(self, method, hidden_size):
@@ -44,35 +111,51 @@ class Attn(nn.Module):
 		elif self.method == 'concat':
 			self.attn = nn.Linear(self.hidden_size * 2, hidden_size)
 			self.v = nn.Parameter(torch.FloatTensor(hidden_size))
+		# Bound once, so that forward() has no per-step branching on the method name
+		self.score = getattr(self, self.method + '_score')
+ 
+	# Encoder-side projections only depend on the encoder outputs, so they are computed once per
+	#   sequence and passed back in as `keys` at every decoder step. Encoder outputs, keys and masks are
+	#   batch-first: (batch_size, max_length, hidden_size) and (batch_size, 1, max_length).
+	def precompute(self, encoder_outputs):
+		if self.method == 'general':
+			return self.attn(encoder_outputs)
+		elif self.method == 'concat':
+			# Key half of the concat projection: W[:, H:] * encoder_output + b
+			return F.linear(encoder_outputs, self.attn.weight[:, self.hidden_size:], self.attn.bias)
+		return encoder_outputs
  
-	def dot_score(self, hidden, encoder_output):
-		return torch.sum(hidden * encoder_output, dim=2)
+	# Score functions take the precomputed keys and return energies of shape (batch_size, 1, max_length),
+	#   the layout the context bmm consumes. The GRU output (1, batch_size, hidden_size) is contiguous, so
+	#   it is reshaped with views only and the hidden dimension is reduced with a single batched matmul.
+	def dot_score(self, hidden, keys):
+		return keys.bmm(hidden.view(-1, self.hidden_size, 1)).view(keys.size(0), 1, -1)
  
-	def general_score(self, hidden, encoder_output):
-		energy = self.attn(encoder_output)
-		return torch.sum(hidden * energy, dim=2)
+	def general_score(self, hidden, keys):
+		return keys.bmm(hidden.view(-1, self.hidden_size, 1)).view(keys.size(0), 1, -1)
  
-	def concat_score(self, hidden, encoder_output):
-		energy = self.attn(torch.cat((hidden.expand(encoder_output.size(0), -1, -1), encoder_output), 2)).tanh()
-		return torch.sum(self.v * energy, dim=2)
+	def concat_score(self, hidden, keys):
+		# Query half of the concat projection: W[:, :H] * hidden
+		query = F.linear(hidden.view(-1, 1, self.hidden_size), self.attn.weight[:, :self.hidden_size])
+		energy = (keys + query).tanh()
+		return torch.matmul(energy, self.v).view(keys.size(0), 1, -1)
+ 
+	def forward(self, hidden, encoder_outputs, mask=None, keys=None):
+		if keys is None:
+			keys = self.precompute(encoder_outputs)
  
-	def forward(self, hidden, encoder_outputs):
 		# Calculate the attention weights (energies) based on the given method
-		if self.method == 'general':
-			attn_energies = self.general_score(hidden, encoder_outputs)
-		elif self.method == 'concat':
-			attn_energies = self.concat_score(hidden, encoder_outputs)
-		elif self.method == 'dot':
-			attn_energies = self.dot_score(hidden, encoder_outputs)
+		attn_energies = self.score(hidden, keys)
  
-		# Transpose max_length and batch_size dimensions
-		attn_energies = attn_energies.t()
+		# Exclude PAD positions of shorter sequences from the softmax
+		if mask is not None:
+			attn_energies = attn_energies.masked_fill(~mask, float('-inf'))
  
-		# Return the softmax normalized probability scores (with added dimension)
-		return F.softmax(attn_energies, dim=1).unsqueeze(1)
+		# Return the softmax normalized probability scores, (batch_size, 1, max_length)
+		return F.softmax(attn_energies, dim=2)
 
 class LuongAttnDecoderRNN(nn.Module):
-	def __init__(self, attn_model, embedding, hidden_size, output_size, n_layers=1, dropout=0.1):
+	def __init__(self, attn_model, embedding, hidden_size, output_size, n_layers=1, dropout=0.1, tie_embedding=False, output_rank=0):
 		super(LuongAttnDecoderRNN, self).__init__()
  
 		# Keep for reference
@@ -87,11 +170,18 @@ class LuongAttnDecoderRNN(nn.Module):
 		self.embedding_dropout = nn.Dropout(dropout)
 		self.gru = nn.GRU(hidden_size, hidden_size, n_layers, dropout=(0 if n_layers == 1 else dropout))
 		self.concat = nn.Linear(hidden_size * 2, hidden_size)
-		self.out = nn.Linear(hidden_size, output_size)
+		self.out = OutputProjection(hidden_size, output_size, embedding if tie_embedding else None, output_rank)
  
 		self.attn = Attn(attn_model, hidden_size)
  
-	def forward(self, input_step, last_hidden, encoder_outputs):
+	def forward(self, input_step, last_hidden, encoder_outputs, mask=None, attn_keys=None):
+		concat_output, hidden = self.step(input_step, last_hidden, encoder_outputs, mask, attn_keys)
+		output = self.project(concat_output)
+		# Return output and final hidden state
+		return output, hidden
+
+	# Everything up to the output projection; returns the Luong attentional hidden state
+	def step(self, input_step, last_hidden, encoder_outputs, mask=None, attn_keys=None):
 		# Note: we run this one step (word) at a time
 		# Get embedding of current input word
 		embedded = self.embedding(input_step)
@@ -99,19 +189,52 @@ class LuongAttnDecoderRNN(nn.Module):
 		# Forward through unidirectional GRU
 		rnn_output, hidden = self.gru(embedded, last_hidden)
 		# Calculate attention weights from the current GRU output
-		attn_weights = self.attn(rnn_output, encoder_outputs)
+		attn_weights = self.attn(rnn_output, encoder_outputs, mask, attn_keys)
 		# Multiply attention weights to encoder outputs to get new "weighted sum" context vector
-		context = attn_weights.bmm(encoder_outputs.transpose(0, 1))
+		context = attn_weights.bmm(encoder_outputs)
 		# Concatenate weighted context vector and GRU output using Luong eq. 5
 		rnn_output = rnn_output.squeeze(0)
 		context = context.squeeze(1)
 		concat_input = torch.cat((rnn_output, context), 1)
 		concat_output = torch.tanh(self.concat(concat_input))
-		# Predict next word using Luong eq. 6
-		output = self.out(concat_output)
-		output = F.softmax(output, dim=1)
-		# Return output and final hidden state
-		return output, hidden
+		return concat_output, hidden
+
+	# Teacher-forced pass over several inputs (steps, batch_size) starting from last_hidden. The GRU runs one
+	#   layer at a time over all steps, which keeps the hidden state of every layer after every input;
+	#   attention and the concat layer then run once for all steps, folded into the batch dimension. Returns
+	#   the attentional hidden states (steps, batch_size, hidden_size) and the GRU hidden states
+	#   (steps, n_layers, batch_size, hidden_size).
+	def stepSequence(self, input_seq, last_hidden, encoder_outputs, mask=None, attn_keys=None):
+		steps, batch_size = input_seq.shape
+		rnn_output = self.embedding_dropout(self.embedding(input_seq))
+		hiddens = []
+		for layer in range(self.n_layers):
+			if layer > 0:
+				rnn_output = F.dropout(rnn_output, self.gru.dropout, self.training)
+			# Single-layer GRU over the parameters of this layer of self.gru
+			weights = [getattr(self.gru, name) for name in self.gru._all_weights[layer]]
+			rnn_output, _ = torch.gru(rnn_output, last_hidden[layer : layer + 1], weights, True, 1, 0.0, self.training, False, False)
+			hiddens.append(rnn_output)
+		rnn_output = rnn_output.view(1, steps * batch_size, -1)
+		if attn_keys is None:
+			attn_keys = self.attn.precompute(encoder_outputs)
+		encoder_outputs = encoder_outputs.repeat(steps, 1, 1)
+		mask = mask.repeat(steps, 1, 1) if mask is not None else None
+		attn_weights = self.attn(rnn_output, encoder_outputs, mask, attn_keys.repeat(steps, 1, 1))
+		context = attn_weights.bmm(encoder_outputs)
+		concat_input = torch.cat((rnn_output.squeeze(0), context.squeeze(1)), 1)
+		concat_output = torch.tanh(self.concat(concat_input))
+		return concat_output.view(steps, batch_size, -1), torch.stack(hiddens, dim=1)
+
+	# Predict next word using Luong eq. 6. With output rows from self.out.gather() only those words
+	#   are scored and the softmax is taken over that subset.
+	def project(self, concat_output, output_rows=None):
+		output = self.out(concat_output, output_rows)
+		return F.softmax(output, dim=1)
+
+def lengthMask(lengths, max_length):
+	# Boolean (batch_size, max_length) mask which is True for valid (non-PAD) encoder positions
+	return torch.arange(max_length, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
 
 def maskNLLLoss(inp, target, mask):
 	nTotal = mask.sum()
@@ -119,6 +242,28 @@ def maskNLLLoss(inp, target, mask):
 	loss = crossEntropy.masked_select(mask).mean()
 	return loss, nTotal.item()
 
+def maskKLLoss(inp, teacher, mask, temperature=1.0):
+	# KL(teacher || student) over the vocabulary, averaged over the unmasked rows. Both inputs are
+	#   softmax outputs, so they are softened by re-normalizing their log-probabilities / temperature;
+	#   the temperature ** 2 factor keeps gradient magnitudes comparable across temperatures.
+	log_inp = F.log_softmax(torch.log(inp.clamp_min(1e-30)) / temperature, dim=1)
+	log_teacher = F.log_softmax(torch.log(teacher.clamp_min(1e-30)) / temperature, dim=1)
+	kl = (log_teacher.exp() * (log_teacher - log_inp)).sum(1)
+	return kl.masked_select(mask).mean() * temperature ** 2
+
+def replaceOptimizerParameter(optimizer, old_param, new_param):
+	# Swap a parameter that grew along dim 0, zero-padding its per-parameter state (e.g. Adam moments)
+	for group in optimizer.param_groups:
+		group['params'] = [new_param if param is old_param else param for param in group['params']]
+	if old_param in optimizer.state:
+		state = optimizer.state.pop(old_param)
+		for key, value in state.items():
+			if torch.is_tensor(value) and value.shape == old_param.shape:
+				padded = value.new_zeros(new_param.shape)
+				padded[:value.size(0)] = value
+				state[key] = padded
+		optimizer.state[new_param] = state
+
 class Seq2SeqModel(nn.Module):
 	def __init__(self, 
 		device,
@@ -129,76 +274,330 @@ class Seq2SeqModel(nn.Module):
 		encoder_n_layers=2, decoder_n_layers=2, 
 		dropout=0.1,
 		learning_rate=0.0001,
-		decoder_learning_ratio=5.0):
+		decoder_learning_ratio=5.0,
+		tie_embedding=False,
+		output_rank=0,
+		inference=False):
 
 		super().__init__()
 
 		self.device = device
 		self.SOS_token = SOS_token
+		# Architecture hyperparameters, stored in checkpoints so the model can be rebuilt without the corpus
+		self.config = {
+			'num_words': num_words,
+			'attn_model': attn_model,
+			'hidden_size': hidden_size,
+			'encoder_n_layers': encoder_n_layers,
+			'decoder_n_layers': decoder_n_layers,
+			'dropout': dropout,
+			'tie_embedding': tie_embedding,
+			'output_rank': output_rank,
+		}
 
-		embedding = nn.Embedding(num_words, hidden_size)
+		# A tied low-rank output projection shares the factors of a factorized embedding
+		if tie_embedding and output_rank > 0:
+			embedding = FactorizedEmbedding(num_words, hidden_size, output_rank)
+		else:
+			embedding = nn.Embedding(num_words, hidden_size)
 		self.encoder = EncoderRNN(hidden_size, embedding, encoder_n_layers, dropout)
-		self.decoder = LuongAttnDecoderRNN(attn_model, embedding, hidden_size, num_words, decoder_n_layers, dropout)
+		self.decoder = LuongAttnDecoderRNN(attn_model, embedding, hidden_size, num_words, decoder_n_layers, dropout,
+			tie_embedding, output_rank)
 
-		self.encoder_optimizer = optim.Adam(self.encoder.parameters(), lr=learning_rate)
-		self.decoder_optimizer = optim.Adam(self.decoder.parameters(), lr=learning_rate * decoder_learning_ratio)
+		# Inference models have no optimizers: they would keep references to the initial parameters after
+		#   load_state_dict(assign=True) replaces them
+		self.encoder_optimizer = None if inference else optim.Adam(self.encoder.parameters(), lr=learning_rate)
+		self.decoder_optimizer = None if inference else optim.Adam(self.decoder.parameters(), lr=learning_rate * decoder_learning_ratio)
 
-	def optimize(self, inputs, lengths, targets, mask, max_target_len,
-		teacher_forcing_ratio=0.5, clip=50.0):
-		self.encoder_optimizer.zero_grad()
-		self.decoder_optimizer.zero_grad()
+		# Optional StageProfiler recording per-stage wall times of optimize()
+		self.profiler = None
+
+		# Decoder timesteps per activation checkpoint in training (0: keep all activations for backward)
+		self.checkpoint_steps = 0
+
+		# Knowledge distillation settings, see distillFrom()
+		self.distill_alpha = 0.5
+		self.distill_temperature = 1.0
+
+		# Gradient accumulation state: micro-batches and target tokens since the last optimizer step
+		self.accumulated_batches = 0
+		self.accumulated_tokens = 0
+		self.accumulated_token_sum = False
+		self.accumulated_synced = True
 
-		encoder_outputs, encoder_hidden = self.encoder(inputs, lengths)
+	def distribute(self, **kwargs):
+		# Wrap in DistributedDataParallel for multi-process training; the wrapper is kept out of
+		#   the module tree (and therefore out of state_dict) by bypassing nn.Module.__setattr__
+		self.__dict__['ddp'] = nn.parallel.DistributedDataParallel(self, **kwargs)
 
-		decoder_input = torch.LongTensor([[self.SOS_token for _ in range(inputs.shape[1])]])
-		decoder_input = decoder_input.to(self.device)
+	# Opt-in torch.compile execution of the encoder and of single decoder steps, used by forward() (and so
+	#   optimize()) and evaluate(); shortlisted decoding stays eager. Shapes are compiled dynamically, so one
+	#   graph covers all batch sizes and lengths greater than 1. As with the DDP wrapper, the compiled
+	#   modules are kept out of the module tree and state_dict.
+	# cache: directory for the compiled kernels, kept across runs so that later processes load rather than
+	#   rebuild them (by default they go to a temporary directory)
+	def compileSteps(self, mode=None, cache=None):
+		if cache is not None:
+			os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache)
+		# Trace through the decoder GRU instead of breaking the graph around it. The encoder's packed GRU still
+		#   runs eagerly between its compiled parts, since dynamo does not trace pack_padded_sequence.
+		torch._dynamo.config.allow_rnn = True
+		self.__dict__['compiled_encoder'] = torch.compile(self.encoder, mode=mode, dynamic=True)
+		self.__dict__['compiled_decoder'] = torch.compile(self.decoder, mode=mode, dynamic=True)
 
-		decoder_hidden = encoder_hidden[:self.decoder.n_layers]
+	# Compile evaluate() ahead of the first request. Sizes of 1 are specialized by the compiler, so batch sizes
+	#   and input lengths of 1 and of more than 1 are all visited.
+	def warmup(self, batch_sizes=(1, 2), input_lengths=(1, 2), max_length=2):
+		with torch.no_grad():
+			for batch_size in batch_sizes:
+				for input_length in input_lengths:
+					input_seq = torch.full((input_length, batch_size), self.SOS_token, device=self.device, dtype=torch.long)
+					self.evaluate(input_seq, torch.full((batch_size,), input_length, dtype=torch.long), max_length, EOS_token=None)
+
+	# Train on the soft targets of a (larger) teacher sharing the vocabulary: in training mode the loss becomes
+	#   alpha * KL(teacher || student) + (1 - alpha) * NLL. Like the DDP wrapper, the teacher is kept out of
+	#   the module tree so that it is neither optimized nor saved with the student.
+	def distillFrom(self, teacher, alpha=0.5, temperature=1.0):
+		if teacher.config['num_words'] != self.config['num_words']:
+			raise ValueError(teacher.config['num_words'], "teacher vocabulary size differs from the student's")
+		teacher.eval()
+		self.__dict__['teacher'] = teacher
+		self.distill_alpha = alpha
+		self.distill_temperature = temperature
+
+	# Computes the training loss of one batch; called through the DDP wrapper when distributed
+	# With token_sum the returned loss is the sum of the per-token losses instead of the sum of per-step means
+	def forward(self, inputs, lengths, targets, mask, max_target_len, teacher_forcing_ratio=0.5, token_sum=False):
+		# The printed loss stays the NLL of the targets; evaluation mode ignores the teacher
+		teacher = self.__dict__.get('teacher') if self.training else None
+		with stage(self.profiler, 'encoder'):
+			encoder_outputs, encoder_hidden = self.__dict__.get('compiled_encoder', self.encoder)(inputs, lengths)
+			attn_mask = lengthMask(lengths.to(self.device), encoder_outputs.size(1)).unsqueeze(1)
+			attn_keys = self.decoder.attn.precompute(encoder_outputs)
+
+		if teacher is not None:
+			with stage(self.profiler, 'teacher_encoder'), torch.no_grad():
+				teacher_outputs, teacher_hidden = teacher.encoder(inputs, lengths)
+				teacher_keys = teacher.decoder.attn.precompute(teacher_outputs)
+				teacher_hidden = teacher_hidden[:teacher.decoder.n_layers]
+
+		decoder_input = torch.full((1, inputs.size(1)), self.SOS_token, device=self.device, dtype=torch.long)
+
+		# A copy rather than a view, like the hidden states of later steps, so compiled decoder steps are not recompiled
+		decoder_hidden = encoder_hidden[:self.decoder.n_layers].clone()
 		use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
+		if teacher is None:
+			teacher_outputs, teacher_hidden, teacher_keys = None, None, None
 
 		loss = 0
-		print_losses = []
-		n_totals = 0
+		print_loss = 0.0
+
+		with stage(self.profiler, 'decoder'):
+			# With checkpoint_steps, only the loss and the decoder state at chunk boundaries are kept for backward;
+			#   the activations inside a chunk (e.g. its batch_size x num_words softmax outputs) are recomputed
+			chunk_steps = self.checkpoint_steps if self.checkpoint_steps > 0 and torch.is_grad_enabled() else max_target_len
+			for start in range(0, max_target_len, chunk_steps):
+				end = min(start + chunk_steps, max_target_len)
+				chunk = (start, end, use_teacher_forcing, token_sum, decoder_input, decoder_hidden, teacher_hidden,
+					encoder_outputs, attn_mask, attn_keys, teacher_outputs, teacher_keys, targets, mask)
+				if chunk_steps < max_target_len:
+					chunk_loss, chunk_print_loss, decoder_input, decoder_hidden, teacher_hidden = checkpoint(
+						self.decodeSteps, *chunk, use_reentrant=False)
+				else:
+					chunk_loss, chunk_print_loss, decoder_input, decoder_hidden, teacher_hidden = self.decodeSteps(*chunk)
+				loss += chunk_loss
+				print_loss += chunk_print_loss
+
+		return loss, print_loss, mask[:max_target_len].sum().item()
 
-		if use_teacher_forcing:
-			for t in range(max_target_len):
-				decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs)
+	# Decoder steps start to end of forward(); returns their loss, the summed per-token NLL for printing,
+	#   and the decoder input and hidden states (of the student and the teacher) to continue from
+	def decodeSteps(self, start, end, use_teacher_forcing, token_sum, decoder_input, decoder_hidden, teacher_hidden,
+		encoder_outputs, attn_mask, attn_keys, teacher_outputs, teacher_keys, targets, mask):
+		teacher = self.__dict__.get('teacher') if self.training else None
+		decoder = self.__dict__.get('compiled_decoder', self.decoder)
+		loss = 0
+		print_losses = []
+		for t in range(start, end):
+			decoder_output, decoder_hidden = decoder(decoder_input, decoder_hidden, encoder_outputs, attn_mask, attn_keys)
+			if teacher is not None:
+				# Without teacher forcing the teacher is fed the student's own predictions, so it scores the states the student visits
+				with torch.no_grad():
+					teacher_output, teacher_hidden = teacher.decoder(decoder_input, teacher_hidden, teacher_outputs, attn_mask, teacher_keys)
+			if use_teacher_forcing:
 				decoder_input = targets[t].view(1, -1)
-				mask_loss, nTotal = maskNLLLoss(decoder_output, targets[t], mask[t])
-				loss += mask_loss
-				print_losses.append(mask_loss.item() * nTotal)
-				n_totals += nTotal
-		else:
-			for t in range(max_target_len):
-				decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs)
+			else:
 				_, topi = decoder_output.topk(1)
-				decoder_input = torch.LongTensor([[topi[i][0] for i in range(inputs.shape[1])]])
-				decoder_input = decoder_input.to(self.device)
-				mask_loss, nTotal = maskNLLLoss(decoder_output, targets[t], mask[t])
-				loss += mask_loss
-				print_losses.append(mask_loss.item() * nTotal)
-				n_totals += nTotal
-
-		loss.backward()
+				decoder_input = topi.view(1, -1)
+			mask_loss, nTotal = maskNLLLoss(decoder_output, targets[t], mask[t])
+			step_loss = mask_loss if teacher is None else self.distillationLoss(decoder_output, teacher_output, mask_loss, mask[t])
+			loss += step_loss * nTotal if token_sum else step_loss
+			print_losses.append(mask_loss.item() * nTotal)
+		return loss, sum(print_losses), decoder_input, decoder_hidden, teacher_hidden
+
+	def distillationLoss(self, decoder_output, teacher_output, nll_loss, mask):
+		kl_loss = maskKLLoss(decoder_output, teacher_output, mask, self.distill_temperature)
+		return self.distill_alpha * kl_loss + (1 - self.distill_alpha) * nll_loss
+
+	def optimize(self, inputs, lengths, targets, mask, max_target_len,
+		teacher_forcing_ratio=0.5, clip=50.0, accumulation_steps=1):
+		if self.accumulated_batches == 0:
+			self.encoder_optimizer.zero_grad()
+			self.decoder_optimizer.zero_grad()
+
+		# When accumulating, losses are summed per token and normalized by the total token count in step()
+		token_sum = accumulation_steps > 1
+		model = self.__dict__.get('ddp', self)
+		# Under DDP, gradients are only all-reduced on the last micro-batch of an accumulation cycle
+		last = self.accumulated_batches + 1 >= accumulation_steps
+		with (model.no_sync() if model is not self and not last else contextlib.nullcontext()):
+			loss, print_loss, n_totals = model(inputs, lengths, targets, mask, max_target_len, teacher_forcing_ratio, token_sum)
+
+			with stage(self.profiler, 'backward'):
+				loss.backward()
+
+		self.accumulated_batches += 1
+		self.accumulated_tokens += n_totals
+		self.accumulated_token_sum = token_sum
+		self.accumulated_synced = model is self or last
+		if last:
+			self.step(clip)
+
+		if self.profiler is not None:
+			self.profiler.addTokens('input_tokens', lengths.sum().item())
+			self.profiler.addTokens('target_tokens', n_totals)
+
+		return print_loss / n_totals
+
+	# Apply the accumulated gradients; optimize() calls this itself, but a partial accumulation
+	#   cycle (e.g. at the end of an epoch) has to be flushed explicitly
+	def step(self, clip=50.0):
+		if self.accumulated_batches == 0:
+			return
+
+		if not self.accumulated_synced:
+			# Flushing a partial cycle under DDP: average the gradients that no_sync() held back
+			world_size = torch.distributed.get_world_size()
+			for param in self.parameters():
+				if param.grad is not None:
+					torch.distributed.all_reduce(param.grad)
+					param.grad.div_(world_size)
+
+		if self.accumulated_token_sum:
+			for param in self.parameters():
+				if param.grad is not None:
+					param.grad.div_(self.accumulated_tokens)
 	 
-		_ = nn.utils.clip_grad_norm_(self.encoder.parameters(), clip)
-		_ = nn.utils.clip_grad_norm_(self.decoder.parameters(), clip)
-
-		self.encoder_optimizer.step()
-		self.decoder_optimizer.step()
-
-		return sum(print_losses) / n_totals
-
-	def evaluate(self, input_seq, input_length, max_length):
-		encoder_outputs, encoder_hidden = self.encoder(input_seq, input_length)
-		decoder_hidden = encoder_hidden[:self.decoder.n_layers]
-		decoder_input = torch.ones(1, 1, device=self.device, dtype=torch.long) * self.SOS_token
-		all_tokens = torch.zeros([0], device=self.device, dtype=torch.long)
-		all_scores = torch.zeros([0], device=self.device)
-		for _ in range(max_length):
-			decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs)
-			decoder_scores, decoder_input = torch.max(decoder_output, dim=1)
-			all_tokens = torch.cat((all_tokens, decoder_input), dim=0)
-			all_scores = torch.cat((all_scores, decoder_scores), dim=0)
+		with stage(self.profiler, 'clip'):
+			_ = nn.utils.clip_grad_norm_(self.encoder.parameters(), clip)
+			_ = nn.utils.clip_grad_norm_(self.decoder.parameters(), clip)
+
+		with stage(self.profiler, 'encoder_optimizer'):
+			self.encoder_optimizer.step()
+		with stage(self.profiler, 'decoder_optimizer'):
+			self.decoder_optimizer.step()
+
+		self.accumulated_batches = 0
+		self.accumulated_tokens = 0
+
+	# Grow the shared embedding and the output projection to num_words for an extended Voc.
+	#   Existing rows, and the Adam moments of existing rows, are kept; new rows get the
+	#   default initialization of nn.Embedding / nn.Linear and empty optimizer state.
+	def resizeVocab(self, num_words):
+		old_words = self.config['num_words']
+		if num_words < old_words:
+			raise ValueError(num_words, "is smaller than the current vocabulary.")
+		if num_words == old_words:
+			return
+
+		embedding = self.encoder.embedding
+		out = self.decoder.out
+		# (module, parameter name, initialization of the new rows); tied output rows grow with the embedding
+		table = embedding.table if isinstance(embedding, FactorizedEmbedding) else embedding
+		bound = 1 / math.sqrt(out.rank or out.in_features)
+		grow = [(table, 'weight', nn.init.normal_)]
+		if not out.tied:
+			grow.append((out, 'weight', lambda rows: nn.init.uniform_(rows, -bound, bound)))
+		grow.append((out, 'bias', lambda rows: nn.init.uniform_(rows, -bound, bound)))
+
+		for module, name, init in grow:
+			old_param = getattr(module, name)
+			with torch.no_grad():
+				value = old_param.new_empty((num_words,) + old_param.shape[1:])
+				value[:old_words] = old_param
+				init(value[old_words:])
+			new_param = nn.Parameter(value)
+			setattr(module, name, new_param)
+			# The shared embedding is registered with both optimizers
+			for optimizer in [self.encoder_optimizer, self.decoder_optimizer]:
+				replaceOptimizerParameter(optimizer, old_param, new_param)
+
+		table.num_embeddings = num_words
+		embedding.num_embeddings = num_words
+		out.out_features = num_words
+		self.decoder.output_size = num_words
+		self.config['num_words'] = num_words
+
+	# sampler: optional model.sampling.Sampler replacing greedy torch.max selection
+	# Decoding stops once every row has produced EOS_token (None always runs max_length steps).
+	#   Returns tokens and scores of shape (steps, batch_size), PAD (0) after the end of each row,
+	#   and the length of each reply including its EOS.
+	def evaluate(self, input_seq, input_length, max_length, shortlist=None, sampler=None, EOS_token=2):
+		encoder_outputs, encoder_hidden = self.__dict__.get('compiled_encoder', self.encoder)(input_seq, input_length)
+		decoder = self.__dict__.get('compiled_decoder', self.decoder)
+		attn_mask = lengthMask(input_length.to(self.device), encoder_outputs.size(1)).unsqueeze(1)
+		attn_keys = self.decoder.attn.precompute(encoder_outputs)
+		# A copy rather than a view, like the hidden states of later steps, so compiled decoder steps are not recompiled
+		decoder_hidden = encoder_hidden[:self.decoder.n_layers].clone()
+		# Restrict the output projection to the shortlist candidates of this batch (see model.shortlist)
+		output_ids = shortlist.candidates(input_seq) if shortlist is not None else None
+		# Their projection rows are copied once here rather than at every step
+		output_rows = self.decoder.out.gather(output_ids) if output_ids is not None else None
+		batch_size = input_seq.size(1)
+		decoder_input = torch.full((1, batch_size), self.SOS_token, device=self.device, dtype=torch.long)
+		# Output buffers are allocated once for the longest possible reply and trimmed at the end
+		all_tokens = torch.zeros(max_length, batch_size, device=self.device, dtype=torch.long)
+		all_scores = torch.zeros(max_length, batch_size, device=self.device)
+		lengths = torch.full((batch_size,), max_length, device=self.device, dtype=torch.long)
+		finished = torch.zeros(batch_size, device=self.device, dtype=torch.bool)
+		steps = max_length
+		for t in range(max_length):
+			if output_ids is None:
+				decoder_output, decoder_hidden = decoder(decoder_input, decoder_hidden, encoder_outputs, attn_mask, attn_keys)
+				decoder_scores, decoder_input = sampler(decoder_output) if sampler is not None else torch.max(decoder_output, dim=1)
+			else:
+				decoder_scores, decoder_input, decoder_hidden = self.shortlistStep(
+					shortlist, output_ids, output_rows, decoder_input, decoder_hidden, encoder_outputs, attn_mask, attn_keys, sampler)
+			all_tokens[t] = decoder_input
+			all_scores[t] = decoder_scores
+			if EOS_token is not None:
+				eos = decoder_input == EOS_token
+				lengths.masked_fill_(eos & ~finished, t + 1)
+				finished |= eos
+				if finished.all():
+					steps = t + 1
+					break
 			decoder_input = torch.unsqueeze(decoder_input, 0)
-		return all_tokens, all_scores
+		all_tokens, all_scores = all_tokens[:steps], all_scores[:steps]
+		# Rows that finished earlier kept decoding alongside the others; blank what they produced after EOS
+		ended = torch.arange(steps, device=self.device).unsqueeze(1) >= lengths.unsqueeze(0)
+		return all_tokens.masked_fill_(ended, 0), all_scores.masked_fill_(ended, 0.0), lengths
+
+	def shortlistStep(self, shortlist, output_ids, output_rows, decoder_input, decoder_hidden, encoder_outputs, attn_mask, attn_keys, sampler=None):
+		concat_output, decoder_hidden = self.decoder.step(decoder_input, decoder_hidden, encoder_outputs, attn_mask, attn_keys)
+		decoder_output = self.decoder.project(concat_output, output_rows)
+		if sampler is not None:
+			# Sampled words are drawn from the shortlist only; the confidence fallback applies to greedy decoding
+			decoder_scores, positions = sampler(decoder_output)
+			return decoder_scores, output_ids[positions], decoder_hidden
+		decoder_scores, positions = torch.max(decoder_output, dim=1)
+		decoder_input = output_ids[positions]
+		# Rows whose best shortlisted word is not confident enough are rescored over the full vocabulary
+		fallback = decoder_scores < shortlist.fallback_threshold
+		shortlist.steps += fallback.size(0)
+		if fallback.any():
+			full_scores, full_input = torch.max(self.decoder.project(concat_output[fallback]), dim=1)
+			decoder_scores = decoder_scores.masked_scatter(fallback, full_scores)
+			decoder_input = decoder_input.masked_scatter(fallback, full_input)
+			shortlist.fallbacks += fallback.sum().item()
+		return decoder_scores, decoder_input, decoder_hidden
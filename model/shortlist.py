@@ -0,0 +1,79 @@
+import torch
+
+# Output vocabulary shortlist for faster decoding: the top_k most frequent words plus, for every
+#   input word, the per_word output words that co-occurred with it most often in training pairs.
+#   EOS is always a candidate.
+# Probabilities over the shortlist are normalized over the candidates only, so a word outside it can be the
+#   full-vocabulary argmax even when the best candidate looks likely. By default a row is only decoded on the
+#   shortlist when its best candidate holds the majority of the candidates' probability.
+DEFAULT_FALLBACK_THRESHOLD = 0.5
+
+class Shortlist():
+	def __init__(self, frequent, table, EOS_token=2, fallback_threshold=DEFAULT_FALLBACK_THRESHOLD):
+		self.frequent = frequent
+		# (num_words, per_word) co-occurrence table of output ids, padded with -1
+		self.table = table
+		self.EOS_token = EOS_token
+		# Rows whose best shortlisted probability is below this are rescored over the full vocabulary (0: never)
+		self.fallback_threshold = fallback_threshold
+		# Decoding statistics: scored rows and rows that fell back to the full vocabulary
+		self.steps = 0
+		self.fallbacks = 0
+
+	def to(self, device):
+		self.frequent = self.frequent.to(device)
+		self.table = self.table.to(device)
+		return self
+
+	def candidates(self, input_seq):
+		# Sorted candidate ids shared by every sentence of the batch
+		input_ids = torch.unique(input_seq)
+		per_input = self.table[input_ids].flatten()
+		eos = torch.tensor([self.EOS_token], device=self.frequent.device)
+		return torch.unique(torch.cat((self.frequent, per_input[per_input >= 0], eos)))
+
+	def state_dict(self):
+		return {'frequent': self.frequent.cpu(), 'table': self.table.cpu(), 'EOS_token': self.EOS_token}
+
+	@staticmethod
+	def fromState(state, fallback_threshold=DEFAULT_FALLBACK_THRESHOLD):
+		return Shortlist(state['frequent'], state['table'], state['EOS_token'], fallback_threshold)
+
+def mergeCounts(keys, counts, new_keys):
+	keys, inverse = torch.unique(torch.cat((keys, torch.tensor(new_keys, dtype=torch.long))), return_inverse=True)
+	merged = torch.zeros(keys.size(0), dtype=torch.long)
+	merged.index_add_(0, inverse, torch.cat((counts, torch.ones(len(new_keys), dtype=torch.long))))
+	return keys, merged
+
+def buildShortlist(voc, pairs, top_k=2000, per_word=20, EOS_token=2, chunk_size=1000000):
+	num_words = voc.num_words
+	frequent = sorted(voc.word2count.items(), key=lambda x: -x[1])[:top_k]
+	frequent = torch.tensor([voc.word2index[word] for word, _ in frequent], dtype=torch.long)
+
+	# Count (input word, output word) co-occurrences as input_id * num_words + output_id keys,
+	#   merging chunk by chunk so memory is bounded by the number of distinct word pairs
+	keys = torch.zeros(0, dtype=torch.long)
+	counts = torch.zeros(0, dtype=torch.long)
+	chunk = []
+	for pair in pairs:
+		input_ids = set(voc.word2index[word] for word in pair[0].split(' '))
+		output_ids = set(voc.word2index[word] for word in pair[1].split(' '))
+		chunk.extend(i * num_words + o for i in input_ids for o in output_ids)
+		if len(chunk) >= chunk_size:
+			keys, counts = mergeCounts(keys, counts, chunk)
+			chunk = []
+	if chunk:
+		keys, counts = mergeCounts(keys, counts, chunk)
+
+	# Keep the per_word most frequent outputs of every input word
+	order = torch.argsort(counts, descending=True, stable=True)
+	keys = keys[order]
+	inputs = keys // num_words
+	order = torch.argsort(inputs, stable=True)
+	inputs, outputs = inputs[order], keys[order] % num_words
+	rank = torch.arange(inputs.size(0)) - torch.searchsorted(inputs, inputs)
+	keep = rank < per_word
+
+	table = torch.full((num_words, per_word), -1, dtype=torch.long)
+	table[inputs[keep], rank[keep]] = outputs[keep]
+	return Shortlist(frequent, table, EOS_token)
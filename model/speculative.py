@@ -0,0 +1,108 @@
+import torch
+
+from .seq2seq import lengthMask
+
+# Greedy speculative decoding: a small draft Seq2SeqModel sharing the vocabulary proposes k tokens, and
+#   the target model scores all of them in one teacher-forced pass (LuongAttnDecoderRNN.stepSequence).
+#   The longest prefix matching the target's own greedy choices is accepted together with the target's
+#   next token, so the output is the target's greedy output. Sentences of a batch advance in lockstep
+#   by the shortest accepted prefix among the unfinished ones.
+class SpeculativeDecoder():
+	def __init__(self, model, draft, k=4):
+		if draft.config['num_words'] != model.config['num_words']:
+			raise ValueError(draft.config['num_words'], "draft vocabulary size differs from the model's")
+		self.model = model
+		self.draft = draft
+		self.k = k
+		self.device = model.device
+		# Decoding statistics: drafted tokens, drafted tokens accepted, and target verification passes
+		self.proposed = 0
+		self.accepted = 0
+		self.passes = 0
+
+	def reset(self):
+		self.proposed = 0
+		self.accepted = 0
+		self.passes = 0
+
+	def acceptanceRate(self):
+		return self.accepted / self.proposed if self.proposed > 0 else 0.0
+
+	def encode(self, model, input_seq, input_length):
+		encoder_outputs, encoder_hidden = model.encoder(input_seq, input_length)
+		attn_keys = model.decoder.attn.precompute(encoder_outputs)
+		return encoder_outputs, attn_keys, encoder_hidden[:model.decoder.n_layers]
+
+	# Same arguments and return values as Seq2SeqModel.evaluate; only greedy decoding is supported
+	def evaluate(self, input_seq, input_length, max_length, shortlist=None, sampler=None, EOS_token=2):
+		if shortlist is not None or sampler is not None:
+			raise ValueError("speculative decoding only supports greedy decoding over the full vocabulary")
+		model, draft, device = self.model, self.draft, self.device
+		encoder_outputs, attn_keys, hidden = self.encode(model, input_seq, input_length)
+		draft_outputs, draft_keys, draft_hidden = self.encode(draft, input_seq, input_length)
+		attn_mask = lengthMask(input_length.to(device), encoder_outputs.size(1)).unsqueeze(1)
+
+		batch_size = input_seq.size(1)
+		decoder_input = torch.full((1, batch_size), model.SOS_token, device=device, dtype=torch.long)
+		all_tokens = torch.zeros(max_length, batch_size, device=device, dtype=torch.long)
+		all_scores = torch.zeros(max_length, batch_size, device=device)
+		lengths = torch.full((batch_size,), max_length, device=device, dtype=torch.long)
+		finished = torch.zeros(batch_size, device=device, dtype=torch.bool)
+		# Last proposal of a fully accepted pass, which the draft has not consumed yet
+		pending = None
+		t = 0
+		while t < max_length:
+			# Draft n tokens greedily; with room for more, the target pass also yields a bonus token
+			n = min(self.k, max_length - t)
+			draft_input, draft_hiddens, proposals = decoder_input, [], []
+			for _ in range(n):
+				if pending is not None:
+					# Consume the pending proposal and the target's bonus token in one pass
+					concat_output, pending_hiddens = draft.decoder.stepSequence(torch.cat([pending, draft_input]), draft_hidden,
+						draft_outputs, attn_mask, draft_keys)
+					draft_output, draft_hidden, pending = draft.decoder.project(concat_output[-1]), pending_hiddens[-1], None
+				else:
+					draft_output, draft_hidden = draft.decoder(draft_input, draft_hidden, draft_outputs, attn_mask, draft_keys)
+				draft_input = torch.max(draft_output, dim=1)[1].unsqueeze(0)
+				draft_hiddens.append(draft_hidden)
+				proposals.append(draft_input)
+			verify_steps = min(n + 1, max_length - t)
+			inputs = torch.cat([decoder_input] + proposals[:verify_steps - 1])
+
+			concat_output, hiddens = model.decoder.stepSequence(inputs, hidden, encoder_outputs, attn_mask, attn_keys)
+			decoder_output = model.decoder.project(concat_output.view(verify_steps * batch_size, -1))
+			scores, tokens = torch.max(decoder_output.view(verify_steps, batch_size, -1), dim=2)
+
+			# Accepted drafts: the leading positions where the target agrees, over all unfinished rows
+			matches = (tokens[:n] == torch.cat(proposals)) | finished.unsqueeze(0)
+			accepted = int(matches.all(dim=1).long().cumprod(0).sum())
+			emitted = min(accepted + 1, verify_steps)
+			self.proposed += n
+			self.accepted += accepted
+			self.passes += 1
+
+			all_tokens[t : t + emitted] = tokens[:emitted]
+			all_scores[t : t + emitted] = scores[:emitted]
+			# Both models continue from the state after the last emitted input, i.e. inputs[:emitted]
+			hidden = hiddens[emitted - 1]
+			if emitted <= n:
+				draft_hidden = draft_hiddens[emitted - 1]
+			else:
+				# Every draft was accepted: the draft catches up on its own last proposal in the next pass
+				draft_hidden, pending = draft_hiddens[-1], proposals[-1]
+			decoder_input = tokens[emitted - 1].unsqueeze(0)
+
+			if EOS_token is not None:
+				eos = tokens[:emitted] == EOS_token
+				positions = torch.arange(t + 1, t + emitted + 1, device=device).unsqueeze(1)
+				first = torch.where(eos, positions, max_length + 1).min(dim=0)[0]
+				lengths = torch.where(~finished & eos.any(dim=0), first, lengths)
+				finished |= eos.any(dim=0)
+			t += emitted
+			if EOS_token is not None and finished.all():
+				break
+		# A pass can emit tokens past the EOS of the last row to finish; evaluate() would have stopped there
+		steps = int(lengths.max()) if EOS_token is not None and finished.all() else t
+		all_tokens, all_scores = all_tokens[:steps], all_scores[:steps]
+		ended = torch.arange(steps, device=device).unsqueeze(1) >= lengths.unsqueeze(0)
+		return all_tokens.masked_fill_(ended, 0), all_scores.masked_fill_(ended, 0.0), lengths
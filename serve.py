@@ -0,0 +1,307 @@
+import os
+import gc
+import sys
+import json
+import time
+import queue
+import random
+import signal
+import socket
+import argparse
+import threading
+import multiprocessing as mp
+
+import torch
+
+from inference import loadInferenceCheckpoint, buildInferenceModel, evaluateBatch
+
+# Pre-fork inference server. The model and vocabulary are loaded once in the parent, either memory-mapped
+#   from the checkpoint file (page cache) or moved to shared memory, and N forked workers use them without
+#   copying. Each worker is pinned to its own set of cores with a matching intra-op thread count, and
+#   takes requests from a shared queue, so idle workers pick up the next request (least-loaded balancing).
+#   Requests that are waiting together are decoded as one batch of up to max_batch sentences.
+#   With compile_cache, the model runs through torch.compile and is compiled in the parent before forking,
+#   so neither the workers nor their first requests pay for compilation.
+
+def memoryUsage(pid):
+	# Resident memory of a process in MB (Linux): rss counts shared pages in full, pss divides them among
+	#   the processes mapping them, shared/private split rss by whether another process maps the page
+	usage = {}
+	try:
+		with open('/proc/%d/smaps_rollup' % (pid)) as f:
+			for line in f:
+				fields = line.split()
+				if len(fields) == 3 and fields[2] == 'kB':
+					usage[fields[0].rstrip(':')] = int(fields[1]) / 1024
+	except OSError:
+		return {}
+	return {
+		'rss_mb': usage.get('Rss', 0.0),
+		'pss_mb': usage.get('Pss', 0.0),
+		'shared_mb': usage.get('Shared_Clean', 0.0) + usage.get('Shared_Dirty', 0.0),
+		'private_mb': usage.get('Private_Clean', 0.0) + usage.get('Private_Dirty', 0.0),
+	}
+
+def coreSets(num_workers):
+	# Contiguous, equally sized groups of the cores this process may run on; with more workers than
+	#   cores, workers share single cores
+	cores = sorted(os.sched_getaffinity(0))
+	per_worker = max(1, len(cores) // num_workers)
+	return [cores[(i * per_worker) % len(cores) : (i * per_worker) % len(cores) + per_worker] for i in range(num_workers)]
+
+class WorkerPool():
+	def __init__(self, path, num_workers, threads=None, pin=True, share='mmap', max_batch=8, max_length=10, compile_cache=None):
+		if share not in ['mmap', 'shm']:
+			raise ValueError(share, "is not a weight sharing mode.")
+		device = torch.device('cpu')
+		# mmap: parameters stay backed by the checkpoint file; shm: they are copied once into shared memory
+		checkpoint = loadInferenceCheckpoint(path, device) if share == 'mmap' else torch.load(path, map_location=device, weights_only=True)
+		self.model, self.voc = buildInferenceModel(checkpoint, device)
+		if share == 'shm':
+			self.model.share_memory()
+		if compile_cache is not None:
+			self.model.compileSteps(cache=compile_cache)
+			self.model.warmup(max_length=max_length)
+		self.num_workers = num_workers
+		self.core_sets = coreSets(num_workers) if pin else [sorted(os.sched_getaffinity(0))] * num_workers
+		self.threads = threads
+		self.max_batch = max_batch
+		self.max_length = max_length
+		self.context = mp.get_context('fork')
+		self.requests = self.context.Queue()
+		self.results = self.context.Queue()
+		self.workers = []
+		self.next_id = 0
+
+	def start(self):
+		# Objects allocated so far (weights, vocabulary dictionaries) are moved out of the garbage collector's
+		#   reach, so that collections in the workers do not write to, and thereby copy, their pages
+		gc.freeze()
+		for rank in range(self.num_workers):
+			worker = self.context.Process(target=self.work, args=(rank,), daemon=True)
+			worker.start()
+			self.workers.append(worker)
+		return self
+
+	def work(self, rank):
+		cores = self.core_sets[rank]
+		os.sched_setaffinity(0, cores)
+		torch.set_num_threads(self.threads or len(cores))
+		stop = False
+		while not stop:
+			batch = [self.requests.get()]
+			# Take whatever else is already waiting, up to max_batch
+			while len(batch) < self.max_batch:
+				try:
+					batch.append(self.requests.get_nowait())
+				except queue.Empty:
+					break
+			if None in batch:
+				stop = True
+				# Leave the other workers their stop signals
+				for _ in range(batch.count(None) - 1):
+					self.requests.put(None)
+				batch = [request for request in batch if request is not None]
+			if batch:
+				try:
+					replies = evaluateBatch(self.model, self.voc, [sentence for _, sentence in batch], self.max_length)
+				except Exception as error:
+					# Every request of the batch is answered as failed, so that no caller waits for it forever
+					for request_id, _ in batch:
+						self.results.put((request_id, None, rank, '%s: %s' % (type(error).__name__, error)))
+					continue
+				for (request_id, _), reply in zip(batch, replies):
+					self.results.put((request_id, reply, rank, None))
+
+	def submit(self, sentence):
+		request_id = self.next_id
+		self.next_id += 1
+		self.requests.put((request_id, sentence))
+		return request_id
+
+	def result(self):
+		# (request_id, reply words or None for unknown words and failed decodes, rank of the worker that served it,
+		#   error message of a failed decode or None)
+		return self.results.get()
+
+	def map(self, sentences):
+		# Replies in input order, None for unknown words and failed decodes
+		ids = [self.submit(sentence) for sentence in sentences]
+		results = dict((request_id, reply) for request_id, reply, _, _ in (self.result() for _ in ids))
+		return [results[request_id] for request_id in ids]
+
+	def memory(self):
+		return [memoryUsage(worker.pid) for worker in self.workers]
+
+	def close(self):
+		for _ in self.workers:
+			self.requests.put(None)
+		for worker in self.workers:
+			worker.join()
+		self.workers = []
+
+def loadSentences(args):
+	if args.sentences:
+		with open(args.sentences, encoding='utf-8') as f:
+			return [line.rstrip('\n') for line in f if line.strip()]
+	if args.synthetic > 0:
+		from dataloader.synthetic import loadSyntheticDataset
+		return [pair[0] for pair in loadSyntheticDataset(args.synthetic, seed=args.seed)]
+	# Imported lazily: the NUCC loader pulls in spaCy/GiNZA
+	from dataloader.nucc import loadNUCCDataset
+	return [pair[0] for pair in loadNUCCDataset('data/nucc')]
+
+def benchmark(args):
+	sentences = loadSentences(args)
+	random.Random(args.seed).shuffle(sentences)
+	sentences = sentences[:args.requests]
+
+	pool = WorkerPool(args.load, args.workers, args.threads, not args.no_pin, args.share, args.max_batch, args.max_length,
+		args.compile_cache if args.compile else None).start()
+	# Warm-up: every worker decodes at least once before timing
+	pool.map(sentences[:args.workers * args.max_batch])
+	served = [0] * args.workers
+	start = time.perf_counter()
+	ids = [pool.submit(sentence) for sentence in sentences]
+	for _ in ids:
+		_, _, rank, _ = pool.result()
+		served[rank] += 1
+	pool_time = time.perf_counter() - start
+	workers = pool.memory()
+	for worker, count in zip(workers, served):
+		worker['requests'] = count
+	parent = memoryUsage(os.getpid())
+	pool.close()
+
+	# Baseline: one process using every core for intra-op parallelism, with the same batching
+	model, voc = pool.model, pool.voc
+	torch.set_num_threads(len(os.sched_getaffinity(0)))
+	evaluateBatch(model, voc, sentences[:args.max_batch], args.max_length)
+	start = time.perf_counter()
+	for i in range(0, len(sentences), args.max_batch):
+		evaluateBatch(model, voc, sentences[i : i + args.max_batch], args.max_length)
+	single_time = time.perf_counter() - start
+
+	report = {
+		'config': vars(args),
+		'pool': {
+			'seconds': pool_time,
+			'requests_per_sec': len(sentences) / pool_time,
+			'parent': parent,
+			'workers': workers,
+			'total_pss_mb': parent.get('pss_mb', 0.0) + sum(worker.get('pss_mb', 0.0) for worker in workers),
+		},
+		'single_process': {
+			'threads': torch.get_num_threads(),
+			'seconds': single_time,
+			'requests_per_sec': len(sentences) / single_time,
+			'memory': memoryUsage(os.getpid()),
+		},
+	}
+	report['speedup'] = report['pool']['requests_per_sec'] / report['single_process']['requests_per_sec']
+	for rank, worker in enumerate(workers):
+		print('worker %d: cores %s, %d requests, rss %.1f MB (shared %.1f MB, private %.1f MB), pss %.1f MB' % (rank,
+			pool.core_sets[rank], worker['requests'], worker.get('rss_mb', 0.0), worker.get('shared_mb', 0.0),
+			worker.get('private_mb', 0.0), worker.get('pss_mb', 0.0)))
+	print('pool: %.1f requests/sec, total pss %.1f MB' % (report['pool']['requests_per_sec'], report['pool']['total_pss_mb']))
+	print('single process (%d threads): %.1f requests/sec, rss %.1f MB' % (report['single_process']['threads'],
+		report['single_process']['requests_per_sec'], report['single_process']['memory'].get('rss_mb', 0.0)))
+	print('speedup %.2fx' % (report['speedup']))
+
+	with open(args.output, 'w') as f:
+		json.dump(report, f, indent=2)
+
+def serve(args):
+	# Normalized replies to stdin lines, in input order
+	from dataloader import utils
+	normalize = utils.normalizeString if args.english else utils.normalizeJapaneseString
+	pool = WorkerPool(args.load, args.workers, args.threads, not args.no_pin, args.share, args.max_batch, args.max_length,
+		args.compile_cache if args.compile else None).start()
+	try:
+		for line in sys.stdin:
+			pool.submit(normalize(line.strip()))
+			_, reply, _, error = pool.result()
+			if error is not None:
+				print("Error:", error)
+			elif reply is None:
+				print("Error: Encountered unknown word.")
+			else:
+				print('Bot:', ' '.join(word for word in reply if word not in ['EOS', 'PAD']))
+	finally:
+		pool.close()
+
+def listen(args):
+	# Line protocol over TCP on localhost: a request "<id>\t<normalized sentence>\n" is answered with
+	#   "<id>\t<reply words>\n" as soon as it is decoded, so replies may come back out of order. Unknown words
+	#   and failed decodes are answered with "<id>\n". Requests of all connections share the worker pool and its batching.
+	pool = WorkerPool(args.load, args.workers, args.threads, not args.no_pin, args.share, args.max_batch, args.max_length,
+		args.compile_cache if args.compile else None).start()
+	lock = threading.Lock()
+	# pool request id -> (connection, client request id)
+	pending = {}
+
+	def dispatch():
+		while True:
+			request_id, reply, _, _ = pool.result()
+			with lock:
+				connection, client_id = pending.pop(request_id)
+			if reply is None:
+				line = '%s\n' % (client_id)
+			else:
+				line = '%s\t%s\n' % (client_id, ' '.join(word for word in reply if word not in ['EOS', 'PAD']))
+			try:
+				connection.sendall(line.encode('utf-8'))
+			except OSError:
+				# The client went away; its remaining replies are dropped
+				pass
+
+	def handle(connection):
+		with connection, connection.makefile('r', encoding='utf-8') as lines:
+			for line in lines:
+				client_id, _, sentence = line.rstrip('\n').partition('\t')
+				with lock:
+					pending[pool.submit(sentence)] = (connection, client_id)
+
+	# Exit through the finally below on SIGTERM as well, so that the workers are stopped
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	server = socket.create_server(('127.0.0.1', args.port))
+	threading.Thread(target=dispatch, daemon=True).start()
+	print('listening on port %d' % (args.port), flush=True)
+	try:
+		while True:
+			connection, _ = server.accept()
+			threading.Thread(target=handle, args=(connection,), daemon=True).start()
+	finally:
+		server.close()
+		pool.close()
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-l', '--load', type=str, required=True, help='checkpoint with an embedded vocabulary')
+	parser.add_argument('-n', '--workers', type=int, default=2)
+	parser.add_argument('--threads', type=int, help='intra-op threads per worker (default: its number of cores)')
+	parser.add_argument('--no_pin', action='store_true', help='do not pin workers to core sets')
+	parser.add_argument('--share', type=str, default='mmap', choices=['mmap', 'shm'], help='share weights through the mapped checkpoint file or shared memory')
+	parser.add_argument('--max_batch', type=int, default=8, help='requests decoded together by a worker')
+	parser.add_argument('--max_length', type=int, default=10)
+	parser.add_argument('--compile', action='store_true', help='run the encoder and decoder steps through torch.compile, compiled before forking')
+	parser.add_argument('--compile_cache', type=str, default='weights/compile_cache', help='directory of compiled kernels reused across runs with --compile')
+	parser.add_argument('--port', type=int, help='serve normalized sentences over a localhost TCP line protocol instead of stdin')
+	parser.add_argument('--english', action='store_true')
+	parser.add_argument('--benchmark', action='store_true', help='compare throughput and memory against a single multi-threaded process')
+	parser.add_argument('--requests', type=int, default=1000)
+	parser.add_argument('--sentences', type=str, help='file of normalized input sentences, one per line, for --benchmark')
+	parser.add_argument('--synthetic', type=int, default=0, help='benchmark with synthetic inputs of this many pairs instead of NUCC')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('-o', '--output', type=str, default='serving.json')
+	args = parser.parse_args()
+
+	if args.benchmark:
+		benchmark(args)
+	elif args.port:
+		listen(args)
+	else:
+		serve(args)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,120 @@
+import json
+import time
+import random
+import argparse
+
+import torch
+
+from dataloader.corpus import loadCorpus
+from dataloader.common import TextDataloader, EOS_token
+from model.speculative import SpeculativeDecoder
+from inference import loadInferenceModel
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-m', '--model', type=str, required=True, help='checkpoint of the model to serve')
+parser.add_argument('-d', '--draft', type=str, required=True, help='small checkpoint sharing the vocabulary, e.g. from distill.py')
+parser.add_argument('-k', type=str, default='2,4,6', help='comma-separated numbers of drafted tokens per verification pass')
+parser.add_argument('-b', '--batch_size', type=int, default=1)
+parser.add_argument('--held_out', type=str, default='weights/held_out.tsv', help='pairs the model never trained on, written by test.py --held_out')
+parser.add_argument('--max_length', type=int, default=10)
+parser.add_argument('--ignore_eos', action='store_true', help='decode all max_length steps, for models whose replies end too early to fill a pass')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--synthetic', type=int, default=0, help='use a synthetic corpus of this many pairs instead of NUCC, held out against pairs of the next seed')
+parser.add_argument('-o', '--output', type=str, default='speculative.json')
+args = parser.parse_args()
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+eos = None if args.ignore_eos else EOS_token
+
+def synchronize():
+	if device.type == 'cuda':
+		torch.cuda.synchronize()
+
+def timeDecode(decoder, batches):
+	outputs = []
+	with torch.no_grad():
+		synchronize()
+		start = time.perf_counter()
+		for inputs, lengths in batches:
+			outputs.append(decoder.evaluate(inputs, lengths, args.max_length, EOS_token=eos))
+		synchronize()
+	return time.perf_counter() - start, outputs
+
+def timeEncode(decoder, model, batches):
+	with torch.no_grad():
+		synchronize()
+		start = time.perf_counter()
+		for inputs, lengths in batches:
+			decoder.encode(model, inputs, lengths)
+		synchronize()
+	return time.perf_counter() - start
+
+# Apart from the target's own encoder, which both decoders run, greedy pays step_time per decoding step and
+#   speculative decoding pays pass_time per pass. A pass breaks even when it advances pass_time / step_time
+#   steps; it advances 1 + acceptance * k steps unless the replies end first. Returns the steps and the
+#   acceptance rate needed, None when even full acceptance does not pay off.
+def breakEven(step_time, pass_time, k):
+	needed = pass_time / step_time
+	return needed, (max(needed - 1, 0.0) / k if needed <= k + 1 else None)
+
+def main():
+	random.seed(args.seed)
+	torch.manual_seed(args.seed)
+
+	model, voc = loadInferenceModel(args.model, device)
+	draft, _ = loadInferenceModel(args.draft, device)
+
+	_, held_out_pairs = loadCorpus(args.held_out, args.synthetic, args.seed)
+	dataloader = TextDataloader(held_out_pairs, max_length=32, min_count=3, batch_size=args.batch_size, shuffle=False, voc=voc)
+	batches = [(data[0].to(device), data[1]) for data in dataloader]
+
+	with torch.no_grad():
+		model.evaluate(batches[0][0], batches[0][1], args.max_length, EOS_token=eos)
+	greedy_time, greedy_outputs = timeDecode(model, batches)
+	tokens = sum(lengths.sum().item() for _, _, lengths in greedy_outputs)
+	# Decoding steps of the whole batch, which speculative decoding advances in lockstep
+	steps = sum(all_tokens.size(0) for all_tokens, _, _ in greedy_outputs)
+	report = {
+		'config': vars(args),
+		'sentences': sum(inputs.size(1) for inputs, _ in batches),
+		'greedy': {
+			'seconds': greedy_time,
+			'ms_per_token': greedy_time / tokens * 1000,
+			'mean_reply_length': tokens / sum(inputs.size(1) for inputs, _ in batches),
+		},
+		'speculative': {},
+	}
+	print('greedy: %.3f ms/token' % (report['greedy']['ms_per_token']))
+
+	for k in [int(k) for k in args.k.split(',')]:
+		decoder = SpeculativeDecoder(model, draft, k)
+		with torch.no_grad():
+			decoder.evaluate(batches[0][0], batches[0][1], args.max_length, EOS_token=eos)
+		decoder.reset()
+		elapsed, outputs = timeDecode(decoder, batches)
+		encode_time = timeEncode(decoder, model, batches)
+		break_even_steps, break_even = breakEven((greedy_time - encode_time) / steps, (elapsed - encode_time) / decoder.passes, k)
+		identical = sum(torch.equal(a[0], b[0]) and torch.equal(a[2], b[2]) for a, b in zip(greedy_outputs, outputs))
+		report['speculative'][str(k)] = {
+			'seconds': elapsed,
+			'ms_per_token': elapsed / tokens * 1000,
+			'speedup': greedy_time / elapsed,
+			'acceptance_rate': decoder.acceptanceRate(),
+			'accepted_per_pass': decoder.accepted / decoder.passes,
+			'break_even_acceptance_rate': break_even,
+			'steps_per_pass': steps / decoder.passes,
+			'break_even_steps_per_pass': break_even_steps,
+			'identical_batches': identical / len(batches),
+		}
+		r = report['speculative'][str(k)]
+		print('k=%d: %.3f ms/token, %.2fx, acceptance %.1f%% (break-even %s), %.2f steps per pass (break-even %.2f), %.1f%% identical to greedy' % (
+			k, r['ms_per_token'], r['speedup'], 100 * r['acceptance_rate'], 'never' if break_even is None else '%.1f%%' % (100 * break_even),
+			r['steps_per_pass'], break_even_steps, 100 * r['identical_batches']))
+		if r['speedup'] < 1:
+			print('  slower than greedy decoding: --speculative does not pay off with this draft and k')
+
+	with open(args.output, 'w') as f:
+		json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+	main()
@@ -1,77 +1,203 @@
+import os
+import sys
+import time
 import torch
 import argparse
 
 from dataloader.cornell import *
 from dataloader.convai2 import *
 from dataloader.nucc import *
-from dataloader.common import TextDataloader, PAD_token, SOS_token, EOS_token
+from dataloader.common import TextDataloader, Voc, filterPairs, PAD_token, SOS_token, EOS_token
+from dataloader.dedup import PairDeduplicator
+from dataloader.shards import ShardedTextDataloader, writePairFile
+from dataloader.mixing import MixedTextDataloader
 from dataloader import utils
 from model.seq2seq import Seq2SeqModel
+from model.profiling import StageProfiler, traceProfiler, stage
+from model.checkpoint import CheckpointSaver, CheckpointEvaluator, makeCheckpoint, loadCheckpoint
+from model.shortlist import buildShortlist
+from inference import loadInferenceCheckpoint, buildInferenceModel, evaluateInput
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', '--iteration', type=int, default=10)
 parser.add_argument('-b', '--batch_size', type=int, default=64)
+parser.add_argument('--max_tokens', type=int, help='build batches by padded token budget instead of a fixed pair count')
+parser.add_argument('--accumulation_steps', type=int, default=1, help='micro-batches per optimizer step; the loss is then normalized per token')
+parser.add_argument('--shards', type=str, help='train from a sharded corpus directory built by build_shards.py')
+parser.add_argument('--shuffle_buffer', type=int, default=100000, help='pairs kept in memory to shuffle across shards')
+parser.add_argument('--mix', type=str, help='sample batches from several corpora by weight, e.g. nucc:1.0,cornell:0.3')
+parser.add_argument('--dedup', action='store_true', help='drop exact duplicate pairs')
+parser.add_argument('--near_dup', action='store_true', help='also drop MinHash near-duplicate pairs')
+parser.add_argument('--max_response_count', type=int, help='keep at most this many pairs with the same response')
+parser.add_argument('--dedup_capacity', type=int, default=1000000, help='kept pairs the fixed-size dedup filters are sized for (20 MB per million)')
+parser.add_argument('--shortlist', type=int, help='build a decoding shortlist with this many frequent words into weights/shortlist.pth')
+parser.add_argument('--tie_embedding', action='store_true', help='use the shared embedding as the output projection')
+parser.add_argument('--output_rank', type=int, default=0, help='factorize the output projection through this many features')
+parser.add_argument('--checkpoint_steps', type=int, default=0, help='recompute decoder activations in backward, in chunks of this many timesteps')
+parser.add_argument('--compile', action='store_true', help='run the encoder and decoder steps through torch.compile (kernels cached in weights/compile_cache)')
+parser.add_argument('--held_out', type=int, default=0, help='keep this many pairs (of every corpus with --mix) out of training and write them to weights/held_out.tsv (not with --shards)')
+parser.add_argument('--async_eval', action='store_true', help='run evaluate.py on the held-out pairs in the background for every saved checkpoint (needs --held_out, not with --shards)')
 parser.add_argument('-l', '--load', type=str)
 parser.add_argument('-e', '--eval', action='store_true')
+parser.add_argument('--extend', type=str, help='continue training a checkpoint on the current corpus, appending its new words to the vocabulary')
+parser.add_argument('-r', '--resume', type=str, help='resume training from a checkpoint, including optimizer, data cursor and RNG state')
+parser.add_argument('--save_every', type=int, default=0, help='also checkpoint every N steps within an epoch')
+parser.add_argument('--keep', type=int, default=5, help='number of step checkpoints to retain')
+parser.add_argument('--profile', action='store_true', help='record per-stage wall times of each training step')
+parser.add_argument('--trace', type=str, help='export torch.profiler traces of the first training steps to this directory')
 args = parser.parse_args()
+# evaluate.py reads the held-out pairs from weights/held_out.tsv, which only --held_out without --shards writes
+if args.async_eval and (args.held_out <= 0 or args.shards):
+	sys.exit('--async_eval needs --held_out and cannot be combined with --shards')
+# The extended vocabulary is built from the plain corpus, before it is loaded
+if args.extend and (args.mix or args.shards):
+	sys.exit('--extend cannot be combined with --mix or --shards')
+# The shortlist counts words of training pairs held in memory, which a sharded corpus streams from disk
+if args.shortlist and args.shards:
+	sys.exit('--shortlist cannot be combined with --shards')
+# A sharded corpus is filtered and split by build_shards.py and batched by pair count
+if args.shards:
+	ignored = [flag for flag, value in [('--mix', args.mix), ('--max_tokens', args.max_tokens), ('--dedup', args.dedup),
+		('--near_dup', args.near_dup), ('--max_response_count', args.max_response_count is not None), ('--held_out', args.held_out > 0)] if value]
+	if ignored:
+		sys.exit('%s cannot be combined with --shards; deduplicate with build_shards.py instead' % (', '.join(ignored)))
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-dataset = []
-#dataset.extend(loadCornellDataset('data/cornell movie-dialogs corpus'))
-#dataset.extend(loadConvAI2Dataset('data/ConvAI2'))
-dataset.extend(loadNUCCDataset('data/nucc'))
+if args.eval and args.load:
+	# Checkpoints with an embedded vocabulary are served without loading the corpus
+	checkpoint = loadInferenceCheckpoint(args.load, device)
+	if 'voc' in checkpoint and 'config' in checkpoint:
+		model, voc = buildInferenceModel(checkpoint, device)
+		evaluateInput(model, voc, utils.normalizeJapaneseString)
+		sys.exit()
 
-dataloader = TextDataloader(dataset, max_length=32, min_count=3, batch_size=args.batch_size, shuffle=True)
+dedup = None
+if args.dedup or args.near_dup or args.max_response_count is not None:
+	dedup = PairDeduplicator(near_duplicates=args.near_dup, max_response_count=args.max_response_count,
+		capacity=args.dedup_capacity)
+
+if args.shards:
+	# Pre-built sharded corpus (see build_shards.py); streamed from disk instead of held in memory
+	dataloader = ShardedTextDataloader(args.shards, batch_size=args.batch_size, buffer_size=args.shuffle_buffer)
+elif args.mix:
+	corpora = {
+		'cornell': lambda: loadCornellDataset('data/cornell movie-dialogs corpus'),
+		'convai2': lambda: loadConvAI2Dataset('data/ConvAI2'),
+		'nucc': lambda: loadNUCCDataset('data/nucc'),
+	}
+	sources = {}
+	for source in args.mix.split(','):
+		name, weight = source.split(':')
+		sources[name] = (corpora[name], float(weight))
+	dataloader = MixedTextDataloader(sources, max_length=32, min_count=3, batch_size=args.batch_size, shuffle=True,
+		max_tokens=args.max_tokens, dedup=dedup, held_out=args.held_out)
+else:
+	dataset = []
+	#dataset.extend(loadCornellDataset('data/cornell movie-dialogs corpus'))
+	#dataset.extend(loadConvAI2Dataset('data/ConvAI2'))
+	dataset.extend(loadNUCCDataset('data/nucc'))
+
+	extend_voc = None
+	if args.extend:
+		# Keep the word ids of the checkpoint and append the words of the new data after them
+		extend_checkpoint = torch.load(args.extend, map_location='cpu', weights_only=False)
+		extend_voc = Voc()
+		extend_voc.load_state_dict(extend_checkpoint['voc'])
+		print("Added {} words".format(extend_voc.extend(filterPairs(dataset, 32), min_count=3)))
+
+	dataloader = TextDataloader(dataset, max_length=32, min_count=3, batch_size=args.batch_size, shuffle=True,
+		max_tokens=args.max_tokens, dedup=dedup, voc=extend_voc, held_out=args.held_out)
 voc = dataloader.getVoc()
 
-model = Seq2SeqModel(device, SOS_token, voc.num_words).to(device)
+if args.held_out > 0 and not args.shards:
+	os.makedirs('weights', exist_ok=True)
+	writePairFile('weights/held_out.tsv', dataloader.held_out_pairs)
+
+if args.extend:
+	# Load weights and optimizer state at the old size, then grow the embedding and output rows
+	model = Seq2SeqModel(device, SOS_token, **extend_checkpoint['config']).to(device)
+	loadCheckpoint(args.extend, model, map_location=device)
+	model.resizeVocab(voc.num_words)
+else:
+	model = Seq2SeqModel(device, SOS_token, voc.num_words, tie_embedding=args.tie_embedding, output_rank=args.output_rank).to(device)
 
 if args.load:
-	model.load_state_dict(torch.load(args.load))
+	model.load_state_dict(loadCheckpoint(args.load, map_location=device, restore_rng=False)['model'])
+
+start_epoch, step = 0, 0
+if args.resume:
+	checkpoint = loadCheckpoint(args.resume, model, dataloader, map_location=device)
+	start_epoch, step = checkpoint['epoch'], checkpoint['step']
+
+if args.shortlist:
+	# Frequent words plus input/output co-occurrences of the training pairs, for inference.py --shortlist
+	pairs = [pair for loader in dataloader.loaders.values() for pair in loader.pairs] if args.mix else dataloader.pairs
+	os.makedirs('weights', exist_ok=True)
+	torch.save(buildShortlist(voc, pairs, top_k=args.shortlist).state_dict(), 'weights/shortlist.pth')
 
 if not args.eval:
 	model.train()
+	model.checkpoint_steps = args.checkpoint_steps
+	if args.compile:
+		model.compileSteps(cache='weights/compile_cache')
 
-	for epoch in range(args.iteration):
+	profiler = None
+	if args.profile or args.trace:
+		profiler = StageProfiler(synchronize=True, record_functions=args.trace is not None)
+		model.profiler = profiler
+		dataloader.profiler = profiler
+	tracer = traceProfiler(args.trace) if args.trace else None
+	if tracer is not None:
+		tracer.start()
+
+	saver = CheckpointSaver('weights', keep=args.keep)
+	evaluator = None
+	if args.async_eval:
+		# Separate single-threaded process, one at a time, so evaluation neither blocks nor slows down the training loop much
+		evaluator = CheckpointEvaluator([sys.executable, 'evaluate.py', '--threads', '1', '-l'], saver)
+		saver.on_saved = evaluator
+
+	for epoch in range(start_epoch, args.iteration):
 		for i, data in enumerate(dataloader):
 			inputs, lengths, targets, mask, max_target_len = data
-			inputs = inputs.to(device)
-			lengths = lengths.to(device)
-			targets = targets.to(device)
-			mask = mask.to(device)
+			with stage(profiler, 'to_device'):
+				inputs = inputs.to(device)
+				lengths = lengths.to(device)
+				targets = targets.to(device)
+				mask = mask.to(device)
+
+			step_start = time.perf_counter()
+			print_loss = model.optimize(inputs, lengths, targets, mask, max_target_len, accumulation_steps=args.accumulation_steps)
+			if args.mix:
+				dataloader.record(print_loss, mask.sum().item(), time.perf_counter() - step_start)
+			if tracer is not None:
+				tracer.step()
 
-			print_loss = model.optimize(inputs, lengths, targets, mask, max_target_len)
+			step += 1
+			# Only checkpoint between optimizer steps, never with partially accumulated gradients
+			if args.save_every > 0 and step % args.save_every == 0 and model.accumulated_batches == 0:
+				saver.saveStep(makeCheckpoint(model, voc, dataloader, epoch, step), step)
 
 			if i % 10 == 0:
 				print('[Epoch: %d, %d/%d] loss: %f' % (epoch, i, len(dataloader), print_loss))
 
-		torch.save(model.state_dict(), 'weights/%03d.pth' % (epoch))
+		model.step()
+
+		if args.mix:
+			print(dataloader.report())
+		if profiler is not None:
+			print(profiler.report())
+			profiler.reset()
+
+		saver.save(makeCheckpoint(model, voc, dataloader, epoch + 1, step), '%03d.pth' % (epoch))
+
+	saver.close()
+	if evaluator is not None:
+		evaluator.close()
+	if tracer is not None:
+		tracer.stop()
 
 model.eval()
 
-def evaluate(model, voc, sentence, max_length=10):
-	indexes_batch = [voc.indicesFromSentence(sentence)]
-	lengths = torch.tensor([len(indexes) for indexes in indexes_batch])
-	input_batch = torch.LongTensor(indexes_batch).transpose(0, 1)
-	input_batch = input_batch.to(device)
-	lengths = lengths.to(device)
-	tokens, scores = model.evaluate(input_batch, lengths, max_length)
-	decoded_words = [voc.index2word[token.item()] for token in tokens]
-	return decoded_words 
- 
-def evaluateInput(model, voc):
-	input_sentence = ''
-	while(1):
-		try:
-			input_sentence = input('> ')
-			if input_sentence == 'q' or input_sentence == 'quit': break
-			input_sentence = utils.normalizeJapaneseString(input_sentence)
-			output_words = evaluate(model, voc, input_sentence)
-			output_words[:] = [x for x in output_words if not (x == 'EOS' or x == 'PAD')]
-			print('Bot:', ' '.join(output_words))
- 
-		except KeyError:
-			print("Error: Encountered unknown word.")
-
-evaluateInput(model, voc)
+evaluateInput(model, voc, utils.normalizeJapaneseString)
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from model.seq2seq import Seq2SeqModel
+
+# Masked attention: decoding a padded batch of mixed lengths gives the same replies as decoding
+#   every sentence on its own
+
+@pytest.mark.parametrize('attn_model', ['dot', 'general', 'concat'])
+def test_batched_evaluate_matches_single(attn_model):
+	torch.manual_seed(0)
+	model = Seq2SeqModel(torch.device('cpu'), 1, 50, attn_model=attn_model, hidden_size=16, encoder_n_layers=2, decoder_n_layers=2)
+	if attn_model == 'concat':
+		# Attn.v is created from uninitialized memory
+		torch.nn.init.normal_(model.decoder.attn.v)
+	model.eval()
+
+	lengths = torch.tensor([7, 5, 5, 3, 1])
+	input_seq = torch.randint(3, 50, (lengths.max(), lengths.size(0)))
+	# PAD after the end of each sentence
+	input_seq[torch.arange(lengths.max()).unsqueeze(1) >= lengths.unsqueeze(0)] = 0
+
+	with torch.no_grad():
+		tokens, scores, _ = model.evaluate(input_seq, lengths, 8, EOS_token=None)
+		for i in range(lengths.size(0)):
+			single_tokens, single_scores, _ = model.evaluate(input_seq[:lengths[i], i : i + 1], lengths[i : i + 1], 8, EOS_token=None)
+			assert torch.equal(tokens[:, i], single_tokens[:, 0])
+			assert torch.allclose(scores[:, i], single_scores[:, 0], rtol=0, atol=1e-6)
@@ -0,0 +1,39 @@
+import os
+import sys
+import subprocess
+
+import torch
+
+from dataloader.common import Voc
+from model.seq2seq import Seq2SeqModel
+from model.checkpoint import saveCheckpoint
+
+# Loading an inference checkpoint maps its tensors instead of allocating a second copy of the weights.
+#   Measured in a fresh process, where memory freed by earlier tests cannot hide an allocation.
+MEASURE = '''
+import os, sys, torch
+from serve import memoryUsage
+from inference import loadInferenceModel
+# One-time allocations of the first load (operator registration, allocator pools) are not counted
+loadInferenceModel(sys.argv[2], torch.device('cpu'))
+before = memoryUsage(os.getpid())['rss_mb']
+model, voc = loadInferenceModel(sys.argv[1], torch.device('cpu'))
+print(memoryUsage(os.getpid())['rss_mb'] - before)
+'''
+
+def saveInferenceCheckpoint(path, num_words, hidden_size):
+	voc = Voc()
+	for i in range(num_words - 3):
+		voc.addWord('w%d' % (i))
+	model = Seq2SeqModel(torch.device('cpu'), 1, voc.num_words, hidden_size=hidden_size)
+	saveCheckpoint({'config': model.config, 'model': model.state_dict(), 'voc': voc.state_dict()}, path)
+
+def test_load_does_not_copy_weights(tmp_path):
+	path, warmup_path = str(tmp_path / 'model.pth'), str(tmp_path / 'warmup.pth')
+	saveInferenceCheckpoint(path, 20000, 256)
+	saveInferenceCheckpoint(warmup_path, 100, 16)
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	output = subprocess.run([sys.executable, '-c', MEASURE, path, warmup_path], cwd=root, capture_output=True, text=True, check=True)
+	growth = float(output.stdout.split()[-1])
+	size = os.path.getsize(path) / 1024 / 1024
+	assert growth < 0.25 * size, (growth, size)
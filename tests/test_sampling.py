@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from model.sampling import Sampler, nucleusThreshold
+
+# nucleusThreshold selects the same words as sorting, and a seeded request samples the same tokens
+#   whatever it is batched with
+
+def sortedNucleus(weights, target):
+	# Membership of the smallest set of largest weights that sums to at least target, by sorting
+	sorted_weights, sorted_ids = weights.sort(dim=1, descending=True)
+	keep = (sorted_weights.cumsum(dim=1) - sorted_weights) < target
+	return torch.zeros_like(keep).scatter_(1, sorted_ids, keep)
+
+def rows(num_words, scales, seed=0):
+	generator = torch.Generator().manual_seed(seed)
+	return torch.cat([torch.softmax(torch.randn(1, num_words, generator=generator) * scale, dim=1) for scale in scales])
+
+@pytest.mark.parametrize('scale', [0.1, 1.0, 4.0, 8.0])
+def test_nucleus_threshold_matches_sort(scale):
+	weights = rows(3000, [scale] * 16)
+	# top_p < 1: at top_p = 1 the sampler does not filter, and the target would be the sum itself, up to rounding
+	target = torch.linspace(0.05, 0.95, 16).unsqueeze(1) * weights.sum(dim=1, keepdim=True)
+	threshold = nucleusThreshold(weights, target)
+	assert torch.equal(weights >= threshold, sortedNucleus(weights, target))
+
+@pytest.mark.parametrize('temperature', [1.0, 0.6])
+def test_sampled_words_are_in_the_nucleus(temperature):
+	# A peaked row goes through the ranked prefix, a flat one through nucleusThreshold
+	probs = rows(2000, [8.0, 0.1])
+	weights = (probs / probs.amax(dim=1, keepdim=True)) ** (1 / temperature)
+	allowed = sortedNucleus(weights, 0.8 * weights.sum(dim=1, keepdim=True))
+	sampler = Sampler(2, temperature=temperature, top_p=0.8, seeds=[1, 2])
+	for _ in range(200):
+		_, tokens = sampler(probs)
+		assert allowed[0, tokens[0]] and allowed[1, tokens[1]]
+
+@pytest.mark.parametrize('params', [
+	dict(top_p=0.8),
+	dict(top_k=[0, 5, 10, 0, 3, 2], top_p=0.8),
+	dict(temperature=[1.0, 0.0, 0.7, 1.3, 0.0, 0.5], top_p=0.9),
+	dict(top_p=[0.9, 1.0, 0.5, 1.0, 0.95, 0.3], temperature=0.8),
+	dict(top_k=[0, 0, 40, 0, 1, 7], top_p=[1.0, 0.9, 0.7, 0.5, 1.0, 1.0]),
+])
+def test_seeded_sampling_does_not_depend_on_batch(params):
+	probs = rows(2000, [0.1, 8.0, 1.0, 3.0, 0.5, 5.0])
+	seeds = list(range(10, 16))
+	batched = Sampler(6, seeds=seeds, **params)
+	batched_tokens = torch.stack([batched(probs)[1] for _ in range(50)])
+	for i in range(6):
+		single = Sampler(1, seeds=seeds[i : i + 1], **{key: [value[i]] if isinstance(value, list) else value for key, value in params.items()})
+		single_tokens = torch.stack([single(probs[i : i + 1])[1] for _ in range(50)])
+		assert torch.equal(single_tokens[:, 0], batched_tokens[:, i])
@@ -0,0 +1,48 @@
+import copy
+
+import pytest
+import torch
+
+from model.seq2seq import Seq2SeqModel
+from model.speculative import SpeculativeDecoder
+
+# Speculative decoding returns exactly the target's greedy output, whatever the draft proposes
+
+def makeModel(seed, num_words, hidden_size, n_layers):
+	torch.manual_seed(seed)
+	model = Seq2SeqModel(torch.device('cpu'), 1, num_words, hidden_size=hidden_size, encoder_n_layers=n_layers, decoder_n_layers=n_layers)
+	return model.eval()
+
+def perturbed(model, scale, seed):
+	# A draft that agrees with the model on some tokens only
+	generator = torch.Generator().manual_seed(seed)
+	draft = copy.deepcopy(model)
+	with torch.no_grad():
+		for param in draft.parameters():
+			param.add_(torch.randn(param.shape, generator=generator) * scale)
+	return draft
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('draft_kind', ['same', 'perturbed', 'unrelated'])
+@pytest.mark.parametrize('n_layers', [1, 2])
+def test_speculative_output_is_greedy_output(seed, draft_kind, n_layers):
+	# Few words, so that EOS (2) ends some replies early
+	num_words = 12
+	model = makeModel(seed, num_words, 16, n_layers)
+	draft = {'same': lambda: model, 'perturbed': lambda: perturbed(model, 0.03, seed),
+		'unrelated': lambda: makeModel(seed + 100, num_words, 8, 1)}[draft_kind]()
+	generator = torch.Generator().manual_seed(seed)
+	for batch_size in [1, 3, 8]:
+		lengths = torch.randint(1, 7, (batch_size,), generator=generator).sort(descending=True)[0]
+		inputs = torch.randint(3, num_words, (int(lengths[0]), batch_size), generator=generator)
+		for k in [1, 3, 5]:
+			for EOS_token in [2, None]:
+				decoder = SpeculativeDecoder(model, draft, k)
+				with torch.no_grad():
+					tokens, scores, reply_lengths = model.evaluate(inputs, lengths, 12, EOS_token=EOS_token)
+					speculative_tokens, speculative_scores, speculative_lengths = decoder.evaluate(inputs, lengths, 12, EOS_token=EOS_token)
+				assert torch.equal(speculative_tokens, tokens)
+				assert torch.equal(speculative_lengths, reply_lengths)
+				assert torch.allclose(speculative_scores, scores, atol=1e-6)
+				if draft_kind == 'same':
+					assert decoder.acceptanceRate() == 1.0
@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from model.seq2seq import Seq2SeqModel
+
+# Growing the vocabulary keeps the rows of the existing word ids and their Adam moments, and pads the
+#   moments of the new rows with zeros
+
+def trainStep(model, num_words):
+	inputs = torch.randint(3, num_words, (5, 4))
+	lengths = torch.tensor([5, 4, 3, 2])
+	targets = torch.randint(3, num_words, (3, 4))
+	mask = torch.ones(3, 4, dtype=torch.bool)
+	model.optimize(inputs, lengths, targets, mask, 3)
+
+@pytest.mark.parametrize('tie_embedding, output_rank', [(False, 0), (True, 0), (False, 4), (True, 4)])
+def test_resize_vocab_keeps_rows_and_adam_state(tie_embedding, output_rank):
+	torch.manual_seed(0)
+	old_words, new_words = 30, 45
+	model = Seq2SeqModel(torch.device('cpu'), 1, old_words, hidden_size=8, tie_embedding=tie_embedding, output_rank=output_rank)
+	model.train()
+	trainStep(model, old_words)
+
+	grown = {name: param for name, param in model.named_parameters() if param.size(0) == old_words}
+	before = {name: param.detach().clone() for name, param in grown.items()}
+	moments = {}
+	for name, param in grown.items():
+		for optimizer in [model.encoder_optimizer, model.decoder_optimizer]:
+			if param in optimizer.state:
+				moments[name] = {key: value.clone() for key, value in optimizer.state[param].items() if key != 'step'}
+	assert moments.keys() == grown.keys()
+
+	model.resizeVocab(new_words)
+
+	params = dict(model.named_parameters())
+	for name, value in before.items():
+		param = params[name]
+		assert param.size(0) == new_words
+		assert torch.equal(param[:old_words], value)
+		for optimizer in [model.encoder_optimizer, model.decoder_optimizer]:
+			if any(param is p for group in optimizer.param_groups for p in group['params']):
+				state = optimizer.state[param]
+				for key, moment in moments[name].items():
+					assert torch.equal(state[key][:old_words], moment)
+					assert not state[key][old_words:].any()
+	assert model.config['num_words'] == new_words
+
+	# New word ids are usable in training and decoding
+	trainStep(model, new_words)
+	model.eval()
+	with torch.no_grad():
+		tokens, _, _ = model.evaluate(torch.randint(old_words, new_words, (4, 1)), torch.tensor([4]), 5)
+	assert tokens.max() < new_words
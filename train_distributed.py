@@ -0,0 +1,113 @@
+import json
+import time
+import random
+import argparse
+
+import torch
+import torch.multiprocessing as mp
+
+from dataloader.synthetic import loadSyntheticDataset
+from dataloader.common import TextDataloader, SOS_token
+from model.seq2seq import Seq2SeqModel
+from model.checkpoint import CheckpointSaver, makeCheckpoint
+from model import distributed
+
+def loadDataset(args):
+	if args.synthetic > 0:
+		return loadSyntheticDataset(args.synthetic, seed=args.seed)
+	# Imported lazily: the NUCC loader pulls in spaCy/GiNZA, which synthetic runs do not need
+	from dataloader.nucc import loadNUCCDataset
+	return loadNUCCDataset('data/nucc')
+
+def train(rank, world_size, args, results):
+	distributed.setup(rank, world_size, args.port, args.threads)
+	device = torch.device('cpu')
+
+	# Same seed on every rank: identical shuffle before sharding and identical initial weights
+	random.seed(args.seed)
+	torch.manual_seed(args.seed)
+
+	dataloader = TextDataloader(loadDataset(args), max_length=32, min_count=3, batch_size=args.batch_size, shuffle=True, max_tokens=args.max_tokens)
+	dataloader.shard(rank, world_size)
+	voc = dataloader.getVoc()
+
+	model = Seq2SeqModel(device, SOS_token, voc.num_words, hidden_size=args.hidden_size)
+	model.distribute()
+	model.train()
+
+	saver = CheckpointSaver('weights', keep=None) if rank == 0 and args.save else None
+
+	tokens = 0
+	steps = 0
+	torch.distributed.barrier()
+	start = time.perf_counter()
+	for epoch in range(args.iteration):
+		for i, data in enumerate(dataloader):
+			if args.steps > 0 and i >= args.steps:
+				break
+			print_loss = model.optimize(*data, accumulation_steps=args.accumulation_steps)
+			tokens += data[3].sum().item()
+			steps += 1
+
+			if rank == 0 and i % 10 == 0:
+				print('[Epoch: %d, %d/%d] loss: %f' % (epoch, i, len(dataloader), print_loss))
+		model.step()
+
+		if saver is not None:
+			saver.save(makeCheckpoint(model, voc, None, epoch + 1, steps), '%03d.pth' % (epoch))
+
+	elapsed = time.perf_counter() - start
+	total_tokens = distributed.allReduceSum(tokens)
+	if saver is not None:
+		saver.close()
+	if rank == 0:
+		results.put({
+			'processes': world_size,
+			'threads_per_process': torch.get_num_threads(),
+			'steps_per_process': steps,
+			'seconds': elapsed,
+			'tokens': total_tokens,
+			'tokens_per_sec': total_tokens / elapsed,
+		})
+	distributed.cleanup()
+
+def run(args, world_size):
+	results = mp.get_context('spawn').SimpleQueue()
+	distributed.launch(train, world_size, args, results)
+	return results.get()
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-n', '--nproc', type=int, default=2)
+	parser.add_argument('-i', '--iteration', type=int, default=10)
+	parser.add_argument('-b', '--batch_size', type=int, default=64, help='per-process batch size')
+	parser.add_argument('--max_tokens', type=int, help='per-process padded token budget per batch instead of a fixed pair count')
+	parser.add_argument('--accumulation_steps', type=int, default=1)
+	parser.add_argument('--hidden_size', type=int, default=500)
+	parser.add_argument('--steps', type=int, default=0, help='limit the steps per epoch (0: full epochs)')
+	parser.add_argument('--threads', type=int, help='intra-op threads per process (default: cores / processes)')
+	parser.add_argument('--port', type=int, default=29500)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--synthetic', type=int, default=0, help='train on a synthetic corpus of this many pairs instead of NUCC')
+	parser.add_argument('--save', action='store_true', help='save a checkpoint from rank 0 after every epoch')
+	parser.add_argument('--scaling', type=str, help='comma-separated process counts to measure scaling efficiency over, e.g. 1,2,4')
+	parser.add_argument('-o', '--output', type=str, default='scaling.json')
+	args = parser.parse_args()
+
+	if args.scaling is None:
+		print(run(args, args.nproc))
+		return
+
+	report = []
+	for world_size in [int(n) for n in args.scaling.split(',')]:
+		result = run(args, world_size)
+		# Weak scaling: each process keeps its batch size, so ideal throughput grows linearly
+		result['efficiency'] = result['tokens_per_sec'] / (world_size * report[0]['tokens_per_sec'] / report[0]['processes']) if report else 1.0
+		report.append(result)
+		print('%2d processes: %10.1f tokens/sec, efficiency %.2f' % (world_size, result['tokens_per_sec'], result['efficiency']))
+
+	with open(args.output, 'w') as f:
+		json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+	main()